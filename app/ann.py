@@ -0,0 +1,164 @@
+import os
+import numpy as np
+from recall import print_report, recall_against_exact
+from vectors import normalize_rows, top_k
+
+IVF_FILE = "ivf.npz"
+
+
+class IVFIndex:
+    """
+    Inverted-file (IVF) approximate nearest-neighbour index over unit-length embeddings.
+
+    The corpus is partitioned into `n_lists` clusters with spherical k-means. A query only scores
+    the rows of the `nprobe` clusters whose centroids are closest to it, so search cost grows with
+    nprobe / n_lists of the corpus instead of the whole corpus. Rows are referenced by their
+    position in the embedding matrix of the index they belong to.
+    """
+
+    def __init__(self, centroids, lists=None):
+        """
+        Args:
+            centroids (np.ndarray): An (n_lists, dims) array of unit-length cluster centroids.
+            lists (list, optional): One int64 array of row ids per centroid.
+        """
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.lists = lists if lists is not None else [np.zeros(0, dtype=np.int64) for _ in range(len(centroids))]
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def train(cls, embeddings, n_lists=256, n_iter=10, sample_size=100000, seed=0):
+        """
+        Fit the cluster centroids with spherical k-means on a sample of the corpus.
+
+        Args:
+            embeddings (np.ndarray): The unit-length corpus embeddings.
+            n_lists (int, optional): Number of clusters. Defaults to 256.
+            n_iter (int, optional): Number of k-means iterations. Defaults to 10.
+            sample_size (int, optional): Maximum number of rows used for training. Defaults to 100000.
+            seed (int, optional): Random seed for sampling and initialisation. Defaults to 0.
+
+        Returns:
+            IVFIndex: An empty index with trained centroids.
+        """
+        rng = np.random.default_rng(seed)
+        n_rows = len(embeddings)
+        n_lists = max(1, min(n_lists, n_rows))
+
+        sample_ids = rng.choice(n_rows, size=min(sample_size, n_rows), replace=False)
+        sample = np.asarray(embeddings[np.sort(sample_ids)], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+
+        for _ in range(n_iter):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+
+            # Keep the previous centroid for clusters that received no rows
+            empty = ~np.bincount(assignments, minlength=n_lists).astype(bool)
+            sums[empty] = centroids[empty]
+            centroids = normalize_rows(sums)
+
+        return cls(centroids)
+
+    def _assign(self, embeddings, batch_size=65536):
+        """Return the nearest centroid of every row, computed in batches to bound memory."""
+        assignments = np.empty(len(embeddings), dtype=np.int64)
+        for start in range(0, len(embeddings), batch_size):
+            batch = np.asarray(embeddings[start:start + batch_size], dtype=np.float32)
+            assignments[start:start + batch_size] = np.argmax(batch @ self.centroids.T, axis=1)
+        return assignments
+
+    def add(self, embeddings, start_id=0):
+        """
+        Insert rows into the inverted lists without retraining the centroids.
+
+        Args:
+            embeddings (np.ndarray): The unit-length embeddings to insert.
+            start_id (int, optional): Row id of the first embedding in the index matrix. Defaults to 0.
+        """
+        assignments = self._assign(embeddings)
+        ids = np.arange(start_id, start_id + len(embeddings), dtype=np.int64)
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.searchsorted(assignments[order], np.arange(self.n_lists + 1))
+        for list_id in range(self.n_lists):
+            new_ids = ids[order[bounds[list_id]:bounds[list_id + 1]]]
+            if len(new_ids):
+                self.lists[list_id] = np.concatenate([self.lists[list_id], new_ids])
+
+    def candidates(self, query, nprobe=8):
+        """
+        Return the row ids stored in the `nprobe` lists closest to the query.
+
+        Args:
+            query (np.ndarray): A unit-length query embedding.
+            nprobe (int, optional): Number of lists to visit. Defaults to 8.
+
+        Returns:
+            np.ndarray: The candidate row ids.
+        """
+        probe = top_k(self.centroids @ query, max(1, nprobe))
+        return np.concatenate([self.lists[list_id] for list_id in probe])
+
+    def save(self, path):
+        """Persist the centroids and inverted lists to a single .npz file."""
+        sizes = np.array([len(ids) for ids in self.lists], dtype=np.int64)
+        ids = np.concatenate(self.lists) if self.lists else np.zeros(0, dtype=np.int64)
+        with open(path + ".tmp", "wb") as file:
+            np.savez(file, centroids=self.centroids, ids=ids, sizes=sizes)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        """Load an index written by `save`."""
+        with np.load(path) as data:
+            offsets = np.concatenate([[0], np.cumsum(data["sizes"])])
+            ids = data["ids"]
+            lists = [ids[offsets[i]:offsets[i + 1]] for i in range(len(data["sizes"]))]
+            return cls(data["centroids"], lists)
+
+
+def recall_report(engine, index_name, top_n=5, nprobes=(1, 2, 4, 8, 16, 32), n_queries=200, seed=0):
+    """
+    Measure recall@k and latency of IVF search against exact search on the same index.
+
+    Queries are corpus embeddings perturbed with a little Gaussian noise, so the report can be
+    produced without a labelled query set.
+
+    Args:
+        engine (LocalSearchEngine): The local search engine holding the index.
+        index_name (str): The index to evaluate. It must have an IVF index built.
+        top_n (int, optional): The k in recall@k. Defaults to 5.
+        nprobes (tuple, optional): The nprobe values to evaluate. Defaults to (1, 2, 4, 8, 16, 32).
+        n_queries (int, optional): Number of sampled queries. Defaults to 200.
+        seed (int, optional): Random seed for query sampling. Defaults to 0.
+
+    Returns:
+        list: One dict per setting with `setting`, `recall` and `mean_ms`, preceded by the exact baseline.
+    """
+    settings = [(f"nprobe={nprobe}", {"nprobe": nprobe}) for nprobe in nprobes]
+    return recall_against_exact(engine, index_name, settings, top_n, n_queries, seed)
+
+
+if __name__ == "__main__":
+    import argparse
+    from local_search import LocalSearchEngine
+
+    parser = argparse.ArgumentParser(description="Build an IVF index for a local search index and report recall@k against exact search.")
+    parser.add_argument("--index-dir", default="../docs/local_index")
+    parser.add_argument("--index-name", default="passage_metadata_emb")
+    parser.add_argument("--n-lists", type=int, default=256)
+    parser.add_argument("--top-n", type=int, default=5)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--no-build", action="store_true", help="Evaluate the existing IVF index instead of rebuilding it")
+    args = parser.parse_args()
+
+    engine = LocalSearchEngine(args.index_dir)
+    if not args.no_build:
+        engine.build_ann(args.index_name, n_lists=args.n_lists)
+
+    print_report(recall_report(engine, args.index_name, args.top_n, args.nprobe, args.queries), args.top_n)
@@ -0,0 +1,116 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+def answer_key(model_name, prompt_template, passages, user_query):
+    """
+    Hash everything that determines a generated answer.
+
+    Args:
+        model_name (str): Name of the generative model.
+        prompt_template (str): The prompt template the passages and query are inserted into.
+        passages (list): The retrieved passages, in prompt order.
+        user_query (str): The user's query/question.
+
+    Returns:
+        str: The hex SHA-256 digest used as cache key.
+    """
+    digest = hashlib.sha256()
+    for part in [model_name, prompt_template, user_query, *passages]:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class AnswerCache:
+    """
+    Persistent cache of generated answers stored in a local SQLite database.
+
+    Entries are evicted least recently used first once the stored answers exceed `max_bytes`.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        """
+        Args:
+            path (str): Path to the SQLite database file.
+            max_bytes (int, optional): Maximum total size of the stored answers. Defaults to 64 MiB.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "key TEXT PRIMARY KEY, answer TEXT, size INTEGER, last_used REAL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)")
+        # Total size of the stored answers, kept up to date by put and clear instead of summed on every insert
+        self._total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM answers").fetchone()[0]
+
+    def get(self, key):
+        """Return the cached answer for `key`, or None."""
+        with self._lock:
+            row = self._connection.execute("SELECT answer FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            with self._connection:
+                self._connection.execute("UPDATE answers SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, answer):
+        """Store an answer and evict the least recently used answers beyond `max_bytes`."""
+        if answer is None:
+            return
+
+        size = len(answer.encode("utf-8"))
+        with self._lock, self._connection:
+            replaced = self._connection.execute("SELECT size FROM answers WHERE key = ?", (key,)).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO answers (key, answer, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, answer, size, time.time())
+            )
+            total = self._total + size - (replaced[0] if replaced else 0)
+            while total > self.max_bytes:
+                oldest = self._connection.execute(
+                    "SELECT key, size FROM answers ORDER BY last_used LIMIT 1"
+                ).fetchone()
+                if oldest is None:
+                    break
+                self._connection.execute("DELETE FROM answers WHERE key = ?", (oldest[0],))
+                total -= oldest[1]
+                self.evictions += 1
+            self._total = total
+
+    def clear(self):
+        """Delete every cached answer."""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM answers")
+            self._total = 0
+
+    def stats(self):
+        """Return the size of the cache and its counters."""
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "size": entries,
+                "bytes": self._total,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
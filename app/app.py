@@ -1,12 +1,19 @@
 import os
-from elasticsearch import Elasticsearch
-from sentence_transformers import SentenceTransformer
-from indexing import connect_instance, create_index, index_data_to_elasticsearch
-from gen_ai import generate_direct_answer_with_palm
-from model import generate_embeddings_and_save
-from parsing import process_folder
+import time
+import threading
+from batcher import MicroBatcher
+from evaluation import answer_questions
+from cache import cache_stats, cached_encode, cached_search, check_index_stamp, semantic_cache
+from documents import DOCUMENT_STORE_PATH, DocumentStore, join_metadata
+from local_search import LocalSearchEngine
+from metrics import HITS_RETURNED, REGISTRY, REQUEST_SECONDS, REQUESTS, finish_trace, start_trace
+from model import MODEL_NAME, load_model
+from projection import PROJECTION_PATH, ProjectedEncoder, load_projection
+from gen_ai import answer_cache_stats, answer_hits, stream_answer
 from retrieval import search_similar_passages, save_results_to_csv
-from flask import Flask, request, jsonify
+from sessions import SessionStore, build_session_index
+import json
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from werkzeug.utils import secure_filename
 
 from dotenv import load_dotenv
@@ -14,110 +21,516 @@ load_dotenv()
 
 app = Flask(__name__)
 
-# Initialize the SentenceTransformer model for embeddings
-model = SentenceTransformer('paraphrase-distilroberta-base-v1')
+# The embedding model, the search backend and their heavy imports (torch, the Elasticsearch client) are
+# created on first use or by the background warm-up, so importing this module and binding the port is fast.
+# The model is read from a local snapshot when one has been saved with `python model.py --save-snapshot`.
+MODEL_SNAPSHOT_DIR = os.getenv("MODEL_SNAPSHOT_DIR", "../docs/model_snapshot")
 
-# Retrieve environment variables for connecting to Elasticsearch
-es_host = os.getenv("ES_HOST")
-es_port = int(os.getenv("ES_PORT"))
-es_username = os.getenv("ES_USERNAME")
-es_password = os.getenv("ES_PASSWORD")
+# Inference runtime of the embedding model: "torch", "torch-int8", "onnx" or "onnx-int8" (see model.EMBEDDING_BACKENDS)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+ONNX_QUANTIZATION = os.getenv("ONNX_QUANTIZATION", "avx2")
 
-# Connect to the remote Elasticsearch instance
-es = connect_instance(es_host, es_port, es_username, es_password)
+# Encode questions through a micro-batcher so concurrent requests share one forward pass
+MICRO_BATCH_SIZE = int(os.getenv("MICRO_BATCH_SIZE", "32"))
+MICRO_BATCH_WAIT_MS = float(os.getenv("MICRO_BATCH_WAIT_MS", "5"))
 
-# Configuration for file uploads
-UPLOAD_FOLDER = '../docs/corpus'  
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# Select the retrieval backend: "elasticsearch" (default) or "local" for in-process search
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "elasticsearch")
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "../docs/local_index")
 
-# Ensure UPLOAD_FOLDER exists, if not, create it
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
-    print("created folder")
+# Approximate nearest-neighbour settings: IVF lists probed by the local backend, and kNN candidates
+# considered by Elasticsearch (0 keeps exact script_score search)
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "8"))
+ES_NUM_CANDIDATES = int(os.getenv("ES_NUM_CANDIDATES", "0"))
+
+# Quantized first-stage search ("int8" or "binary", empty for float32) with exact rescoring of
+# QUANTIZATION_OVERSAMPLE x top_n shortlisted rows; Elasticsearch applies it to new kNN indexes
+QUANTIZATION = os.getenv("QUANTIZATION", "") or None
+QUANTIZATION_OVERSAMPLE = int(os.getenv("QUANTIZATION_OVERSAMPLE", "10"))
+
+# Warm the service up in the background once the server listens: load the model, connect to the
+# search backend and run one encode and one search, then report ready on /ready
+WARM_UP = os.getenv("WARM_UP", "true").lower() == "true"
+WARM_UP_RETRY_SECONDS = float(os.getenv("WARM_UP_RETRY_SECONDS", "5"))
+
+model = None
+question_encoder = None
+es = None
+documents = None
+_init_lock = threading.RLock()
+
+# Startup timeline in seconds since the process started; serve.py records when the port is listening
+startup = {"started_at": time.perf_counter(), "listening": None, "ready": None, "first_request": None,
+           "first_request_ms": None, "error": None}
+
+
+def get_model():
+    """Return the embedding model, loading it on first use and wrapping it in the PCA projection if one is configured."""
+    global model
+    if model is None:
+        with _init_lock:
+            if model is None:
+                start = time.perf_counter()
+                loaded = load_model(MODEL_NAME, MODEL_SNAPSHOT_DIR, EMBEDDING_BACKEND, ONNX_QUANTIZATION)
+                projection = load_projection(PROJECTION_PATH)
+                if projection is not None:
+                    # Questions are reduced with the projection the indexed passages were reduced with
+                    loaded = ProjectedEncoder(loaded, projection)
+                model = loaded
+                print(f"Loaded {MODEL_NAME} on the {EMBEDDING_BACKEND} backend in {time.perf_counter() - start:.2f}s"
+                      + (f", projected to {projection.dims} dimensions" if projection is not None else ""))
+    return model
+
+
+def get_question_encoder():
+    """Return the question encoder, a micro-batcher in front of the model unless batching is disabled."""
+    global question_encoder
+    if question_encoder is None:
+        with _init_lock:
+            if question_encoder is None:
+                loaded = get_model()
+                question_encoder = MicroBatcher(loaded, MICRO_BATCH_SIZE, MICRO_BATCH_WAIT_MS) if MICRO_BATCH_SIZE > 1 else loaded
+    return question_encoder
+
+
+def get_search_backend():
+    """Return the search backend, connecting to it on first use."""
+    global es
+    if es is None:
+        with _init_lock:
+            if es is None:
+                if SEARCH_BACKEND == "local":
+                    # Serve retrieval from memory-mapped embeddings on local disk
+                    es = LocalSearchEngine(LOCAL_INDEX_DIR, default_nprobe=ANN_NPROBE,
+                                           quantization=QUANTIZATION, oversample=QUANTIZATION_OVERSAMPLE)
+                else:
+                    from indexing import connect_instance
+
+                    # Connect to the remote Elasticsearch instance
+                    es = connect_instance(os.getenv("ES_HOST"), int(os.getenv("ES_PORT")),
+                                          os.getenv("ES_USERNAME"), os.getenv("ES_PASSWORD"))
+    return es
+
+
+def get_document_store():
+    """Return the document table the metadata of search hits is joined from, opening it on first use."""
+    global documents
+    if documents is None:
+        with _init_lock:
+            if documents is None:
+                documents = DocumentStore(DOCUMENT_STORE_PATH)
+    return documents
+
+
+def warm_up(index_name="passage_metadata_emb"):
+    """
+    Load the model and the search backend and run one encode and one search, retrying until they succeed.
+
+    The service reports ready on /ready once this returns, so the first routed request does not pay
+    for model loading, lazy imports or the first forward pass.
+    """
+    while True:
+        try:
+            embedding = get_question_encoder().encode("warm up")
+            search_similar_passages(get_search_backend(), index_name, embedding, 1)
+            break
+        except Exception as e:
+            startup["error"] = str(e)
+            print(f"Warm-up failed, retrying in {WARM_UP_RETRY_SECONDS}s: {e}")
+            time.sleep(WARM_UP_RETRY_SECONDS)
+
+    startup["error"] = None
+    startup["ready"] = time.perf_counter() - startup["started_at"]
+    print(f"Ready {startup['ready']:.2f}s after startup")
+
+
+def start_warm_up():
+    """Run `warm_up` in a background thread, or mark the service ready at once if warm-up is disabled."""
+    if WARM_UP:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    else:
+        startup["ready"] = time.perf_counter() - startup["started_at"]
+
+# Number of passages encoded per forward pass when embedding uploaded documents
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+
+# Limits of /ask_batch: questions per request, passages retrieved per question, and answers generated concurrently
+MAX_BATCH_QUESTIONS = int(os.getenv("MAX_BATCH_QUESTIONS", "1000"))
+MAX_TOP_N = int(os.getenv("MAX_TOP_N", "100"))
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "8"))
+
+# Documents uploaded to /upload are indexed in memory per session (see sessions.SESSION_TTL and SESSION_MAX_MB)
+sessions = SessionStore()
+
+
+def int_option(payload, key, default, minimum=1, maximum=None):
+    """
+    Return an integer option of a request body, or its default if the body does not set it.
+
+    Raises:
+        ValueError: If the value is not an integer between `minimum` and `maximum`.
+    """
+    value = payload.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(f"{key} must be an integer, got {value!r}")
+    if value < minimum or (maximum is not None and value > maximum):
+        bounds = f"between {minimum} and {maximum}" if maximum is not None else f"at least {minimum}"
+        raise ValueError(f"{key} must be {bounds}, got {value}")
+    return value
+
+
+def request_question(payload):
+    """
+    Return the `question` of a request body.
+
+    Raises:
+        ValueError: If the body is not a JSON object or its question is not a non-empty string.
+    """
+    question = payload.get('question') if isinstance(payload, dict) else None
+    if not isinstance(question, str) or not question.strip():
+        raise ValueError('Expected a non-empty question')
+    return question
+
+
+def search_knobs(payload):
+    """
+    Return the `nprobe` and `num_candidates` search knobs of a request body, defaulting to the configured ones.
+
+    `num_candidates` may be 0, which keeps exact search on Elasticsearch as ES_NUM_CANDIDATES does.
+
+    Raises:
+        ValueError: If a knob is not a positive integer (or 0 for `num_candidates`).
+    """
+    return (int_option(payload, 'nprobe', ANN_NPROBE),
+            int_option(payload, 'num_candidates', ES_NUM_CANDIDATES, minimum=0))
+
+
+def retrieve(payload, index_name="passage_metadata_emb"):
+    """
+    Encode the question of a request body and retrieve the most similar passages.
+
+    Args:
+        payload (dict): The JSON request body with `question`, an optional metadata `filter`, optional
+            `nprobe`/`num_candidates` knobs, and an optional `session_id` to search the documents uploaded in
+            that session instead of the index.
+        index_name (str, optional): The index to search in. Defaults to "passage_metadata_emb".
+
+    Returns:
+        tuple: (question, search_results)
+
+    Raises:
+        KeyError: If the session is unknown, expired or evicted.
+        ValueError: If the question, the filter or a search knob is invalid.
+    """
+    # Extract the user question and optional ANN knobs from the request
+    question = request_question(payload)
+    nprobe, num_candidates = search_knobs(payload)
+    filters = payload.get('filter') or None
+
+    # Convert the question into an embedding, reusing the embedding of a repeated question
+    question_embedding = cached_encode(get_question_encoder(), question)
+
+    # Search the in-memory index of an upload session, whose hits carry their own metadata
+    session_id = payload.get('session_id')
+    if session_id:
+        index = sessions.get(session_id)
+        if index is None:
+            raise KeyError(session_id)
+        search_results = index.search(question_embedding)
+        HITS_RETURNED.observe(len(search_results))
+        return question, search_results
+
+    # Search for relevant passages, reusing the hits of a repeated search
+    search_results = cached_search(get_search_backend(), index_name, question_embedding,
+                                   nprobe=nprobe, num_candidates=num_candidates, filters=filters)
+    HITS_RETURNED.observe(len(search_results))
+
+    # Join the metadata of their documents into the returned hits only
+    return question, join_metadata(search_results, get_document_store())
+
+
+@app.before_request
+def start_request_timer():
+    """Start timing the request and collecting its per-stage breakdown."""
+    g.request_start = time.perf_counter()
+    start_trace()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Record the latency and status of the request; streamed bodies are timed to their first byte."""
+    endpoint = request.endpoint or "unknown"
+    elapsed = time.perf_counter() - g.request_start
+    REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+
+    # Record when the first request other than a probe was served, and how long it took
+    if startup["first_request"] is None and endpoint not in ("healthz", "ready", "get_metrics", "unknown"):
+        startup["first_request"] = time.perf_counter() - startup["started_at"]
+        startup["first_request_ms"] = elapsed * 1000
+    return response
+
+
+def cache_gauges(field):
+    """Return (labels, value) pairs of one statistic of every cache tier, for the /metrics gauges."""
+    stats = cache_stats()
+    answer_stats = answer_cache_stats()
+    if answer_stats is not None:
+        stats["answer"] = answer_stats
+    return [({"tier": tier}, tier_stats[field]) for tier, tier_stats in stats.items() if field in tier_stats]
+
+
+REGISTRY.gauge("queryquill_cache_entries", "Entries held by each cache tier.", lambda: cache_gauges("size"))
+REGISTRY.gauge("queryquill_cache_hit_rate", "Hit rate of each cache tier since startup.", lambda: cache_gauges("hit_rate"))
+REGISTRY.gauge("queryquill_sessions", "Live upload sessions.", lambda: [({}, sessions.stats()["sessions"])])
+REGISTRY.gauge("queryquill_session_bytes", "Memory held by the indexes of live upload sessions.", lambda: [({}, sessions.stats()["bytes"])])
+REGISTRY.gauge("queryquill_startup_seconds", "Seconds from process start to each startup milestone.",
+               lambda: [({"milestone": name}, startup[name]) for name in ("listening", "ready", "first_request")
+                        if startup[name] is not None])
+
+
+def semantic_lookup(payload, index_name="passage_metadata_emb"):
+    """
+    Look the question of a request body up in the semantic cache of recently answered questions.
+
+    Args:
+        payload (dict): The JSON request body, as for `retrieve`.
+        index_name (str, optional): The index the question is asked against. Defaults to "passage_metadata_emb".
+
+    Returns:
+        tuple: (scope, question_embedding, cached), where `cached` is the (hits, answer, similarity) of a similar
+        enough cached question or None. Questions about an upload session are not cached and have no scope.
+
+    Raises:
+        ValueError: If the question or a search knob is invalid.
+    """
+    question = request_question(payload)
+    nprobe, num_candidates = search_knobs(payload)
+    if payload.get('session_id'):
+        return None, None, None
+
+    # Answers are only shared between questions searched in the same index with the same knobs and filter
+    scope = (index_name, json.dumps({'filter': payload.get('filter') or None, 'nprobe': nprobe,
+                                     'num_candidates': num_candidates}, sort_keys=True))
+    question_embedding = cached_encode(get_question_encoder(), question)
+    check_index_stamp(index_name)
+    return scope, question_embedding, semantic_cache.get(scope, question_embedding)
 
 
 @app.route('/ask', methods=['POST'])
 def ask():
     """
     API endpoint to retrieve answers for a given question.
+
+    A question similar enough to a recently answered one (see `cache.SemanticCache`) is served the cached
+    passages and answer without searching or generating.
     
     Returns:
         json: A JSON object containing the top relevant answers, metadata, and AI-generated answer.
     """
-    # Extract the user question from the request
-    question = request.json.get('question', '')
-
-    # Convert the question into an embedding
-    question_embedding = model.encode(question)
+    try:
+        scope, question_embedding, cached = semantic_lookup(request.json)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    context = None
+    if cached is not None:
+        search_results, gen_ai_output, similarity = cached
+    else:
+        try:
+            question, search_results = retrieve(request.json)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid filter. Error: {str(e)}'}), 400
+        except KeyError:
+            return jsonify({'error': 'Unknown or expired session, upload the files again'}), 404
 
-    # Search for relevant passages using the provided functions
-    search_results = search_similar_passages(es, "passage_metadata_emb", question_embedding)
+        # Generate AI-enhanced answer
+        gen_ai_output, context = answer_hits(search_results, question)
+        if scope is not None:
+            semantic_cache.put(scope, question_embedding, search_results, gen_ai_output)
 
     # Extract the top passages and their metadata from the search results
     passages = [hit["_source"]["Passage"] for hit in search_results]
     metadata = [hit["_source"]["Metadata"] for hit in search_results]
     scores = [hit["_score"] for hit in search_results]
+
+    response = {'answer': passages, 'relevance_socres': scores,'metadata': metadata, 'gen_ai_output': gen_ai_output}
+    if request.json.get('timings'):
+        response['timings'] = finish_trace()
+        response['prompt_tokens'] = context.prompt_tokens if context is not None else 0
+        response['semantic_cache_similarity'] = similarity if cached is not None else None
+    return jsonify(response)
+
+
+@app.route('/ask_stream', methods=['POST'])
+def ask_stream():
+    """
+    Streaming variant of /ask that sends the retrieved passages before the generated answer.
     
-    # Generate AI-enhanced answer
-    gen_ai_output = generate_direct_answer_with_palm(search_results, question, save_csv=False)
+    Returns:
+        Response: Newline-delimited JSON events: one `hits` event with the passages, relevance scores and
+        metadata, `answer` events with fragments of the AI-generated answer, then a `done` event, which carries
+        the per-stage timings if the request set `timings`.
+    """
+    try:
+        scope, question_embedding, cached = semantic_lookup(request.json)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    want_timings = bool(request.json.get('timings'))
+    if cached is not None:
+        search_results, cached_answer, _ = cached
+    else:
+        try:
+            question, search_results = retrieve(request.json)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid filter. Error: {str(e)}'}), 400
+        except KeyError:
+            return jsonify({'error': 'Unknown or expired session, upload the files again'}), 404
+
+    def generate_events():
+        yield json.dumps({
+            'type': 'hits',
+            'answer': [hit["_source"]["Passage"] for hit in search_results],
+            'relevance_socres': [hit["_score"] for hit in search_results],
+            'metadata': [hit["_source"]["Metadata"] for hit in search_results]
+        }) + "\n"
+
+        if cached is not None:
+            yield json.dumps({'type': 'answer', 'text': cached_answer}) + "\n"
+        else:
+            try:
+                fragments = []
+                for fragment in stream_answer(search_results, question):
+                    fragments.append(fragment)
+                    yield json.dumps({'type': 'answer', 'text': fragment}) + "\n"
+                if scope is not None:
+                    semantic_cache.put(scope, question_embedding, search_results, "".join(fragments))
+            except Exception as e:
+                yield json.dumps({'type': 'error', 'error': f'Failed to generate an answer. Error: {str(e)}'}) + "\n"
 
-    return jsonify({'answer': passages, 'relevance_socres': scores,'metadata': metadata, 'gen_ai_output': gen_ai_output})
+        done = {'type': 'done'}
+        if want_timings:
+            done['timings'] = finish_trace()
+        yield json.dumps(done) + "\n"
 
+    return Response(stream_with_context(generate_events()), mimetype='application/x-ndjson')
 
-def save_file(file, extension):
+
+@app.route('/ask_batch', methods=['POST'])
+def ask_batch():
+    """
+    Batch variant of /ask for many questions at once, e.g. evaluation runs.
+
+    The questions are encoded together, searched in one multi-search and answered by concurrent generation calls.
+    The request body takes `questions` (a list), and optionally `top_n`, `generate` (default true), a metadata
+    `filter`, the `nprobe`/`num_candidates` knobs and `timings`.
+
+    Returns:
+        json: A JSON object with `results`, one entry per question with the same fields as /ask plus the `question`.
     """
-    Saves a file to the UPLOAD_FOLDER directory.
+    payload = request.json
+    questions = payload.get('questions')
+    if not isinstance(questions, list) or not questions or not all(isinstance(q, str) for q in questions):
+        return jsonify({'error': 'Expected a non-empty list of questions'}), 400
+    if len(questions) > MAX_BATCH_QUESTIONS:
+        return jsonify({'error': f'At most {MAX_BATCH_QUESTIONS} questions per request'}), 400
+    try:
+        top_n = int_option(payload, 'top_n', 5, maximum=MAX_TOP_N)
+        nprobe, num_candidates = search_knobs(payload)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        results = list(answer_questions(
+            get_model(), get_search_backend(), questions,
+            top_n=top_n,
+            generate=payload.get('generate', True),
+            concurrency=GENERATION_CONCURRENCY,
+            batch_size=EMBEDDING_BATCH_SIZE,
+            nprobe=nprobe,
+            num_candidates=num_candidates,
+            filters=payload.get('filter') or None,
+            documents=get_document_store()
+        ))
+    except ValueError as e:
+        return jsonify({'error': f'Invalid filter. Error: {str(e)}'}), 400
+
+    response = {'results': results}
+    if payload.get('timings'):
+        response['timings'] = finish_trace()
+    return jsonify(response)
+
+
+def read_upload(file, extension):
+    """
+    Read an uploaded file as text.
     
     Args:
-        file (FileStorage): The file to save.
+        file (FileStorage): The uploaded file.
         extension (str): Expected file extension.
     
     Returns:
-        str: Path to the saved file or None if the file type is incorrect.
+        str: The content of the file, or None if the file type is incorrect.
     """
     if not file.filename.endswith(extension):
         return None
-    
-    filename = secure_filename(file.filename)
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(filepath)
-    return filepath
+    return file.read().decode('utf-8', errors='replace')
+
+
+def upload_document_id(filename):
+    """Return the document id of an uploaded .txt file: its safe name without the `_Technical.txt` or `.txt` suffix."""
+    filename = secure_filename(filename) or 'upload.txt'
+    for suffix in ('_Technical.txt', '.txt'):
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)] or 'upload'
+    return filename
+
 
 @app.route('/upload', methods=['POST'])
 def upload_and_query():
     """
-    API endpoint to upload text and JSON files, and retrieve answers for a given question.
+    API endpoint to upload a text and a JSON file into a new session, and optionally answer a question about them.
+
+    The document is chunked and embedded once into an in-memory index owned by the session; follow-up questions
+    are sent to /ask or /ask_stream with the returned `session_id`, or to /upload with `session_id` and no files,
+    and only cost a retrieval.
     
     Returns:
-        json: A JSON object containing the top relevant answers, metadata, and AI-generated answer.
+        json: A JSON object containing the `session_id` and, if a question was asked, the top relevant answers,
+        metadata, and AI-generated answer.
     """
-    # Extract the user question and files from the request
+    # Extract the user question, files and session from the request
     question = request.form.get('question', '')
+    session_id = request.form.get('session_id', '')
     txt_file = request.files.get('txt_file', None)
     json_file = request.files.get('json_file', None)
 
-    # Validate the presence of both files and the question
-    if not txt_file or not json_file or not question:
-        return jsonify({'error': 'Both .txt and .json files along with a query are required'}), 400
-    
-    # Save the files to the UPLOAD_FOLDER
-    txt_filepath = save_file(txt_file, '.txt')
-    json_filepath = save_file(json_file, '.json')
+    if txt_file or json_file:
+        # Validate the presence of both files
+        if not txt_file or not json_file:
+            return jsonify({'error': 'Both .txt and .json files are required'}), 400
 
-    # Validate the saved files
-    if not txt_filepath or not json_filepath:
-        return jsonify({'error': 'Invalid file types. Please provide a .txt and a .json file'}), 400
-    
-    # Process and index the data to Elasticsearch
-    process_folder(UPLOAD_FOLDER, "../docs")
-    generate_embeddings_and_save("../docs/passage_metadata.csv", "../docs/passage_metadata_emb.csv")
-    index_data_to_elasticsearch(es, "../docs/passage_metadata_emb.csv", index_name="temp" )
-    
-    # Convert the question into an embedding
-    question_embedding = model.encode(question)  
+        text = read_upload(txt_file, '.txt')
+        metadata = read_upload(json_file, '.json')
+        if text is None or metadata is None:
+            return jsonify({'error': 'Invalid file types. Please provide a .txt and a .json file'}), 400
+
+        # Chunk and embed the document once into the index of a new session
+        try:
+            index = build_session_index(get_model(), [(upload_document_id(txt_file.filename), text, metadata)],
+                                        batch_size=EMBEDDING_BATCH_SIZE)
+            session_id = sessions.add(index)
+        except ValueError as e:
+            return jsonify({'error': f'Could not index the uploaded files. Error: {str(e)}'}), 400
+    elif not session_id:
+        return jsonify({'error': 'Both .txt and .json files, or a session_id, are required'}), 400
 
-    # Search for relevant passages using the provided functions
-    search_results = search_similar_passages(es, "temp", question_embedding)
+    if not question:
+        return jsonify({'session_id': session_id})
+
+    try:
+        question, search_results = retrieve({'question': question, 'session_id': session_id})
+    except KeyError:
+        return jsonify({'error': 'Unknown or expired session, upload the files again'}), 404
 
     # Extract the top passages and their metadata from the search results
     passages = [hit["_source"]["Passage"] for hit in search_results]
@@ -125,29 +538,90 @@ def upload_and_query():
     metadata = [hit["_source"]["Metadata"] for hit in search_results]
 
     # Generate AI-enhanced answer
-    gen_ai_output = generate_direct_answer_with_palm(search_results, question, save_csv=False)
+    gen_ai_output, context = answer_hits(search_results, question)
 
-    return jsonify({'answer': passages, 'relevance_socres': scores, 'metadata': metadata, 'gen_ai_output': gen_ai_output})
+    response = {'session_id': session_id, 'answer': passages, 'relevance_socres': scores, 'metadata': metadata,
+                'gen_ai_output': gen_ai_output}
+    if request.form.get('timings', '').lower() in ('1', 'true'):
+        response['timings'] = finish_trace()
+        response['prompt_tokens'] = context.prompt_tokens
+    return jsonify(response)
+
+
+@app.route('/session/<session_id>', methods=['DELETE'])
+def end_session(session_id):
+    """
+    API endpoint to end an upload session and free its index.
+
+    Returns:
+        json: A JSON object indicating success, or 404 if the session is unknown or expired.
+    """
+    if not sessions.delete(session_id):
+        return jsonify({'error': 'Unknown or expired session'}), 404
+    return jsonify({'success': 'Session ended'})
 
 
 @app.route('/reset_index', methods=['POST'])
 def reset_index():
     """
-    API endpoint to reset the Elasticsearch index.
+    API endpoint to discard the documents uploaded so far, by ending every upload session.
+
+    Returns:
+        json: A JSON object with the number of sessions ended.
+    """
+    ended = sessions.clear()
+    return jsonify({'success': 'Index reset successfully', 'sessions_ended': ended}), 200
+
+@app.route('/cache_stats', methods=['GET'])
+def get_cache_stats():
+    """
+    API endpoint to inspect the query-embedding, retrieval and answer caches.
     
     Returns:
-        json: A JSON object indicating success or failure.
+        json: Size, hit, miss, eviction and expiration counters of every cache tier.
     """
-    try:
-        # Delete and recreate the Elasticsearch index
-        if es.indices.exists(index='temp'):
-            es.indices.delete(index='temp')
-        
-        create_index(es, "temp")
-        
-        return jsonify({'success': 'Index reset successfully'}), 200
-    except Exception as e:
-        return jsonify({'error': f'Failed to reset index. Error: {str(e)}'}), 500
+    stats = cache_stats()
+    answer_stats = answer_cache_stats()
+    if answer_stats is not None:
+        stats["answer"] = answer_stats
+    if isinstance(question_encoder, MicroBatcher):
+        stats["micro_batcher"] = question_encoder.stats()
+    stats["sessions"] = sessions.stats()
+    return jsonify(stats)
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """
+    Liveness probe: the process is up and serving HTTP.
+    
+    Returns:
+        json: {"status": "ok"}.
+    """
+    return jsonify({'status': 'ok'})
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+    Readiness probe: the model is loaded and warm and the search backend answered, so traffic can be routed here.
+    
+    Returns:
+        json: The startup timeline, with status 200 once ready and 503 before.
+    """
+    timeline = {key: value for key, value in startup.items() if key != "started_at"}
+    if startup["ready"] is None:
+        return jsonify(dict(timeline, status='warming up')), 503
+    return jsonify(dict(timeline, status='ready'))
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    API endpoint exposing stage latencies, request latencies, processing counters and cache gauges.
+    
+    Returns:
+        Response: The metrics in the Prometheus text exposition format.
+    """
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == "__main__":
+    start_warm_up()
     app.run(host='0.0.0.0', debug=True)
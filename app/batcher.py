@@ -0,0 +1,79 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Dynamic micro-batcher in front of an embedding model.
+
+    Concurrent callers submit single texts; a background thread gathers them for up to
+    `max_wait_ms` milliseconds or `max_batch_size` texts, whichever comes first, and encodes
+    them in one forward pass. Under light load a text waits at most `max_wait_ms`; under heavy
+    load batches fill up immediately and the model runs at a far better batch size than one.
+    """
+
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5):
+        """
+        Args:
+            model (SentenceTransformer): The model used for generating embeddings.
+            max_batch_size (int, optional): Maximum number of texts per forward pass. Defaults to 32.
+            max_wait_ms (float, optional): Longest time the first text of a batch waits for others. Defaults to 5.
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.items = 0
+        self._requests = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._worker.start()
+
+    def encode(self, text):
+        """
+        Encode one text, batched together with concurrent calls.
+
+        Args:
+            text (str): The text to encode.
+
+        Returns:
+            np.ndarray: The embedding of the text.
+        """
+        future = Future()
+        self._requests.put((text, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = self.model.encode(texts, batch_size=len(texts))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.items += len(batch)
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
+    def stats(self):
+        """Return the number of batches run and the mean batch size."""
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0
+        }
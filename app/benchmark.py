@@ -0,0 +1,419 @@
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import hashlib
+import platform
+import resource
+import tempfile
+import subprocess
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+import numpy as np
+from model import EMBEDDING_BACKENDS, MODEL_NAME, encode_passages, load_model
+from documents import DocumentStore
+from parsing import document_id, list_documents, parse_chunks, process_folder
+from indexing import index_passages
+from local_search import LocalSearchEngine
+from retrieval import search_similar_passages
+
+STAGES = ["parse", "embed", "index", "search", "ask"]
+
+COURTS = ["SUPREME COURT", "COURT OF APPEAL", "HIGH COURT", "CIRCUIT COURT", "DISTRICT COURT"]
+CASE_TYPES = ["CIVIL APPEAL", "CRIMINAL APPEAL", "SUIT", "MOTION", "PETITION"]
+TOPICS = [
+    ("contract", ["offer", "acceptance", "consideration", "breach", "specific performance", "damages"]),
+    ("land", ["title", "possession", "lease", "boundary", "customary grant", "trespass"]),
+    ("criminal", ["confession", "intent", "sentence", "bail", "identification", "alibi"]),
+    ("employment", ["dismissal", "wages", "redundancy", "notice", "misconduct", "gratuity"]),
+    ("family", ["custody", "maintenance", "marriage", "divorce", "succession", "intestacy"]),
+    ("company", ["shares", "directors", "winding up", "debenture", "shareholder", "receivership"]),
+]
+TEMPLATES = [
+    "The court considered whether the {a} of {party} amounted to {b}",
+    "Counsel for {party} argued that the {a} was not established on the evidence",
+    "It was held that {party} could rely on the {b} in the circumstances",
+    "The trial judge erred in treating the {a} as conclusive of the {b}",
+    "On the question of {a}, the evidence of {party} was not contradicted",
+    "The principles governing {a} and {b} were restated with reference to earlier authority",
+    "There was no basis for setting aside the findings on {b} in favour of {party}",
+]
+SYLLABLES = ["ka", "wa", "me", "ne", "so", "ta", "bo", "an", "ku", "fi", "ye", "da", "mo", "ri", "la", "se"]
+
+
+def _name(rng, words=2):
+    """Return a pseudo-random proper name."""
+    return " ".join("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize() for _ in range(words))
+
+
+def generate_corpus(folder_path, n_docs=100, paragraphs_per_doc=8, queries_per_doc=1, seed=0):
+    """
+    Generate a synthetic corpus of `_Technical.txt`/`_Metadata.json` pairs and a labelled query set.
+
+    Every document is about one topic and names its own parties, and every query mentions the parties
+    and topic terms of one document, so retrieval accuracy can be measured against known answers.
+
+    Args:
+        folder_path (str): Folder to write the documents to. It is created if needed.
+        n_docs (int, optional): Number of documents. Defaults to 100.
+        paragraphs_per_doc (int, optional): Number of paragraphs per document. Defaults to 8.
+        queries_per_doc (int, optional): Number of labelled queries per document. Defaults to 1.
+        seed (int, optional): Random seed; the same seed always produces the same corpus. Defaults to 0.
+
+    Returns:
+        list: Labelled queries as {"question", "DocId"} dicts.
+    """
+    rng = random.Random(seed)
+    os.makedirs(folder_path, exist_ok=True)
+    queries = []
+
+    for doc in range(n_docs):
+        topic, terms = TOPICS[doc % len(TOPICS)]
+        plaintiff, defendant = _name(rng), _name(rng, 3)
+        doc_id = f"{doc:06d}"
+        date = datetime(2000 + rng.randint(0, 23), rng.randint(1, 12), rng.randint(1, 28), tzinfo=timezone.utc)
+
+        paragraphs = []
+        for _ in range(paragraphs_per_doc):
+            sentences = [
+                rng.choice(TEMPLATES).format(a=rng.choice(terms), b=rng.choice(terms), party=rng.choice([plaintiff, defendant]))
+                for _ in range(rng.randint(3, 7))
+            ]
+            paragraphs.append(". ".join(sentences) + ".")
+        content = "__section__ JUDGMENT " + " ".join(f"__paragraph__ {p}" for p in paragraphs)
+
+        metadata = {
+            "caseId": {"number": f"J{doc}/{date.year}", "type": rng.choice(CASE_TYPES)},
+            "court": {"name": rng.choice(COURTS)},
+            "judgement": {"date": date.strftime("%Y-%m-%dT00:00:00.000Z"), "year": date.year},
+            "judges": [_name(rng) for _ in range(rng.randint(1, 3))],
+            "mediaNeutralCitation": f"[{date.year}] GHASC {doc}",
+            "presidingJudge": _name(rng),
+            "source": "synthetic",
+            "title": {"long": f"{plaintiff} VRS {defendant}", "short": f"{plaintiff} vs {defendant}"},
+        }
+
+        with open(os.path.join(folder_path, f"{doc_id}_Technical.txt"), "w", encoding="utf-8") as f:
+            f.write(content)
+        with open(os.path.join(folder_path, f"{doc_id}_Metadata.json"), "w", encoding="utf-8") as f:
+            json.dump(metadata, f)
+
+        for _ in range(queries_per_doc):
+            queries.append({
+                "question": f"What did the court decide about the {rng.choice(terms)} of {plaintiff} against {defendant}?",
+                "DocId": doc_id
+            })
+
+    return queries
+
+
+class HashingEncoder:
+    """
+    A deterministic bag-of-words stand-in for the SentenceTransformer model.
+
+    Words are hashed into a fixed number of dimensions, so retrieval can be benchmarked without
+    downloading a model; its accuracy says nothing about the real model.
+    """
+
+    def __init__(self, dims=768):
+        self.dims = dims
+
+    def get_sentence_embedding_dimension(self):
+        return self.dims
+
+    def encode(self, texts, batch_size=32, convert_to_numpy=True, **kwargs):
+        single = isinstance(texts, str)
+        embeddings = np.zeros((1 if single else len(texts), self.dims), dtype=np.float32)
+        for row, text in enumerate([texts] if single else texts):
+            for word in text.lower().split():
+                digest = hashlib.md5(word.strip(".,?").encode("utf-8")).digest()
+                embeddings[row, int.from_bytes(digest[:4], "little") % self.dims] += 1.0 if digest[4] & 1 else -1.0
+        return embeddings[0] if single else embeddings
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process so far, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def latency_stats(latencies):
+    """Return count, mean, p50/p95/p99 (in ms) and throughput of a list of per-call latencies in seconds."""
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        "count": len(latencies),
+        "mean_ms": float(latencies_ms.mean()),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "throughput_per_s": len(latencies) / max(float(latencies_ms.sum()) / 1000, 1e-9)
+    }
+
+
+def accuracy(hits_per_query, queries, ks=(1, 3, 5)):
+    """Return the fraction of queries with a passage of the labelled document in their top k hits, for each k."""
+    return {
+        f"top_{k}_accuracy": float(np.mean([
+            any(hit["_source"].get("DocId") == query["DocId"] for hit in hits[:k])
+            for hits, query in zip(hits_per_query, queries)
+        ]))
+        for k in ks
+    }
+
+
+def git_commit():
+    """Return the commit the benchmark runs on, or None outside a git checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(model, corpus_dir, queries, work_dir, stages=STAGES, batch_size=64, top_n=5, index_name="passage_metadata_emb"):
+    """
+    Time every stage from parsing to a full /ask request on one corpus.
+
+    Retrieval runs against a local search engine in `work_dir` and /ask runs through the Flask app with
+    the local stand-in generator, so no Elasticsearch cluster or PaLM key is needed. Peak RSS is recorded after
+    each stage and is cumulative, since the process high-water mark never goes down.
+
+    Args:
+        model (SentenceTransformer or HashingEncoder): The model used for generating embeddings.
+        corpus_dir (str): Folder of `_Technical.txt`/`_Metadata.json` pairs.
+        queries (list): Labelled queries as {"question", "DocId"} dicts.
+        work_dir (str): Scratch folder for the parsed CSV and the local index.
+        stages (list, optional): The stages to run, a subset of `STAGES` in order. Defaults to all.
+        batch_size (int, optional): Number of passages per forward pass. Defaults to 64.
+        top_n (int, optional): Number of hits retrieved per query. Defaults to 5.
+        index_name (str, optional): The local index to build. Defaults to "passage_metadata_emb".
+
+    Returns:
+        dict: Per-stage results.
+    """
+    results = {}
+    txt_files = list_documents(corpus_dir)
+    engine = LocalSearchEngine(os.path.join(work_dir, "local_index"))
+    documents = DocumentStore(os.path.join(work_dir, "documents.sqlite"))
+
+    start = time.perf_counter()
+    if "parse" in stages:
+        process_folder(corpus_dir, work_dir)
+    sources = []
+    for txt_file in txt_files:
+        document_sources, metadata = parse_chunks(corpus_dir, txt_file)
+        documents.put(document_id(txt_file), metadata)
+        sources.extend(document_sources)
+    elapsed = time.perf_counter() - start
+    if "parse" in stages:
+        results["parse"] = {"documents": len(txt_files), "passages": len(sources), "seconds": elapsed,
+                            "documents_per_s": len(txt_files) / max(elapsed, 1e-9), "peak_rss_mb": peak_rss_mb()}
+
+    # Later stages depend on the output of earlier ones, which are then run without being reported
+    needs_index = any(stage in stages for stage in ("index", "search", "ask"))
+    if needs_index or "embed" in stages:
+        start = time.perf_counter()
+        embeddings = encode_passages(model, [source["Passage"] for source in sources], batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        if "embed" in stages:
+            results["embed"] = {"passages": len(sources), "seconds": elapsed,
+                                "passages_per_s": len(sources) / max(elapsed, 1e-9), "peak_rss_mb": peak_rss_mb()}
+
+    if needs_index:
+        engine.delete(index_name)
+        start = time.perf_counter()
+        for offset in range(0, len(sources), 1000):
+            index_passages(engine, sources[offset:offset + 1000], embeddings[offset:offset + 1000], index_name)
+        elapsed = time.perf_counter() - start
+        if "index" in stages:
+            results["index"] = {"passages": len(sources), "seconds": elapsed,
+                                "passages_per_s": len(sources) / max(elapsed, 1e-9), "peak_rss_mb": peak_rss_mb()}
+
+    if "search" in stages:
+        query_embeddings = model.encode([query["question"] for query in queries], batch_size=batch_size)
+        latencies, hits_per_query = [], []
+        for query_embedding in query_embeddings:
+            start = time.perf_counter()
+            hits_per_query.append(search_similar_passages(engine, index_name, query_embedding, top_n))
+            latencies.append(time.perf_counter() - start)
+        results["search"] = dict(latency_stats(latencies), **accuracy(hits_per_query, queries), peak_rss_mb=peak_rss_mb())
+
+    if "ask" in stages:
+        results["ask"] = dict(benchmark_ask(model, engine, queries, documents), peak_rss_mb=peak_rss_mb())
+
+    return results
+
+
+def benchmark_ask(model, engine, queries, documents=None):
+    """
+    Time full /ask requests through the Flask app, with `engine` as the search backend, `documents` as the
+    document table and the local stand-in generator, also reporting the mean prompt tokens.
+
+    Caches are cleared first and every query is sent once, so no request is served from a cache.
+    This relies on `app` loading its model, search backend and document table on first use: importing it
+    loads no model, and the ones set below are used instead.
+    """
+    import app as server
+    import gen_ai
+    from gen_ai import LocalGenerator
+    from cache import query_embedding_cache, retrieval_cache, semantic_cache
+
+    # Keep the app from opening the answer cache; its backend and encoder are replaced below
+    gen_ai.ANSWER_CACHE_PATH = ""
+
+    server.es = engine
+    server.documents = documents or DocumentStore(":memory:")
+    server.question_encoder = model
+    gen_ai.generator = LocalGenerator()
+    query_embedding_cache.invalidate()
+    retrieval_cache.invalidate()
+
+    client = server.app.test_client()
+    latencies, prompt_tokens = [], []
+    for query in queries:
+        # Similar queries would otherwise be answered by the semantic cache
+        semantic_cache.invalidate()
+        start = time.perf_counter()
+        response = client.post("/ask", json={"question": query["question"], "timings": True})
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(f"/ask failed with status {response.status_code}: {response.get_data(as_text=True)}")
+        prompt_tokens.append(response.get_json()["prompt_tokens"])
+    return dict(latency_stats(latencies), prompt_tokens_mean=float(np.mean(prompt_tokens)) if prompt_tokens else 0.0)
+
+
+def benchmark_startup(index_dir, question, port=5077, timeout=600):
+    """
+    Start `serve.py` in a fresh process and measure how long it takes to listen, to be ready, and to answer.
+
+    The server uses the local index in `index_dir` and the real embedding model. Times are wall-clock
+    seconds from spawning the process; the first request is sent as soon as /ready succeeds and is timed
+    to the arrival of its retrieved passages on /ask_stream, so no PaLM call is needed.
+
+    Returns:
+        dict: `time_to_listening_s`, `time_to_ready_s`, `time_to_first_request_s`, `first_request_ms`,
+        and the startup timeline reported by the server itself.
+    """
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, SEARCH_BACKEND="local", LOCAL_INDEX_DIR=index_dir, PORT=str(port), ANSWER_CACHE_PATH="")
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "serve.py"], cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def wait_for(path):
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"serve.py exited with status {process.returncode}")
+            try:
+                with urllib.request.urlopen(base_url + path, timeout=1) as response:
+                    return json.load(response)
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        raise TimeoutError(f"{path} did not succeed within {timeout}s")
+
+    try:
+        wait_for("/healthz")
+        results = {"time_to_listening_s": time.perf_counter() - start}
+        timeline = wait_for("/ready")
+        results["time_to_ready_s"] = time.perf_counter() - start
+
+        request_start = time.perf_counter()
+        body = json.dumps({"question": question}).encode("utf-8")
+        request = urllib.request.Request(base_url + "/ask_stream", data=body, headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.readline()
+            results["first_request_ms"] = (time.perf_counter() - request_start) * 1000
+            results["time_to_first_request_s"] = time.perf_counter() - start
+            response.read()
+        results["server_timeline"] = timeline
+        return results
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def compare(previous, current):
+    """Print the change of the headline metrics of every stage between two benchmark results."""
+    metrics = ["time_to_listening_s", "time_to_ready_s", "first_request_ms", "seconds", "documents_per_s", "passages_per_s", "p50_ms", "p95_ms", "p99_ms",
+               "throughput_per_s", "top_1_accuracy", "top_3_accuracy", "peak_rss_mb"]
+    print(f"{'stage':>8} {'metric':>18} {'previous':>12} {'current':>12} {'change':>8}")
+    for stage, results in current["stages"].items():
+        for metric in metrics:
+            if metric in results and metric in previous["stages"].get(stage, {}):
+                old, new = previous["stages"][stage][metric], results[metric]
+                change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+                print(f"{stage:>8} {metric:>18} {old:>12.3f} {new:>12.3f} {change:>8}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark parsing, embedding, indexing, search and /ask on a synthetic corpus.")
+    parser.add_argument("--docs", type=int, default=200, help="Number of synthetic documents")
+    parser.add_argument("--paragraphs", type=int, default=8, help="Paragraphs per synthetic document")
+    parser.add_argument("--corpus", help="Benchmark an existing corpus folder instead of a synthetic one; needs --queries")
+    parser.add_argument("--queries", help="JSONL file of labelled {\"question\", \"DocId\"} queries")
+    parser.add_argument("--model", default=MODEL_NAME,
+                        help="SentenceTransformer model name, or 'hashing' for a deterministic stand-in")
+    parser.add_argument("--backend", choices=EMBEDDING_BACKENDS, default="torch", help="Inference backend of the embedding model")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--top-n", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Path of the JSON results. Defaults to ../docs/benchmarks/<timestamp>.json")
+    parser.add_argument("--compare", help="A previous JSON result to compare this run against")
+    parser.add_argument("--startup", action="store_true",
+                        help="Also measure time to listening, to ready and to the first request of serve.py on the benchmark index "
+                             "(needs one of the index, search or ask stages)")
+    args = parser.parse_args()
+
+    if args.model == "hashing":
+        model = HashingEncoder()
+    else:
+        model = load_model(args.model, backend=args.backend)
+
+    work_dir = tempfile.mkdtemp(prefix="queryquill-bench-")
+    try:
+        if args.corpus:
+            corpus_dir = args.corpus
+            with open(args.queries, encoding="utf-8") as f:
+                queries = [json.loads(line) for line in f if line.strip()]
+        else:
+            corpus_dir = os.path.join(work_dir, "corpus")
+            queries = generate_corpus(corpus_dir, args.docs, args.paragraphs, seed=args.seed)
+
+        stages = run_benchmark(model, corpus_dir, queries, work_dir, args.stages, args.batch_size, args.top_n)
+        if args.startup:
+            stages["startup"] = benchmark_startup(os.path.join(work_dir, "local_index"), queries[0]["question"])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    timestamp = datetime.now(timezone.utc)
+    result = {
+        "commit": git_commit(),
+        "timestamp": timestamp.isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "config": {
+            "corpus": args.corpus or "synthetic", "docs": len(list_documents(args.corpus)) if args.corpus else args.docs,
+            "paragraphs": args.paragraphs, "queries": len(queries), "model": args.model, "backend": args.backend,
+            "batch_size": args.batch_size, "top_n": args.top_n, "seed": args.seed
+        },
+        "stages": stages
+    }
+
+    output = args.output or os.path.join("../docs/benchmarks", timestamp.strftime("%Y%m%dT%H%M%SZ") + ".json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+
+    print(json.dumps(stages, indent=2))
+    print(f"Successfully wrote benchmark results to {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), result)
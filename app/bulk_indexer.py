@@ -0,0 +1,271 @@
+import json
+import time
+import random
+import threading
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from elasticsearch import ConnectionError as ESConnectionError, ConnectionTimeout
+
+# Bulk item and response statuses worth retrying: rejected by a full write queue, or a node briefly unavailable
+RETRYABLE_STATUSES = {429, 502, 503, 504}
+
+
+def _status_of(error):
+    """Return the HTTP status of an Elasticsearch client error, for both the 7.x and 8.x+ clients."""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "meta", None), "status", None)
+    return status if isinstance(status, int) else None
+
+
+@contextmanager
+def tuned_for_bulk_load(es_instance, index_name):
+    """
+    Turn refresh and replicas off for the duration of a bulk load, restoring the previous settings afterwards.
+
+    Segments are not refreshed and documents are not copied to replicas while loading, which is the
+    bulk of the indexing overhead; the index is refreshed once at the end.
+
+    Args:
+        es_instance (Elasticsearch): The Elasticsearch connection object.
+        index_name (str): The index being loaded.
+    """
+    settings = es_instance.indices.get_settings(index=index_name)[index_name]["settings"]["index"]
+    previous = {
+        "refresh_interval": settings.get("refresh_interval"),
+        "number_of_replicas": settings.get("number_of_replicas")
+    }
+    es_instance.indices.put_settings(index=index_name, settings={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+    try:
+        yield
+    finally:
+        # A setting that was never set explicitly is reset to the cluster default by putting null
+        es_instance.indices.put_settings(index=index_name, settings={"index": previous})
+        es_instance.indices.refresh(index=index_name)
+
+
+class BulkIndexer:
+    """
+    Parallel, streaming bulk loader for Elasticsearch.
+
+    Documents are consumed lazily from an iterable, serialized once, cut into chunks bounded both in
+    documents and in bytes, and sent by a pool of worker threads with a bounded number of chunks in
+    flight, so memory use does not depend on the size of the load. Rejected documents (429) and
+    chunks that fail with a transient error are retried with exponential backoff and jitter; a chunk
+    that still fails after `max_retries` attempts is counted as failed instead of aborting the load.
+    """
+
+    def __init__(self, es_instance, index_name, workers=4, chunk_docs=500, chunk_bytes=10 * 1024 * 1024,
+                 max_retries=5, initial_backoff=0.5, max_backoff=30.0, progress_interval=5.0):
+        """
+        Args:
+            es_instance (Elasticsearch): The Elasticsearch connection object.
+            index_name (str): The index to load into.
+            workers (int, optional): Number of concurrent bulk requests. Defaults to 4.
+            chunk_docs (int, optional): Maximum number of documents per bulk request. Defaults to 500.
+            chunk_bytes (int, optional): Maximum size of a bulk request body in bytes. Defaults to 10 MiB.
+            max_retries (int, optional): Retries of a chunk or of its rejected documents. Defaults to 5.
+            initial_backoff (float, optional): Seconds to wait before the first retry; doubled on every retry. Defaults to 0.5.
+            max_backoff (float, optional): Longest wait between retries in seconds. Defaults to 30.
+            progress_interval (float, optional): Seconds between progress reports; 0 disables them. Defaults to 5.
+        """
+        self.es_instance = es_instance
+        self.index_name = index_name
+        self.workers = workers
+        self.chunk_docs = chunk_docs
+        self.chunk_bytes = chunk_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.progress_interval = progress_interval
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.indexed = 0
+        self.failed = 0
+        self.retries = 0
+        self.errors = []
+
+    def _chunks(self, sources):
+        """Serialize sources into chunks of bulk NDJSON lines bounded by `chunk_docs` and `chunk_bytes`."""
+        action = json.dumps({"index": {"_index": self.index_name}})
+        lines, size = [], 0
+        for source in sources:
+            document = json.dumps(source)
+            document_size = len(action) + len(document.encode("utf-8")) + 2
+            if lines and (len(lines) // 2 >= self.chunk_docs or size + document_size > self.chunk_bytes):
+                yield lines
+                lines, size = [], 0
+            lines.extend((action, document))
+            size += document_size
+        if lines:
+            yield lines
+
+    def _backoff(self, attempt):
+        delay = min(self.max_backoff, self.initial_backoff * 2 ** attempt)
+        time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def _send(self, lines):
+        """Send one chunk, retrying transient failures and rejected documents."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.es_instance.bulk(operations=lines, refresh=False)
+            except (ESConnectionError, ConnectionTimeout) as e:
+                error, retry_lines = e, lines
+            except Exception as e:
+                if _status_of(e) not in RETRYABLE_STATUSES:
+                    raise
+                error, retry_lines = e, lines
+            else:
+                if not response["errors"]:
+                    self._count(indexed=len(lines) // 2)
+                    return
+
+                # Keep the documents that were rejected for retry; other item errors are permanent
+                retry_lines, indexed, failed = [], 0, 0
+                for i, item in enumerate(response["items"]):
+                    result = next(iter(item.values()))
+                    status = result.get("status", 500)
+                    if status < 300:
+                        indexed += 1
+                    elif status in RETRYABLE_STATUSES:
+                        retry_lines.extend(lines[2 * i:2 * i + 2])
+                    else:
+                        failed += 1
+                        self._record_error(result.get("error"))
+                self._count(indexed=indexed, failed=failed)
+                if not retry_lines:
+                    return
+                error = f"{len(retry_lines) // 2} documents rejected"
+
+            if attempt == self.max_retries:
+                self._record_error(str(error))
+                self._count(failed=len(retry_lines) // 2)
+                return
+            with self._lock:
+                self.retries += 1
+            lines = retry_lines
+            self._backoff(attempt)
+
+    def _count(self, indexed=0, failed=0):
+        with self._lock:
+            self.indexed += indexed
+            self.failed += failed
+
+    def _record_error(self, error):
+        with self._lock:
+            # Keep a sample of errors for the summary rather than every one
+            if len(self.errors) < 10:
+                self.errors.append(error)
+
+    def _report(self, start, final=False):
+        elapsed = time.perf_counter() - start
+        label = "Indexed" if final else "Indexing:"
+        print(f"{label} {self.indexed} documents into {self.index_name} in {elapsed:.1f}s "
+              f"({self.indexed / max(elapsed, 1e-9):.0f} docs/s, {self.failed} failed, {self.retries} retries)")
+
+    def index(self, sources):
+        """
+        Index documents.
+
+        Args:
+            sources (iterable): Document sources (dicts), consumed lazily.
+
+        Returns:
+            dict: Number of documents `indexed` and `failed`, chunk `retries`, the wall time in `seconds`,
+            `docs_per_s`, and a sample of `errors`.
+        """
+        self._reset()
+        start = last_report = time.perf_counter()
+        pending = set()
+
+        def collect(done):
+            for future in done:
+                # Re-raise errors that are not worth retrying, e.g. authentication failures
+                future.result()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for lines in self._chunks(sources):
+                # Bound the chunks in flight so a fast producer cannot buffer the whole load
+                while len(pending) >= 2 * self.workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(self._send, lines))
+
+                if self.progress_interval and time.perf_counter() - last_report >= self.progress_interval:
+                    self._report(start)
+                    last_report = time.perf_counter()
+
+            done, _ = wait(pending)
+            collect(done)
+
+        elapsed = time.perf_counter() - start
+        self._report(start, final=True)
+        return {
+            "indexed": self.indexed,
+            "failed": self.failed,
+            "retries": self.retries,
+            "seconds": elapsed,
+            "docs_per_s": self.indexed / max(elapsed, 1e-9),
+            "errors": list(self.errors)
+        }
+
+
+def bulk_index(es_instance, index_name, sources, tune_settings=True, **options):
+    """
+    Bulk load documents into an Elasticsearch index with a `BulkIndexer`.
+
+    Args:
+        es_instance (Elasticsearch): The Elasticsearch connection object.
+        index_name (str): The index to load into. It must exist.
+        sources (iterable): Document sources (dicts), consumed lazily.
+        tune_settings (bool, optional): Turn refresh and replicas off during the load (see `tuned_for_bulk_load`). Defaults to True.
+        **options: Options of `BulkIndexer`, e.g. `workers`, `chunk_docs` or `chunk_bytes`.
+
+    Returns:
+        dict: The summary returned by `BulkIndexer.index`.
+    """
+    indexer = BulkIndexer(es_instance, index_name, **options)
+    if not tune_settings:
+        return indexer.index(sources)
+    with tuned_for_bulk_load(es_instance, index_name):
+        return indexer.index(sources)
+
+
+if __name__ == "__main__":
+    import os
+    import argparse
+    from elasticsearch import Elasticsearch
+    from indexing import connect_instance, index_data_to_elasticsearch, recreate_index
+    from projection import embedding_dims
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Reindex an embedding store or CSV into Elasticsearch with the parallel bulk indexer.")
+    parser.add_argument("data_path", nargs="?", default="../docs/passage_metadata_emb", help="Embedding store folder or CSV file")
+    parser.add_argument("--index-name", default="passage_metadata_emb")
+    parser.add_argument("--url", help="Elasticsearch URL, e.g. that of es_stand_in.py. Defaults to ES_HOST/ES_PORT")
+    parser.add_argument("--recreate", action="store_true", help="Delete and recreate the index first")
+    parser.add_argument("--knn", action="store_true", default=os.getenv("ES_KNN", "false").lower() == "true")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--chunk-docs", type=int, default=500)
+    parser.add_argument("--chunk-mb", type=float, default=10)
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--no-tune", action="store_true", help="Leave refresh and replicas on during the load")
+    parser.add_argument("--dims", type=int, default=None, help="Embedding dimension of a recreated index. Defaults to that of PROJECTION_PATH or the model")
+    args = parser.parse_args()
+
+    if args.url:
+        es = Elasticsearch(args.url, request_timeout=120)
+    else:
+        es = connect_instance(os.getenv("ES_HOST"), int(os.getenv("ES_PORT")), os.getenv("ES_USERNAME"), os.getenv("ES_PASSWORD"))
+    if args.recreate:
+        recreate_index(es, args.index_name, knn=args.knn, quantization=os.getenv("QUANTIZATION") or None,
+                       dims=args.dims or embedding_dims())
+
+    summary = index_data_to_elasticsearch(es, args.data_path, args.index_name, workers=args.workers, chunk_docs=args.chunk_docs,
+                                          chunk_bytes=int(args.chunk_mb * 1024 * 1024), max_retries=args.max_retries,
+                                          tune_settings=not args.no_tune)
+    print(json.dumps(summary, indent=2))
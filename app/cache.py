@@ -0,0 +1,474 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from metrics import SEMANTIC_CACHE_SIMILARITY, span
+from retrieval import search_similar_passages, search_similar_passages_batch
+from vectors import normalize_vector
+
+
+class LRUCache:
+    """
+    A thread-safe, size-bounded LRU cache whose entries expire after a time-to-live.
+
+    Hit, miss, eviction and expiration counters are kept so the cache can be sized from
+    production traffic.
+    """
+
+    def __init__(self, max_size=1024, ttl=3600):
+        """
+        Args:
+            max_size (int, optional): Maximum number of entries. Defaults to 1024.
+            ttl (float, optional): Seconds an entry stays valid; 0 disables expiry. Defaults to 3600.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """Return the value cached under `key`, or `default` if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires_at = entry
+            if expires_at and expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Cache `value` under `key`, evicting the least recently used entries beyond `max_size`."""
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            expires_at = time.monotonic() + self.ttl if self.ttl else 0
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, predicate=None):
+        """
+        Drop entries from the cache.
+
+        Args:
+            predicate (callable, optional): Called with each key; matching entries are dropped.
+                Defaults to None, which drops every entry.
+
+        Returns:
+            int: The number of entries dropped.
+        """
+        with self._lock:
+            keys = [key for key in self._entries if predicate is None or predicate(key)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def stats(self):
+        """Return the size of the cache and its counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+class SemanticCache:
+    """
+    A thread-safe cache of answered questions looked up by embedding similarity rather than by exact key.
+
+    Each entry holds the normalized question embedding, the hits and the generated answer of a question
+    asked against an index with given search options (its scope). A question whose embedding has a cosine
+    similarity of at least `threshold` with a cached question of the same scope is served the cached hits
+    and answer, so paraphrases of a recent question skip both retrieval and generation. Embeddings are kept
+    in one preallocated matrix with the scope and expiry of every slot in arrays beside it, so a lookup is
+    one mask and one matrix-vector product over the entries of its scope. Entries expire after a
+    time-to-live, the least recently used entry is evicted when the cache is full, and the entries of an
+    index are dropped when it changes.
+    """
+
+    def __init__(self, max_size=1024, threshold=0.95, ttl=3600):
+        """
+        Args:
+            max_size (int, optional): Maximum number of entries; 0 disables the cache. Defaults to 1024.
+            threshold (float, optional): Minimum cosine similarity of a hit. Defaults to 0.95.
+            ttl (float, optional): Seconds an entry stays valid; 0 disables expiry. Defaults to 3600.
+        """
+        self.max_size = max_size
+        self.threshold = threshold
+        self.ttl = ttl
+        # Per slot: the embedding, the id of the scope (-1 when free), the expiry time and the last use,
+        # so a lookup masks out other scopes and expired entries with array operations
+        self._embeddings = None
+        self._scope_ids = np.full(max(max_size, 0), -1, dtype=np.int64)
+        self._expires_at = np.full(max(max_size, 0), np.inf)
+        self._last_used = np.zeros(max(max_size, 0), dtype=np.int64)
+        self._entries = [None] * max(max_size, 0)
+        self._scopes = {}
+        self._next_scope_id = 0
+        self._clock = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _free(self, slots):
+        self._scope_ids[slots] = -1
+        for slot in slots:
+            self._entries[slot] = None
+
+    def _scope_id(self, scope):
+        """Return the id of a scope, forgetting the ids of scopes without entries once there are too many."""
+        if scope not in self._scopes:
+            if len(self._scopes) >= self.max_size:
+                used = set(np.unique(self._scope_ids).tolist())
+                self._scopes = {key: scope_id for key, scope_id in self._scopes.items() if scope_id in used}
+            self._scopes[scope] = self._next_scope_id
+            self._next_scope_id += 1
+        return self._scopes[scope]
+
+    def _candidates(self, scope):
+        """Return the slots of the live entries of `scope`, dropping its expired entries."""
+        scope_id = self._scopes.get(scope)
+        if scope_id is None:
+            return np.zeros(0, dtype=np.int64)
+        slots = np.flatnonzero(self._scope_ids == scope_id)
+        expired = slots[self._expires_at[slots] < time.monotonic()]
+        if len(expired):
+            self._free(expired)
+            self.expirations += len(expired)
+            slots = np.setdiff1d(slots, expired, assume_unique=True)
+        return slots
+
+    def get(self, scope, embedding):
+        """
+        Return the cached result of the most similar question of a scope, if it is similar enough.
+
+        Args:
+            scope (tuple): The index and search options the question is asked with.
+            embedding (array-like): The question embedding.
+
+        Returns:
+            tuple: (hits, answer, similarity) of the cached question, or None on a miss.
+        """
+        if self.max_size <= 0:
+            return None
+
+        query = normalize_vector(embedding)
+        with self._lock:
+            slots = self._candidates(scope) if self._embeddings is not None else ()
+            if not len(slots):
+                self.misses += 1
+                return None
+
+            scores = self._embeddings[slots] @ query
+            best = int(np.argmax(scores))
+            slot = int(slots[best])
+            similarity = min(float(scores[best]), 1.0)
+            if similarity < self.threshold:
+                self.misses += 1
+                SEMANTIC_CACHE_SIMILARITY.observe(similarity, outcome="miss")
+                return None
+
+            entry = self._entries[slot]
+            self._clock += 1
+            self._last_used[slot] = self._clock
+            self.hits += 1
+        SEMANTIC_CACHE_SIMILARITY.observe(similarity, outcome="hit")
+        return entry["hits"], entry["answer"], similarity
+
+    def put(self, scope, embedding, hits, answer):
+        """
+        Cache the hits and answer of a question, evicting the least recently used entry if the cache is full.
+
+        Args:
+            scope (tuple): The index and search options the question was asked with.
+            embedding (array-like): The question embedding.
+            hits (list): The hits returned for the question.
+            answer (str): The generated answer.
+        """
+        if self.max_size <= 0 or answer is None:
+            return
+
+        query = normalize_vector(embedding)
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = np.zeros((self.max_size, len(query)), dtype=np.float32)
+
+            free = np.flatnonzero(self._scope_ids < 0)
+            if len(free):
+                slot = int(free[0])
+            else:
+                slot = int(np.argmin(self._last_used))
+                self.evictions += 1
+
+            self._clock += 1
+            self._embeddings[slot] = query
+            self._scope_ids[slot] = self._scope_id(scope)
+            self._expires_at[slot] = time.monotonic() + self.ttl if self.ttl else np.inf
+            self._last_used[slot] = self._clock
+            self._entries[slot] = {"scope": scope, "hits": hits, "answer": answer}
+
+    def invalidate(self, predicate=None):
+        """
+        Drop entries from the cache.
+
+        Args:
+            predicate (callable, optional): Called with the scope of each entry; matching entries are dropped.
+                Defaults to None, which drops every entry.
+
+        Returns:
+            int: The number of entries dropped.
+        """
+        with self._lock:
+            dropped_scopes = [scope for scope in self._scopes if predicate is None or predicate(scope)]
+            dropped_ids = [self._scopes.pop(scope) for scope in dropped_scopes]
+            slots = np.flatnonzero(np.isin(self._scope_ids, dropped_ids)) if dropped_ids else []
+            self._free(slots)
+            return len(slots)
+
+    def stats(self):
+        """Return the size of the cache, its threshold and its counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": int(np.count_nonzero(self._scope_ids >= 0)),
+                "max_size": self.max_size,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+# Question text -> embedding, and (index, embedding hash, top_n, knobs and filters) -> retrieval hits
+query_embedding_cache = LRUCache(int(os.getenv("QUERY_CACHE_SIZE", "4096")), float(os.getenv("QUERY_CACHE_TTL", "86400")))
+retrieval_cache = LRUCache(int(os.getenv("RETRIEVAL_CACHE_SIZE", "4096")), float(os.getenv("RETRIEVAL_CACHE_TTL", "3600")))
+
+# Every change to an index bumps a generation stamp in INDEX_STAMP_DIR, which serving processes compare at most
+# every INDEX_STAMP_CHECK_SECONDS to drop the entries of indexes changed by another process (pipeline.py,
+# bulk_indexer.py, ...). An empty INDEX_STAMP_DIR leaves such entries to expire with their TTL.
+INDEX_STAMP_DIR = os.getenv("INDEX_STAMP_DIR", "../docs/index_stamps")
+INDEX_STAMP_CHECK_SECONDS = float(os.getenv("INDEX_STAMP_CHECK_SECONDS", "1"))
+
+_stamp_lock = threading.Lock()
+# Index name -> (monotonic time of the last check, stamp seen then)
+_seen_stamps = {}
+
+# (index, search options) and question embedding -> hits and answer of the most similar recent question
+semantic_cache = SemanticCache(int(os.getenv("SEMANTIC_CACHE_SIZE", "1024")), float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")),
+                               float(os.getenv("SEMANTIC_CACHE_TTL", "3600")))
+
+
+def normalize_question(question):
+    """Normalize question text so trivially different spellings share a cache entry."""
+    return " ".join(question.lower().split())
+
+
+def embedding_key(embedding):
+    """Return a short hash of an embedding vector."""
+    return hashlib.sha1(np.asarray(embedding, dtype=np.float32).tobytes()).hexdigest()
+
+
+def cached_encode(model, question):
+    """
+    Encode a question, reusing the embedding of an earlier identical question.
+
+    Args:
+        model (SentenceTransformer): The model used for generating embeddings.
+        question (str): The user's question.
+
+    Returns:
+        np.ndarray: The question embedding.
+    """
+    key = normalize_question(question)
+    embedding = query_embedding_cache.get(key)
+    if embedding is None:
+        with span("encode"):
+            embedding = model.encode(question)
+        query_embedding_cache.put(key, embedding)
+    return embedding
+
+
+def _stamp_path(index_name):
+    return os.path.join(INDEX_STAMP_DIR, f"{index_name}.stamp")
+
+
+def _read_stamp(index_name):
+    try:
+        with open(_stamp_path(index_name), "r") as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+def _drop_index_entries(index_name):
+    semantic_cache.invalidate(lambda scope: scope[0] == index_name)
+    return retrieval_cache.invalidate(lambda key: key[0] == index_name)
+
+
+def check_index_stamp(index_name):
+    """
+    Drop the cached entries of an index if another process changed it since the last check.
+
+    The stamp file is read at most once every INDEX_STAMP_CHECK_SECONDS per index, so the check is cheap
+    enough to run before every lookup.
+    """
+    if not INDEX_STAMP_DIR:
+        return
+    now = time.monotonic()
+    with _stamp_lock:
+        checked_at, seen = _seen_stamps.get(index_name, (None, None))
+        if checked_at is not None and now - checked_at < INDEX_STAMP_CHECK_SECONDS:
+            return
+        stamp = _read_stamp(index_name)
+        _seen_stamps[index_name] = (now, stamp)
+    if checked_at is not None and stamp != seen:
+        _drop_index_entries(index_name)
+
+
+def cached_search(es_instance, index_name, query_embedding, top_n=5, **kwargs):
+    """
+    Search for similar passages, reusing the hits of an earlier identical search.
+
+    Args:
+        es_instance (Elasticsearch or LocalSearchEngine): The search backend.
+        index_name (str): The name of the index to search in.
+        query_embedding (array-like): The embedding vector of the user's query.
+        top_n (int, optional): The number of top results to retrieve. Defaults to 5.
+        **kwargs: Extra search knobs passed to `search_similar_passages`.
+
+    Returns:
+        list: List of top search results.
+    """
+    check_index_stamp(index_name)
+    key = (index_name, embedding_key(query_embedding), top_n, json.dumps(kwargs, sort_keys=True))
+    hits = retrieval_cache.get(key)
+    if hits is None:
+        hits = search_similar_passages(es_instance, index_name, query_embedding, top_n, **kwargs)
+        retrieval_cache.put(key, hits)
+    return hits
+
+
+def cached_encode_batch(model, questions, batch_size=64):
+    """
+    Encode several questions, reusing cached embeddings and encoding the others in one batched call.
+
+    Args:
+        model (SentenceTransformer): The model used for generating embeddings.
+        questions (list): The questions to encode.
+        batch_size (int, optional): Number of questions per forward pass. Defaults to 64.
+
+    Returns:
+        list: The embedding of each question, in order.
+    """
+    keys = [normalize_question(question) for question in questions]
+    embeddings = [query_embedding_cache.get(key) for key in keys]
+    missing = {}
+    for i, (key, embedding) in enumerate(zip(keys, embeddings)):
+        if embedding is None:
+            missing.setdefault(key, []).append(i)
+
+    if missing:
+        texts = [questions[positions[0]] for positions in missing.values()]
+        with span("encode"):
+            encoded = model.encode(texts, batch_size=batch_size)
+        for (key, positions), embedding in zip(missing.items(), encoded):
+            query_embedding_cache.put(key, embedding)
+            for i in positions:
+                embeddings[i] = embedding
+    return embeddings
+
+
+def cached_search_batch(es_instance, index_name, query_embeddings, top_n=5, **kwargs):
+    """
+    Search for the passages similar to several query embeddings, running only the uncached searches, in one batch.
+
+    Args:
+        es_instance (Elasticsearch or LocalSearchEngine): The search backend.
+        index_name (str): The name of the index to search in.
+        query_embeddings (list): The embedding vectors of the queries.
+        top_n (int, optional): The number of top results to retrieve per query. Defaults to 5.
+        **kwargs: Extra search knobs passed to `search_similar_passages_batch`.
+
+    Returns:
+        list: The list of top search results of each query, in order.
+    """
+    check_index_stamp(index_name)
+    options = json.dumps(kwargs, sort_keys=True)
+    keys = [(index_name, embedding_key(embedding), top_n, options) for embedding in query_embeddings]
+    results = [retrieval_cache.get(key) for key in keys]
+    missing = {}
+    for i, (key, hits) in enumerate(zip(keys, results)):
+        if hits is None:
+            missing.setdefault(key, []).append(i)
+
+    if missing:
+        searched = search_similar_passages_batch(es_instance, index_name,
+                                                 [query_embeddings[positions[0]] for positions in missing.values()],
+                                                 top_n, **kwargs)
+        for (key, positions), hits in zip(missing.items(), searched):
+            retrieval_cache.put(key, hits)
+            for i in positions:
+                results[i] = hits
+    return results
+
+
+def invalidate_index(index_name):
+    """
+    Drop the cached retrieval hits and semantically cached answers of an index after its content changed,
+    and bump its generation stamp so that other processes drop theirs too (see `check_index_stamp`).
+
+    Returns:
+        int: The number of retrieval cache entries dropped in this process.
+    """
+    if INDEX_STAMP_DIR:
+        stamp = f"{time.time_ns()}-{os.getpid()}"
+        try:
+            os.makedirs(INDEX_STAMP_DIR, exist_ok=True)
+            with open(_stamp_path(index_name) + f".{os.getpid()}.tmp", "w") as file:
+                file.write(stamp)
+            os.replace(_stamp_path(index_name) + f".{os.getpid()}.tmp", _stamp_path(index_name))
+        except OSError as e:
+            print(f"Failed to update the generation stamp of {index_name}: {str(e)}")
+        else:
+            # This process already drops its own entries below
+            with _stamp_lock:
+                _seen_stamps[index_name] = (time.monotonic(), stamp)
+    return _drop_index_entries(index_name)
+
+
+def cache_stats():
+    """Return the statistics of every cache tier."""
+    return {
+        "query_embedding": query_embedding_cache.stats(),
+        "retrieval": retrieval_cache.stats(),
+        "semantic": semantic_cache.stats()
+    }
@@ -0,0 +1,108 @@
+import os
+import json
+import sqlite3
+import threading
+
+# Document table shared by every index: the metadata of each document is stored once, keyed by its DocId,
+# instead of being copied into every passage
+DOCUMENT_STORE_PATH = os.getenv("DOCUMENT_STORE_PATH", "../docs/documents.sqlite")
+
+# Metadata returned for a hit whose document is unknown
+EMPTY_METADATA = "{}"
+
+
+class DocumentStore:
+    """
+    Table of the documents passages are chunked from, stored in a local SQLite database.
+
+    Passages only carry the `DocId` of their document (and their offsets in it); the document's
+    metadata is stored here once and joined into search hits on demand (see `join_metadata`).
+    """
+
+    def __init__(self, path=DOCUMENT_STORE_PATH):
+        """
+        Args:
+            path (str, optional): Path to the SQLite database file. Defaults to DOCUMENT_STORE_PATH.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS documents (doc_id TEXT PRIMARY KEY, metadata TEXT)")
+
+    def put(self, doc_id, metadata):
+        """
+        Store or replace the metadata of a document.
+
+        Args:
+            doc_id (str): The document id.
+            metadata (dict or str): The parsed `_Metadata.json` content, or its JSON text.
+        """
+        if not isinstance(metadata, str):
+            metadata = json.dumps(metadata)
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO documents (doc_id, metadata) VALUES (?, ?)", (doc_id, metadata))
+
+    def get_many(self, doc_ids):
+        """
+        Look up the metadata of several documents in one query.
+
+        Args:
+            doc_ids (iterable): Document ids.
+
+        Returns:
+            dict: The metadata JSON text of every known document, by id.
+        """
+        doc_ids = list(set(doc_ids))
+        if not doc_ids:
+            return {}
+        placeholders = ",".join("?" * len(doc_ids))
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT doc_id, metadata FROM documents WHERE doc_id IN ({placeholders})", doc_ids
+            ).fetchall()
+        return dict(rows)
+
+    def delete(self, doc_ids):
+        """Delete documents by id."""
+        with self._lock, self._connection:
+            self._connection.executemany("DELETE FROM documents WHERE doc_id = ?", [(doc_id,) for doc_id in doc_ids])
+
+    def clear(self):
+        """Delete every document."""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM documents")
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+
+def join_metadata(hits, document_store):
+    """
+    Join the metadata of their documents into search hits.
+
+    Only hits without a `Metadata` field of their own are looked up, all in one query, so the cost
+    is proportional to the number of hits returned rather than to the size of the index. Hits
+    from indexes built before metadata was normalized already carry it and are returned as they are.
+
+    Args:
+        hits (list): Search hits whose `_source` holds a `DocId`.
+        document_store (DocumentStore): The document table, or None to only fill in empty metadata.
+
+    Returns:
+        list: The hits, with `_source["Metadata"]` set on copies of those that lacked it.
+    """
+    missing = [hit["_source"].get("DocId") for hit in hits if "Metadata" not in hit["_source"]]
+    if not missing:
+        return hits
+
+    metadata = document_store.get_many(doc_id for doc_id in missing if doc_id) if document_store is not None else {}
+    return [
+        hit if "Metadata" in hit["_source"] else
+        dict(hit, _source=dict(hit["_source"], Metadata=metadata.get(hit["_source"].get("DocId"), EMPTY_METADATA)))
+        for hit in hits
+    ]
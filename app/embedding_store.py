@@ -0,0 +1,345 @@
+import os
+import csv
+import json
+import struct
+import numpy as np
+from parsing import source_from_row
+
+EMBEDDINGS_FILE = "embeddings.npy"
+PASSAGES_FILE = "passages.jsonl"
+COMMITTED_FILE = "committed"
+
+# Fixed size of the .npy header we write, so the row count can be rewritten in place on append
+HEADER_SIZE = 128
+
+
+def _npy_header(shape, dtype, size=HEADER_SIZE):
+    """
+    Build a version 1.0 .npy header padded to exactly `size` bytes.
+
+    Args:
+        shape (tuple): Shape of the array stored after the header.
+        dtype (np.dtype): Data type of the array.
+        size (int, optional): Total header size in bytes. Defaults to HEADER_SIZE.
+
+    Returns:
+        bytes: The header, or None if it does not fit in `size` bytes.
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.dtype(dtype).str, tuple(shape))
+    header_len = size - 10
+    if len(header) + 1 > header_len:
+        return None
+    header = header.ljust(header_len - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", header_len) + header.encode("latin1")
+
+
+def _read_npy_header(file):
+    """Return (shape, dtype, data_offset) of an open .npy file."""
+    version = np.lib.format.read_magic(file)
+    if version == (1, 0):
+        shape, _, dtype = np.lib.format.read_array_header_1_0(file)
+    else:
+        shape, _, dtype = np.lib.format.read_array_header_2_0(file)
+    return shape, dtype, file.tell()
+
+
+class EmbeddingStoreWriter:
+    """
+    Append passages and embeddings to a binary embedding store.
+
+    A store is a folder holding an `embeddings.npy` matrix (float32 or float16) and a
+    `passages.jsonl` table whose lines are aligned with the matrix rows. Rows are streamed to
+    disk as they are written, and the row count in the .npy header is updated on every write,
+    so memory use does not grow with the size of the store. A `committed` file records the rows
+    and passages table size of the last completed write; readers and appends stop there.
+    """
+
+    def __init__(self, store_dir, dtype="float32", append=False):
+        """
+        Args:
+            store_dir (str): Folder of the store. It is created if needed.
+            dtype (str, optional): Storage type of new stores, "float32" or "float16". Defaults to "float32".
+            append (bool, optional): Append to an existing store instead of overwriting it. Defaults to False.
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+        self.dims = None
+        self._offset = HEADER_SIZE
+
+        embeddings_path = os.path.join(store_dir, EMBEDDINGS_FILE)
+        passages_path = os.path.join(store_dir, PASSAGES_FILE)
+
+        if append and os.path.exists(embeddings_path):
+            self._embeddings_file = open(embeddings_path, "r+b")
+            shape, self.dtype, self._offset = _read_npy_header(self._embeddings_file)
+            self.rows, self.dims = shape if len(shape) == 2 and shape[0] else (0, None)
+            if self.dims is not None and _npy_header((self.rows, self.dims), self.dtype, self._offset) is None:
+                # The header was written by another tool and has no room to grow; rewrite the file once
+                self._embeddings_file.close()
+                existing = np.load(embeddings_path)
+                self._embeddings_file = open(embeddings_path, "w+b")
+                self._offset = HEADER_SIZE
+                self._embeddings_file.write(_npy_header(existing.shape, self.dtype))
+                self._embeddings_file.write(np.ascontiguousarray(existing).tobytes())
+
+            # Keep the rows that both files hold as of the last completed write, dropping the passage
+            # lines and embedding rows of an interrupted one
+            committed = _read_committed(store_dir)
+            committed_rows, committed_size = committed if committed is not None else (None, None)
+            if committed_rows is not None and committed_rows <= self.rows:
+                rows, size = committed_rows, committed_size
+            else:
+                rows, size = _passages_prefix(passages_path, self.rows, committed_size)
+            with open(passages_path, "ab") as file:
+                file.truncate(size)
+            if rows != self.rows:
+                self.rows = rows
+                self._embeddings_file.seek(0)
+                self._embeddings_file.write(_npy_header((self.rows, self.dims), self.dtype, self._offset))
+            _write_committed(store_dir, self.rows, size)
+        else:
+            self._embeddings_file = open(embeddings_path, "w+b")
+            self._embeddings_file.write(_npy_header((0, 0), self.dtype))
+            open(passages_path, "w", encoding="utf-8").close()
+            _write_committed(store_dir, 0, 0)
+
+        self._embeddings_file.seek(self._offset + self.rows * (self.dims or 0) * self.dtype.itemsize)
+        self._embeddings_file.truncate()
+        self._passages_file = open(passages_path, "ab")
+
+    def write(self, sources, embeddings):
+        """
+        Append rows to the store.
+
+        Args:
+            sources (list): List of passage sources, e.g. {"DocId", "Chunk", "Start", "End", "Passage"} dicts.
+            embeddings (array-like): Embeddings aligned with `sources`.
+        """
+        if not len(sources):
+            return
+
+        embeddings = np.ascontiguousarray(embeddings, dtype=self.dtype)
+        if self.dims is None:
+            self.dims = embeddings.shape[1]
+        elif embeddings.shape[1] != self.dims:
+            raise ValueError(f"Expected embeddings with {self.dims} dimensions, got {embeddings.shape[1]}")
+
+        # Write passages and vectors first, then the header row count; recording the rows and the size of
+        # the flushed passages table last commits the rows, so an interrupted write is rolled back on open
+        self._passages_file.write("".join(json.dumps(source) + "\n" for source in sources).encode("utf-8"))
+        self._passages_file.flush()
+        self._embeddings_file.write(embeddings.tobytes())
+        self.rows += len(embeddings)
+
+        end = self._embeddings_file.tell()
+        self._embeddings_file.seek(0)
+        self._embeddings_file.write(_npy_header((self.rows, self.dims), self.dtype, self._offset))
+        self._embeddings_file.seek(end)
+        self._embeddings_file.flush()
+        _write_committed(self.store_dir, self.rows, self._passages_file.tell())
+
+    def close(self):
+        """Flush and close the store files."""
+        self._embeddings_file.close()
+        self._passages_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def append_npy(path, rows):
+    """
+    Append rows to a 2-D .npy file, creating it if needed, without rewriting the existing rows.
+
+    Args:
+        path (str): Path to the .npy file.
+        rows (np.ndarray): The rows to append; they are cast to the dtype of an existing file.
+    """
+    rows = np.ascontiguousarray(rows)
+    if not len(rows):
+        return
+    if not os.path.exists(path):
+        with open(path, "wb") as file:
+            file.write(_npy_header(rows.shape, rows.dtype))
+            file.write(rows.tobytes())
+        return
+
+    with open(path, "r+b") as file:
+        shape, dtype, offset = _read_npy_header(file)
+        rows = np.ascontiguousarray(rows, dtype=dtype)
+        new_shape = (shape[0] + len(rows),) + tuple(shape[1:])
+        header = _npy_header(new_shape, dtype, offset)
+        if header is None:
+            # The header was written by another tool and has no room to grow; rewrite the file once
+            existing = np.load(path)
+            file.seek(0)
+            file.write(_npy_header(new_shape, dtype))
+            file.write(existing.tobytes())
+        else:
+            file.seek(offset + shape[0] * rows[:1].nbytes)
+        file.write(rows.tobytes())
+        file.truncate()
+        if header is not None:
+            file.seek(0)
+            file.write(header)
+
+
+def _read_committed(store_dir):
+    """
+    Return (rows, size) of the last completed write, the row count and the size in bytes of the passages table.
+
+    Returns:
+        tuple: The committed rows and size, with rows None in markers that only recorded the size, or None if unknown.
+    """
+    path = os.path.join(store_dir, COMMITTED_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as file:
+        fields = file.read().split()
+    if len(fields) == 1:
+        return None, int(fields[0])
+    return int(fields[0]), int(fields[1])
+
+
+def _write_committed(store_dir, rows, size):
+    """Record the row count and the size in bytes of the passages table after a completed write."""
+    path = os.path.join(store_dir, COMMITTED_FILE)
+    with open(path + ".tmp", "w") as file:
+        file.write(f"{rows} {size}")
+    os.replace(path + ".tmp", path)
+
+
+def _passages_prefix(passages_path, rows, max_size=None):
+    """
+    Return (lines, size) of the longest prefix of a passages table with at most `rows` complete lines.
+
+    Args:
+        passages_path (str): Path to the passages table.
+        rows (int): Maximum number of lines.
+        max_size (int, optional): Ignore bytes past this offset. Defaults to None (the whole file).
+
+    Returns:
+        tuple: The number of lines in the prefix and its size in bytes.
+    """
+    lines, size = 0, 0
+    if os.path.exists(passages_path):
+        with open(passages_path, "rb") as file:
+            for line in file:
+                if lines == rows or not line.endswith(b"\n") or (max_size is not None and size + len(line) > max_size):
+                    break
+                lines += 1
+                size += len(line)
+    return lines, size
+
+
+def _committed_rows(store_dir, rows):
+    """Return how many of the `rows` rows of an embedding matrix belong to completed writes."""
+    committed = _read_committed(store_dir)
+    if committed is None or committed[0] is None:
+        return rows
+    return min(rows, committed[0])
+
+
+def _read_sources(passages_path, rows):
+    """Read the first `rows` lines of a passages table."""
+    sources = []
+    if rows and os.path.exists(passages_path):
+        with open(passages_path, "r", encoding="utf-8") as file:
+            for line in file:
+                if len(sources) == rows:
+                    break
+                sources.append(json.loads(line))
+    return sources
+
+
+def store_exists(store_dir):
+    """Return True if the folder holds an embedding store."""
+    return os.path.exists(os.path.join(store_dir, EMBEDDINGS_FILE))
+
+
+def load_store(store_dir, mmap=True):
+    """
+    Load an embedding store.
+
+    Args:
+        store_dir (str): Folder of the store.
+        mmap (bool, optional): Memory-map the embedding matrix instead of reading it into memory. Defaults to True.
+
+    Returns:
+        tuple: (embeddings, sources) where embeddings is an (n, dims) array and sources is a list of
+        passage sources aligned with its rows. Rows of an interrupted write are left out.
+    """
+    embeddings = np.load(os.path.join(store_dir, EMBEDDINGS_FILE), mmap_mode="r" if mmap else None)
+    if embeddings.ndim != 2 or not len(embeddings):
+        return np.zeros((0, 0), dtype=np.float32), []
+    sources = _read_sources(os.path.join(store_dir, PASSAGES_FILE), _committed_rows(store_dir, len(embeddings)))
+    return embeddings[:len(sources)], sources
+
+
+def iter_store(store_dir, chunk_size=10000):
+    """
+    Iterate over an embedding store in chunks without loading it into memory.
+
+    Args:
+        store_dir (str): Folder of the store.
+        chunk_size (int, optional): Number of rows per chunk. Defaults to 10000.
+
+    Yields:
+        tuple: (sources, embeddings) for each chunk, where embeddings is a view of the memory-mapped matrix.
+        Rows of an interrupted write are left out.
+    """
+    embeddings = np.load(os.path.join(store_dir, EMBEDDINGS_FILE), mmap_mode="r")
+    if embeddings.ndim != 2:
+        return
+
+    rows = _committed_rows(store_dir, len(embeddings))
+    with open(os.path.join(store_dir, PASSAGES_FILE), "r", encoding="utf-8") as file:
+        for start in range(0, rows, chunk_size):
+            stop = min(start + chunk_size, rows)
+            sources = [json.loads(line) for line in (file.readline() for _ in range(stop - start)) if line.endswith("\n")]
+            if sources:
+                yield sources, embeddings[start:start + len(sources)]
+            if len(sources) < stop - start:
+                return
+
+
+def convert_csv_to_store(csv_file_path, store_dir, dtype="float32", chunk_size=10000):
+    """
+    Convert a passage/embedding CSV with stringified embedding lists into an embedding store.
+
+    Args:
+        csv_file_path (str): Path to the CSV file containing the data.
+        store_dir (str): Folder of the store to write.
+        dtype (str, optional): Storage type, "float32" or "float16". Defaults to "float32".
+        chunk_size (int, optional): Number of rows converted at a time. Defaults to 10000.
+    """
+    with open(csv_file_path, "r", encoding="utf-8") as csvfile, EmbeddingStoreWriter(store_dir, dtype) as writer:
+        reader = csv.DictReader(csvfile)
+        sources, embeddings = [], []
+        for row in reader:
+            sources.append(source_from_row(row))
+            embeddings.append(np.array(row["Embedding"][1:-1].split(","), dtype=np.float32))
+            if len(sources) == chunk_size:
+                writer.write(sources, np.vstack(embeddings))
+                sources, embeddings = [], []
+        if sources:
+            writer.write(sources, np.vstack(embeddings))
+
+    print(f"Successfully converted {csv_file_path} to {store_dir}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert a passage/metadata/embedding CSV into a binary embedding store.")
+    parser.add_argument("csv_file_path", nargs="?", default="../docs/passage_metadata_emb.csv")
+    parser.add_argument("store_dir", nargs="?", default="../docs/passage_metadata_emb")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    args = parser.parse_args()
+
+    convert_csv_to_store(args.csv_file_path, args.store_dir, args.dtype)
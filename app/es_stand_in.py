@@ -0,0 +1,173 @@
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+class StandInState:
+    """In-memory indexes of the stand-in server: settings and document counts per index, and request counters."""
+
+    def __init__(self, reject_rate=0.0, seed=0):
+        """
+        Args:
+            reject_rate (float, optional): Fraction of bulk items rejected with 429, as by a full write queue. Defaults to 0.
+            seed (int, optional): Seed of the rejection draws. Defaults to 0.
+        """
+        self.reject_rate = reject_rate
+        self.random = random.Random(seed)
+        self.indexes = {}
+        self.bulk_requests = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def index(self, name):
+        return self.indexes.setdefault(name, {"settings": {"number_of_shards": "1", "number_of_replicas": "1"}, "count": 0})
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answers the subset of the Elasticsearch REST API used by the bulk indexer."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=None):
+        payload = json.dumps(body if body is not None else {}).encode("utf-8")
+        self.send_response(status)
+        # The official client refuses to talk to a server that does not identify as Elasticsearch
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(payload)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _parts(self):
+        return [part for part in urlparse(self.path).path.split("/") if part]
+
+    def do_HEAD(self):
+        parts = self._parts()
+        state = self.server.state
+        self._send(200 if len(parts) == 1 and parts[0] in state.indexes else 404)
+
+    def do_GET(self):
+        parts = self._parts()
+        state = self.server.state
+        if not parts:
+            self._send(200, {"name": "stand-in", "cluster_name": "stand-in", "version": {"number": "8.15.0"}, "tagline": "You Know, for Search"})
+        elif len(parts) == 2 and parts[1] == "_settings" and parts[0] in state.indexes:
+            self._send(200, {parts[0]: {"settings": {"index": dict(state.indexes[parts[0]]["settings"])}}})
+        elif len(parts) == 2 and parts[1] == "_count" and parts[0] in state.indexes:
+            self._send(200, {"count": state.indexes[parts[0]]["count"]})
+        else:
+            self._send(404, {"error": "not found", "status": 404})
+
+    def do_PUT(self):
+        parts = self._parts()
+        if parts and parts[-1] == "_bulk":
+            # The client sends bulk requests with PUT as well as POST
+            return self.do_POST()
+        state = self.server.state
+        body = self._body()
+        with state.lock:
+            if len(parts) == 1:
+                state.index(parts[0])
+                self._send(200, {"acknowledged": True, "index": parts[0]})
+            elif len(parts) == 2 and parts[1] == "_settings" and parts[0] in state.indexes:
+                settings = json.loads(body).get("index", {})
+                current = state.indexes[parts[0]]["settings"]
+                for key, value in settings.items():
+                    # Putting null resets a setting to its default
+                    if value is None:
+                        current.pop(key, None)
+                    else:
+                        current[key] = str(value)
+                self._send(200, {"acknowledged": True})
+            else:
+                self._send(404, {"error": "not found", "status": 404})
+
+    def do_DELETE(self):
+        parts = self._parts()
+        state = self.server.state
+        with state.lock:
+            if len(parts) == 1 and state.indexes.pop(parts[0], None) is not None:
+                self._send(200, {"acknowledged": True})
+            else:
+                self._send(404, {"error": "not found", "status": 404})
+
+    def do_POST(self):
+        parts = self._parts()
+        state = self.server.state
+        body = self._body()
+        if parts and parts[-1] == "_refresh":
+            self._send(200, {"_shards": {"total": 1, "successful": 1, "failed": 0}})
+        elif parts and parts[-1] == "_bulk":
+            self._send(200, self._bulk(body.decode("utf-8").splitlines(), parts[0] if len(parts) == 2 else None))
+        else:
+            self._send(404, {"error": "not found", "status": 404})
+
+    def _bulk(self, lines, default_index):
+        state = self.server.state
+        items = []
+        lines = [line for line in lines if line.strip()]
+        with state.lock:
+            state.bulk_requests += 1
+            for action_line, source_line in zip(lines[::2], lines[1::2]):
+                action = json.loads(action_line)
+                op, meta = next(iter(action.items()))
+                index_name = meta.get("_index", default_index)
+                json.loads(source_line)
+                if state.random.random() < state.reject_rate:
+                    state.rejected += 1
+                    items.append({op: {"_index": index_name, "status": 429, "error": {
+                        "type": "es_rejected_execution_exception", "reason": "rejected execution: write queue is full"}}})
+                    continue
+                state.index(index_name)["count"] += 1
+                items.append({op: {"_index": index_name, "_id": str(state.index(index_name)["count"]), "result": "created", "status": 201}})
+        return {"took": 1, "errors": any(next(iter(item.values()))["status"] >= 300 for item in items), "items": items}
+
+
+def start_stand_in(port=0, reject_rate=0.0, seed=0):
+    """
+    Start a local stand-in for an Elasticsearch server in a background thread.
+
+    It implements just enough of the REST API (index creation, settings, refresh, count and bulk)
+    to exercise bulk loading without a cluster, and can reject a fraction of bulk items with 429
+    to exercise retries.
+
+    Args:
+        port (int, optional): Port to listen on; 0 picks a free port. Defaults to 0.
+        reject_rate (float, optional): Fraction of bulk items rejected with 429. Defaults to 0.
+        seed (int, optional): Seed of the rejection draws. Defaults to 0.
+
+    Returns:
+        ThreadingHTTPServer: The running server; its URL is `http://127.0.0.1:{server.server_port}`,
+        its `state` holds the indexes and counters, and `shutdown()` stops it.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandInHandler)
+    server.daemon_threads = True
+    server.state = StandInState(reject_rate, seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for Elasticsearch for bulk loading experiments.")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--reject-rate", type=float, default=0.0, help="Fraction of bulk items rejected with 429")
+    args = parser.parse_args()
+
+    server = start_stand_in(args.port, args.reject_rate)
+    print(f"Elasticsearch stand-in listening on http://127.0.0.1:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
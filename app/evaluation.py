@@ -0,0 +1,168 @@
+import csv
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from cache import cached_encode_batch, cached_search_batch
+from documents import join_metadata
+from gen_ai import answer_passages
+from metrics import HITS_RETURNED
+
+
+def answer_questions(model, es_instance, questions, index_name="passage_metadata_emb", top_n=5, generate=True,
+                     concurrency=8, batch_size=64, documents=None, **search_options):
+    """
+    Retrieve passages for and answer many questions at once.
+
+    All questions are encoded in batched forward passes and searched in one multi-search; the answers are then
+    generated concurrently by at most `concurrency` threads. Results are yielded in the order of `questions`
+    as soon as each one is ready, so callers can write them out while later answers are still generated.
+
+    Args:
+        model (SentenceTransformer): The model used for generating embeddings.
+        es_instance (Elasticsearch or LocalSearchEngine): The search backend.
+        questions (list): The questions to answer.
+        index_name (str, optional): The index to search in. Defaults to "passage_metadata_emb".
+        top_n (int, optional): The number of passages retrieved per question. Defaults to 5.
+        generate (bool, optional): Generate an AI answer from the passages of each question. Defaults to True.
+        concurrency (int, optional): Maximum number of concurrent generation calls. Defaults to 8.
+        batch_size (int, optional): Number of questions per forward pass. Defaults to 64.
+        documents (DocumentStore, optional): The document table the metadata of the hits is joined from. Defaults to None.
+        **search_options: Search knobs passed to `search_similar_passages_batch`, e.g. `nprobe`, `num_candidates` or `filters`.
+
+    Yields:
+        dict: The `question`, its passages (`answer`), `relevance_socres` and `metadata` as returned by /ask, the
+        `gen_ai_output`, and an `error` if the answer could not be generated.
+    """
+    embeddings = cached_encode_batch(model, questions, batch_size)
+    all_hits = cached_search_batch(es_instance, index_name, embeddings, top_n, **search_options)
+
+    def result(question, hits):
+        HITS_RETURNED.observe(len(hits))
+        hits = join_metadata(hits, documents)
+        return {
+            'question': question,
+            'answer': [hit["_source"]["Passage"] for hit in hits],
+            'relevance_socres': [hit["_score"] for hit in hits],
+            'metadata': [hit["_source"]["Metadata"] for hit in hits],
+            'gen_ai_output': None
+        }
+
+    results = [result(question, hits) for question, hits in zip(questions, all_hits)]
+    if not generate:
+        yield from results
+        return
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(answer_passages, entry['answer'], entry['question'], entry['relevance_socres']) for entry in results]
+        for entry, future in zip(results, futures):
+            try:
+                entry['gen_ai_output'] = future.result()
+            except Exception as e:
+                entry['error'] = f'Failed to generate an answer. Error: {str(e)}'
+            yield entry
+
+
+class ResultWriter:
+    """
+    Writes question answering results to a CSV or JSONL file, one row per question, as they arrive.
+
+    Rows have the columns of `retrieval.save_results_to_csv` ("Question", then "Passage i", "Relevance Score i"
+    and "Passage i Metadata" for each retrieved passage) followed by "Generative AI Answer". The format is
+    chosen by the file extension: ".jsonl" writes one JSON object per line, anything else CSV.
+    """
+
+    def __init__(self, path, top_n=5):
+        """
+        Args:
+            path (str): The output file, overwritten if it exists.
+            top_n (int, optional): Number of passage column groups. Defaults to 5.
+        """
+        self.columns = ["Question"]
+        for i in range(1, top_n + 1):
+            self.columns.extend([f"Passage {i}", f"Relevance Score {i}", f"Passage {i} Metadata"])
+        self.columns.append("Generative AI Answer")
+
+        self.jsonl = path.endswith(".jsonl")
+        self._file = open(path, 'w', newline='', encoding='utf-8')
+        if not self.jsonl:
+            self._writer = csv.DictWriter(self._file, fieldnames=self.columns, extrasaction='ignore')
+            self._writer.writeheader()
+
+    def write(self, result):
+        """Write the row of one result of `answer_questions` and flush it to disk."""
+        row = {"Question": result['question']}
+        for i, (passage, score, metadata) in enumerate(zip(result['answer'], result['relevance_socres'], result['metadata']), 1):
+            row.update({f"Passage {i}": passage, f"Relevance Score {i}": score, f"Passage {i} Metadata": metadata})
+        row["Generative AI Answer"] = result.get('gen_ai_output') or result.get('error')
+
+        if self.jsonl:
+            self._file.write(json.dumps(row) + "\n")
+        else:
+            self._writer.writerow(row)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_questions(path):
+    """
+    Read evaluation questions from a file.
+
+    Args:
+        path (str): A text file with one question per line, a CSV file with a "Question" column (or the
+            questions in its first column), or a JSONL file of objects with a "question" key.
+
+    Returns:
+        list: The questions.
+    """
+    with open(path, encoding='utf-8') as f:
+        if path.endswith(".jsonl"):
+            return [json.loads(line)["question"] for line in f if line.strip()]
+        if path.endswith(".csv"):
+            rows = list(csv.reader(f))
+            if rows and "Question" in rows[0]:
+                column = rows[0].index("Question")
+                return [row[column] for row in rows[1:] if len(row) > column and row[column].strip()]
+            return [row[0] for row in rows if row and row[0].strip()]
+        return [line.strip() for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    import time
+    import argparse
+    from app import ANN_NPROBE, EMBEDDING_BATCH_SIZE, ES_NUM_CANDIDATES, get_document_store, get_model, get_search_backend
+
+    parser = argparse.ArgumentParser(description="Answer a file of evaluation questions in batch and write the results to CSV or JSONL.")
+    parser.add_argument("questions", help="Text file with one question per line, CSV with a Question column, or JSONL")
+    parser.add_argument("--output", default="../docs/evaluation_results.csv", help="Output file; a .jsonl extension writes JSON lines")
+    parser.add_argument("--index-name", default="passage_metadata_emb")
+    parser.add_argument("--top-n", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("GENERATION_CONCURRENCY", "8")), help="Concurrent generation calls")
+    parser.add_argument("--batch-size", type=int, default=EMBEDDING_BATCH_SIZE)
+    parser.add_argument("--filter", type=json.loads, default=None, help='Metadata filter as JSON, e.g. \'{"Year": {"gte": 2010}}\'')
+    parser.add_argument("--no-generate", action="store_true", help="Only retrieve passages")
+    args = parser.parse_args()
+
+    questions = read_questions(args.questions)
+    start = time.perf_counter()
+    results = answer_questions(get_model(), get_search_backend(), questions, args.index_name, args.top_n,
+                               generate=not args.no_generate, concurrency=args.concurrency, batch_size=args.batch_size,
+                               documents=get_document_store(), nprobe=ANN_NPROBE, num_candidates=ES_NUM_CANDIDATES,
+                               filters=args.filter)
+
+    failed = 0
+    with ResultWriter(args.output, args.top_n) as writer:
+        for result in results:
+            writer.write(result)
+            failed += 'error' in result
+
+    elapsed = time.perf_counter() - start
+    print(f"Answered {len(questions)} questions in {elapsed:.1f}s ({len(questions) / max(elapsed, 1e-9):.1f} questions/s, "
+          f"{failed} generation errors), results written to {args.output}")
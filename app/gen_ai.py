@@ -1,14 +1,387 @@
-import pandas as pd
-import google.generativeai as palm
 import os
+import re
+import time
+import threading
+from answer_cache import AnswerCache, answer_key
+from metrics import CONTEXT_PASSAGES_DROPPED, PROMPT_CHARS, PROMPT_TOKENS, span
+from parsing import split_sentences
 from dotenv import load_dotenv
 load_dotenv()
 # Extract the API token from the configuration data
 api_key = os.getenv('PALM_API_KEY')
 
+MODEL_NAME = "models/text-bison-001"
+
+PROMPT_TEMPLATE = """
+        Use ONLY the following pieces of passages to answer the question at the end. 
+        If you don't know the answer, just say that you don't know, don't try to make up an answer. 
+        Use three sentences maximum and keep the answer as concise as possible. 
+        Only answer from the passages
+        Passages: {passages}
+        Question: {question}
+    """
+
+# Generator backend: "palm" for the hosted PaLM model, or "local" for a deterministic extractive
+# stand-in that needs no key or network, e.g. to load-test the /ask path offline
+GENERATOR = os.getenv('GENERATOR', 'palm')
+
+# Token budget of the passages inserted into a prompt; passages beyond it are dropped, lowest score first
+CONTEXT_MAX_TOKENS = int(os.getenv('CONTEXT_MAX_TOKENS', '1024'))
+# Passages that would be cut to fewer tokens than this to fit the budget are dropped instead
+CONTEXT_MIN_TOKENS = int(os.getenv('CONTEXT_MIN_TOKENS', '32'))
+
+# Simulated generation latency of the local generator per prompt token, in milliseconds
+LOCAL_GENERATOR_MS_PER_TOKEN = float(os.getenv('LOCAL_GENERATOR_MS_PER_TOKEN', '0'))
+
+# Answers are generated at temperature 0, so identical inputs can be served from disk.
+# Set ANSWER_CACHE_PATH to an empty string to disable the cache.
+ANSWER_CACHE_PATH = os.getenv('ANSWER_CACHE_PATH', '../docs/answer_cache.sqlite')
+ANSWER_CACHE_MAX_MB = float(os.getenv('ANSWER_CACHE_MAX_MB', '64'))
+
+_client_lock = threading.Lock()
+_client = None
+
+_answer_cache_lock = threading.Lock()
+_answer_cache = None
+
+# Words and punctuation marks, an estimate of the subword tokens of the generative model, whose tokenizer is not available locally
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def count_tokens(text):
+    """Estimate the number of tokens of a text as its number of words and punctuation marks."""
+    return sum(1 for _ in _TOKEN_PATTERN.finditer(text))
+
+
+def truncate_tokens(text, max_tokens):
+    """Return the longest prefix of a text with at most `max_tokens` tokens, as counted by `count_tokens`."""
+    for i, match in enumerate(_TOKEN_PATTERN.finditer(text)):
+        if i == max_tokens:
+            return text[:match.start()].rstrip()
+    return text
+
+
+def get_client():
+    """
+    Return the PaLM client, importing and configuring it with the API token on first use only.
+
+    Returns:
+        module: The configured `google.generativeai` module.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # The Google SDK is slow to import, so it is only loaded once an answer is needed
+                import google.generativeai as palm
+                palm.configure(api_key=api_key)
+                _client = palm
+    return _client
+
+
+def get_answer_cache():
+    """
+    Return the answer cache, opening its database on first use only, so importing this module creates no file.
+
+    Returns:
+        AnswerCache: The answer cache, or None if ANSWER_CACHE_PATH is empty.
+    """
+    global _answer_cache
+    if _answer_cache is None and ANSWER_CACHE_PATH:
+        with _answer_cache_lock:
+            if _answer_cache is None:
+                _answer_cache = AnswerCache(ANSWER_CACHE_PATH, int(ANSWER_CACHE_MAX_MB * 1024 * 1024))
+    return _answer_cache
+
+
+def answer_cache_stats():
+    """Return the statistics of the answer cache, or None if it is disabled or not opened yet."""
+    return _answer_cache.stats() if _answer_cache is not None else None
+
+
+class Context:
+    """
+    The passages selected for a prompt and the prompt built from them.
+
+    Attributes:
+        passages (list): The passages inserted into the prompt, highest score first.
+        prompt (str): The prompt.
+        question (str): The user's query/question.
+        context_tokens (int): Tokens of the inserted passages.
+        prompt_tokens (int): Tokens of the whole prompt.
+        duplicates (int): Passages dropped because all their sentences were already in the context.
+        over_budget (int): Passages dropped or cut to fit CONTEXT_MAX_TOKENS.
+    """
+
+    def __init__(self, passages, question, duplicates=0, over_budget=0):
+        self.passages = passages
+        self.question = question
+        self.prompt = PROMPT_TEMPLATE.format(passages=' '.join(passages), question=question)
+        self.context_tokens = sum(count_tokens(passage) for passage in passages)
+        self.prompt_tokens = count_tokens(self.prompt)
+        self.duplicates = duplicates
+        self.over_budget = over_budget
+
+
+def assemble_context(passages, question, scores=None, max_tokens=CONTEXT_MAX_TOKENS, min_tokens=CONTEXT_MIN_TOKENS):
+    """
+    Select the passages of a prompt and build it, within a token budget.
+
+    Passages are taken in order of decreasing score. Sentences already taken from a higher scored passage,
+    such as the overlap between consecutive chunks of a document, are left out, and a passage with no new
+    sentence is dropped. Passages are then added until `max_tokens` is reached; the passage that crosses
+    the budget is cut to fit, unless less than `min_tokens` of it would remain, and the rest are dropped.
+
+    Args:
+        passages (list): The retrieved passages.
+        question (str): The user's query/question.
+        scores (list, optional): The relevance score of each passage. Defaults to the order of `passages`.
+        max_tokens (int, optional): Token budget of the passages. Defaults to CONTEXT_MAX_TOKENS.
+        min_tokens (int, optional): Smallest part of a passage worth inserting. Defaults to CONTEXT_MIN_TOKENS.
+
+    Returns:
+        Context: The selected passages, the prompt and its token counts.
+    """
+    if scores is not None:
+        order = sorted(range(len(passages)), key=lambda i: -scores[i])
+        passages = [passages[i] for i in order]
+
+    seen = set()
+    selected = []
+    duplicates = over_budget = 0
+    remaining = max_tokens
+    for passage in passages:
+        sentences = []
+        for sentence in split_sentences(passage):
+            key = " ".join(sentence.lower().split())
+            if key and key not in seen:
+                seen.add(key)
+                sentences.append(sentence.strip())
+        if not sentences:
+            duplicates += 1
+            continue
+
+        text = " ".join(sentences)
+        tokens = count_tokens(text)
+        if tokens > remaining:
+            over_budget += 1
+            if remaining < min_tokens:
+                continue
+            text, tokens = truncate_tokens(text, remaining), remaining
+        selected.append(text)
+        remaining -= tokens
+
+    context = Context(selected, question, duplicates, over_budget)
+    CONTEXT_PASSAGES_DROPPED.inc(duplicates, reason="duplicate")
+    CONTEXT_PASSAGES_DROPPED.inc(over_budget, reason="budget")
+    PROMPT_TOKENS.observe(context.prompt_tokens)
+    PROMPT_CHARS.observe(len(context.prompt))
+    return context
+
+
+class PalmGenerator:
+    """Generates answers with the hosted PaLM text model."""
+
+    name = MODEL_NAME
+
+    def generate(self, context):
+        """
+        Args:
+            context (Context): The assembled prompt.
+
+        Returns:
+            str: The answer generated by the PaLM model.
+        """
+        completion = get_client().generate_text(
+            model=MODEL_NAME,
+            prompt=context.prompt,
+            temperature=0,
+        )
+        return completion.result
+
+    def stream(self, context):
+        """
+        Yield the answer in fragments. The PaLM text API returns a completion in one piece, so it is yielded once.
+
+        Args:
+            context (Context): The assembled prompt.
+
+        Yields:
+            str: Fragments of the answer.
+        """
+        out = self.generate(context)
+        if out:
+            yield out
+
+
+class LocalGenerator:
+    """
+    A deterministic stand-in for the hosted model that answers with the (at most three) sentences of
+    the context sharing the most words with the question, in context order.
+
+    It needs no key or network, so the whole /ask path can be load-tested offline; set
+    LOCAL_GENERATOR_MS_PER_TOKEN to also simulate a generation latency proportional to the prompt length.
+    """
+
+    name = "local-extractive"
+
+    def __init__(self, ms_per_token=LOCAL_GENERATOR_MS_PER_TOKEN, max_sentences=3):
+        """
+        Args:
+            ms_per_token (float, optional): Simulated latency per prompt token. Defaults to LOCAL_GENERATOR_MS_PER_TOKEN.
+            max_sentences (int, optional): Maximum number of sentences of an answer. Defaults to 3.
+        """
+        self.ms_per_token = ms_per_token
+        self.max_sentences = max_sentences
+
+    def generate(self, context):
+        """
+        Args:
+            context (Context): The assembled prompt.
+
+        Returns:
+            str: The answer, or "I don't know." if no sentence shares a word with the question.
+        """
+        return "".join(self.stream(context))
+
+    def stream(self, context):
+        """
+        Yield the answer token by token, each word with the whitespace that follows it.
+
+        Args:
+            context (Context): The assembled prompt.
+
+        Yields:
+            str: Fragments of the answer.
+        """
+        if self.ms_per_token:
+            time.sleep(context.prompt_tokens * self.ms_per_token / 1000)
+
+        question_words = {word for word in re.findall(r"\w+", context.question.lower()) if len(word) > 3}
+        sentences = [sentence for passage in context.passages for sentence in split_sentences(passage)]
+        overlaps = [len(question_words & set(re.findall(r"\w+", sentence.lower()))) for sentence in sentences]
+        best = sorted((i for i in range(len(sentences)) if overlaps[i]), key=lambda i: -overlaps[i])[:self.max_sentences]
+        answer = " ".join(sentences[i].strip() for i in sorted(best)) if best else "I don't know."
+        for match in re.finditer(r"\S+\s*", answer):
+            yield match.group()
+
+
+GENERATORS = {"palm": PalmGenerator, "local": LocalGenerator}
+
+generator = None
+
+
+def get_generator():
+    """Return the generator selected by GENERATOR, creating it on first use."""
+    global generator
+    if generator is None:
+        with _client_lock:
+            if generator is None:
+                if GENERATOR not in GENERATORS:
+                    raise ValueError(f"Unknown generator {GENERATOR!r}, expected one of {', '.join(GENERATORS)}")
+                generator = GENERATORS[GENERATOR]()
+    return generator
+
+
+def generate_answer(passages, user_query, scores=None):
+    """
+    Answer a question from a list of passages, serving repeated inputs from the answer cache.
+
+    Args:
+        passages (list): The passages to answer from.
+        user_query (str): The user's query/question.
+        scores (list, optional): The relevance score of each passage, used to pick the passages that fit
+            the context budget. Defaults to the order of `passages`.
+
+    Returns:
+        tuple: The generated answer and the `Context` it was generated from.
+    """
+    context = assemble_context(passages, user_query, scores)
+    backend = get_generator()
+
+    # Serve identical (model, prompt, passages, question) inputs from the answer cache
+    key = answer_key(backend.name, PROMPT_TEMPLATE, context.passages, user_query)
+    answer_cache = get_answer_cache()
+    out = answer_cache.get(key) if answer_cache is not None else None
+
+    if out is None:
+        with span("generate"):
+            out = backend.generate(context)
+
+        if answer_cache is not None:
+            answer_cache.put(key, out)
+
+    return out, context
+
+
+def answer_passages(passages, user_query, scores=None):
+    """
+    Answer a question from a list of passages, serving repeated inputs from the answer cache.
+
+    Args:
+        passages (list): The passages to answer from.
+        user_query (str): The user's query/question.
+        scores (list, optional): The relevance score of each passage. Defaults to the order of `passages`.
+
+    Returns:
+        str: The generated answer.
+    """
+    return generate_answer(passages, user_query, scores)[0]
+
+
+def answer_hits(search_results, user_query):
+    """
+    Answer a question from search hits, ranked by their relevance scores.
+
+    Returns:
+        tuple: The generated answer and the `Context` it was generated from.
+    """
+    return generate_answer([hit["_source"]["Passage"] for hit in search_results], user_query,
+                           [hit["_score"] for hit in search_results])
+
+
+def stream_answer(search_results, user_query):
+    """
+    Answer a question from search hits with the configured generator, yielding the answer in fragments as they
+    are generated.
+
+    Generators stream through their `stream` method; one without it has its whole answer yielded once. A cached
+    answer is yielded at once, and a streamed answer is cached once it is complete.
+
+    Args:
+        search_results (list): List of search results, typically from Elasticsearch.
+        user_query (str): The user's query/question.
+
+    Yields:
+        str: Fragments of the generated answer.
+    """
+    context = assemble_context([hit["_source"]["Passage"] for hit in search_results], user_query,
+                               [hit["_score"] for hit in search_results])
+    backend = get_generator()
+
+    key = answer_key(backend.name, PROMPT_TEMPLATE, context.passages, user_query)
+    answer_cache = get_answer_cache()
+    out = answer_cache.get(key) if answer_cache is not None else None
+    if out is not None:
+        if out:
+            yield out
+        return
+
+    fragments = []
+    with span("generate"):
+        stream = backend.stream(context) if hasattr(backend, "stream") else iter([backend.generate(context)])
+        for fragment in stream:
+            if fragment:
+                fragments.append(fragment)
+                yield fragment
+
+    if answer_cache is not None:
+        answer_cache.put(key, "".join(fragments))
+
+
 def generate_direct_answer_with_palm(search_results, user_query, save_csv=True):
     """
-    Generate a direct answer using the PaLM model from Google.
+    Generate a direct answer with the configured generator (the PaLM model from Google by default).
 
     Args:
         search_results (list): List of search results, typically from Elasticsearch.
@@ -16,48 +389,28 @@ def generate_direct_answer_with_palm(search_results, user_query, save_csv=True):
         save_csv (bool): Flag indicating if the results should be saved to a CSV.
 
     Returns:
-        str: The answer generated by the PaLM model.
+        str: The generated answer.
     """
-    
-    # Initialize the PaLM client using the provided API token
-    palm.configure(api_key=api_key)
-    model = "models/text-bison-001"
-
-    passages = ''
 
     # If save_csv is True, read the questions and answers from a CSV and combine the passages
     if save_csv:
+        import pandas as pd
         df = pd.read_csv('../docs/questions_answers.csv', encoding='ISO-8859-1')
         passage_columns = [col for col in df.columns if "Passage" in col and "Metadata" not in col]
-        combined_passages = df[passage_columns].apply(lambda row: ' '.join(row.dropna()), axis=1)
-        passages = "".join(combined_passages)
+        passages, scores = [], []
+        for col in passage_columns:
+            score_col = col.replace("Passage", "Relevance Score")
+            for i, passage in df[col].dropna().items():
+                passages.append(str(passage))
+                scores.append(float(df.at[i, score_col]) if score_col in df.columns and pd.notna(df.at[i, score_col]) else 0.0)
+        # The passages of every question compete for the same context budget, best scored first
+        out = answer_passages(passages, user_query, scores)
     else:
-        passages = [hit["_source"]["Passage"] for hit in search_results]
-
-    # Create a prompt for the PALM model using the passages and user query
-    prompt = f"""
-        Use ONLY the following pieces of passages to answer the question at the end. 
-        If you don't know the answer, just say that you don't know, don't try to make up an answer. 
-        Use three sentences maximum and keep the answer as concise as possible. 
-        Only answer from the passages
-        Passages: {' '.join(passages)}
-        Question: {user_query}
-    """
-
-    # Run the PaLM model with the generated prompt
-    completion = palm.generate_text(
-    model=model,
-    prompt=prompt,
-    temperature=0,
-    )
-
-
-    # Extract the generated answer from the model's output
-    out = completion.result
+        out = answer_hits(search_results, user_query)[0]
 
     # If save_csv is True, save the generated answer to a CSV
     if save_csv:
         df['Generative AI Answer'] = out
         df.to_csv('../docs/questions_answers.csv', index=False)
-    
+
     return out
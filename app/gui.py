@@ -1,3 +1,4 @@
+import json
 import streamlit as st
 import requests
 import pandas as pd
@@ -39,48 +40,74 @@ def sidebar_navigation():
         ("Query Existing Documents", "Upload & Analyze Custom Document")
     )
 
+def render_streamed_answer(response):
+    """Render the events of a streamed /ask_stream response as they arrive."""
+    answer_placeholder = None
+    answer = ""
+
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            continue
+        event = json.loads(line)
+
+        if event["type"] == "hits":
+            # Extract and tabulate the results as soon as retrieval is done
+            df = pd.DataFrame({
+                "Passage": event.get("answer", []),
+                "Metadata": event.get("metadata", [])
+            })
+            st.write("### Top Results")
+            st.table(df)
+
+            # Display AI-generated answer as it is generated
+            st.write("### AI Enhanced Answer")
+            answer_placeholder = st.empty()
+            answer_placeholder.write("_Generating..._")
+
+        elif event["type"] == "answer" and answer_placeholder is not None:
+            answer += event["text"]
+            answer_placeholder.write(answer)
+
+        elif event["type"] == "error":
+            st.error(event["error"])
+
+    if answer_placeholder is not None and not answer:
+        answer_placeholder.write("")
+
 configure_ui()
 selected_feature = sidebar_navigation()
 
 
 # API endpoints
 API_ENDPOINT = "http://127.0.0.1:5000/ask" 
-RESET_INDEX_ENDPOINT = "http://127.0.0.1:5000/reset_index" 
+ASK_STREAM_ENDPOINT = "http://127.0.0.1:5000/ask_stream" 
 UPLOAD_AND_QUERY_ENDPOINT = "http://127.0.0.1:5000/upload" 
 
-# Reset the Elasticsearch index on app startup
-try:
-    response = requests.post(RESET_INDEX_ENDPOINT)
-    response.raise_for_status()  # This will raise an HTTPError if the HTTP request returned an unsuccessful status code
-except requests.RequestException as e:
-    st.error("Failed to reset the Elasticsearch index. Please ensure the backend service is running.")
-    quit()
-
-new_documents_uploaded = False
-
 
+def upload_session(txt_file, json_file):
+    """
+    Upload a pair of files once and return the session handle of their index, reused across reruns
+    until other files are uploaded or the session expires on the server.
+    """
+    key = (txt_file.name, txt_file.size, json_file.name, json_file.size)
+    if st.session_state.get("upload_key") != key or not st.session_state.get("session_id"):
+        response = requests.post(
+            UPLOAD_AND_QUERY_ENDPOINT,
+            files={"txt_file": (txt_file.name, txt_file.getvalue()), "json_file": (json_file.name, json_file.getvalue())}
+        )
+        response.raise_for_status()
+        st.session_state["upload_key"] = key
+        st.session_state["session_id"] = response.json()["session_id"]
+    return st.session_state["session_id"]
 
 
 if selected_feature == "Query Existing Documents":
     prompt = st.chat_input("Query your file")
     if prompt:
         try:
-            response = requests.post(API_ENDPOINT, json={"question": prompt})
-            response.raise_for_status()  # This raises an HTTPError for bad responses
-            data = response.json()
-
-            # Extract and tabulate the results
-            df = pd.DataFrame({
-                "Passage": data.get("answer", []),
-                # "Relevance Scores": data.get("relevance_scores", []),
-                "Metadata": data.get("metadata", [])
-            })
-            st.write("### Top Results")
-            st.table(df)
-
-            # Display AI-generated answer
-            st.write("### AI Enhanced Answer")
-            st.write(data.get("gen_ai_output"))
+            with requests.post(ASK_STREAM_ENDPOINT, json={"question": prompt}, stream=True) as response:
+                response.raise_for_status()  # This raises an HTTPError for bad responses
+                render_streamed_answer(response)
 
         except requests.RequestException as e:
             st.error("Failed to fetch results from the API. Please ensure the backend service is running.")
@@ -92,48 +119,22 @@ elif selected_feature == "Upload & Analyze Custom Document":
     json_file = st.file_uploader("Upload a .json file", type="json")
 
     if txt_file and json_file:
-        if new_documents_uploaded:
-            try:
-                # Reset Elasticsearch index if new documents are uploaded
-                response = requests.post(RESET_INDEX_ENDPOINT)
-                
-                # Check for HTTP errors
-                response.raise_for_status()
-                
-                new_documents_uploaded = False
-
-            except requests.RequestException as e:
-                # Handle the exception and display a message to the user
-                st.error("Error: Could not reset the Elasticsearch index. Please ensure the backend service is running.")
-
         prompt = st.chat_input("Query your uploaded files")
         if prompt:
             try:
-                response = requests.post(
-                    UPLOAD_AND_QUERY_ENDPOINT,
-                    files={"txt_file": txt_file, "json_file": json_file},
-                    data={"question": prompt}
-                )
-                
-                # Check for HTTP errors
-                response.raise_for_status()
-
-                results = response.json()
-
-                # Extract and tabulate the results
-                df = pd.DataFrame({
-                    "Passage": results.get("answer", []),
-                    # "Relevance Scores": results.get("relevance_scores", []),
-                    "Metadata": results.get("metadata", [])
-                })
-                st.write("### Top Results")
-                st.table(df)
-
-                # Display AI-generated answer
-                st.write("### AI Enhanced Answer")
-                st.write(results.get("gen_ai_output"))
-
-                new_documents_uploaded = True
+                # The files are only sent when they change; follow-up questions are asked by session handle
+                session_id = upload_session(txt_file, json_file)
+                response = requests.post(ASK_STREAM_ENDPOINT, json={"question": prompt, "session_id": session_id}, stream=True)
+                if response.status_code == 404:
+                    # The session expired or was evicted on the server, so upload the files again
+                    st.session_state["session_id"] = None
+                    session_id = upload_session(txt_file, json_file)
+                    response = requests.post(ASK_STREAM_ENDPOINT, json={"question": prompt, "session_id": session_id}, stream=True)
+
+                with response:
+                    # Check for HTTP errors
+                    response.raise_for_status()
+                    render_streamed_answer(response)
 
             except requests.RequestException as e:
                 # Handle the exception and display a user-friendly message
@@ -1,5 +1,12 @@
 from elasticsearch import Elasticsearch, helpers
+import os
 import csv
+from bulk_indexer import bulk_index
+from cache import invalidate_index
+from embedding_store import iter_store
+from local_search import LocalSearchEngine
+from parsing import METADATA_FIELDS, add_metadata_fields, source_from_row
+from projection import MODEL_DIMS
 
 def connect_instance(host, port, username, password, timeout=120):
     """
@@ -31,50 +38,168 @@ def connect_instance(host, port, username, password, timeout=120):
         print(f"Failed to connect to ES instance: {str(e)}")
         return None
 
-def create_index(es_instance, index_name="passage_metadata_emb"):
+# Elasticsearch kNN index types storing quantized vectors, by quantization kind
+KNN_INDEX_TYPES = {"int8": "int8_hnsw", "binary": "bbq_hnsw"}
+
+def create_index(es_instance, index_name="passage_metadata_emb", knn=False, quantization=None, dims=MODEL_DIMS):
     """
     Create an Elasticsearch index with specified mappings.
 
     Args:
-        es_instance (Elasticsearch): The Elasticsearch connection object.
+        es_instance (Elasticsearch or LocalSearchEngine): The Elasticsearch connection object or a local search engine.
         index_name (str, optional): The name of the index to create. Defaults to "passage_metadata_emb".
+        knn (bool, optional): Index the embeddings in an HNSW graph so they can be searched with approximate kNN. Defaults to False.
+        quantization (str, optional): Store the kNN-indexed vectors quantized, "int8" or "binary"; Elasticsearch
+            rescores the candidates with the float vectors. Defaults to None.
+        dims (int, optional): Dimension of the indexed embeddings, that of the projection if they are projected
+            (see `projection`). Defaults to MODEL_DIMS.
     """
+    if isinstance(es_instance, LocalSearchEngine):
+        es_instance.create(index_name)
+        invalidate_index(index_name)
+        return
+
     mapping = {
         "mappings": {
             "properties": {
                 "Passage": {"type": "text"},
+                # Only set on passages indexed before metadata was moved to the document table
                 "Metadata": {"type": "text"},
-                "Embedding": {"type": "dense_vector", "dims": 768}
+                # Position of the passage in its document; not searchable
+                "Chunk": {"type": "integer", "index": False},
+                "Start": {"type": "integer", "index": False},
+                "End": {"type": "integer", "index": False},
+                "Embedding": {"type": "dense_vector", "dims": dims}
             }
         }
     }
-    
+
+    # Typed metadata fields used to filter searches before vector scoring
+    for field, field_type in METADATA_FIELDS.items():
+        mapping["mappings"]["properties"][field] = {"type": field_type}
+
+    if knn:
+        mapping["mappings"]["properties"]["Embedding"].update({"index": True, "similarity": "cosine"})
+        if quantization:
+            mapping["mappings"]["properties"]["Embedding"]["index_options"] = {"type": KNN_INDEX_TYPES[quantization]}
+
     es_instance.indices.create(index=index_name, body=mapping)
+    invalidate_index(index_name)
 
-def index_data_to_elasticsearch(es_instance, csv_file_path, index_name="passage_metadata_emb"):
+def index_data_to_elasticsearch(es_instance, csv_file_path, index_name="passage_metadata_emb", **bulk_options):
     """
-    Index data from a CSV file to an Elasticsearch index.
+    Index data from a CSV file or an embedding store to an Elasticsearch index.
+
+    Elasticsearch indexes are loaded by a parallel `BulkIndexer` that streams the data in chunks, with
+    refresh and replicas turned off until the load finishes.
 
     Args:
-        es_instance (Elasticsearch): The Elasticsearch connection object.
-        csv_file_path (str): Path to the CSV file containing the data.
+        es_instance (Elasticsearch or LocalSearchEngine): The Elasticsearch connection object or a local search engine.
+        csv_file_path (str): Path to the CSV file containing the data, or to an embedding store folder (see `embedding_store`).
         index_name (str, optional): The name of the index to which data will be indexed. Defaults to "passage_metadata_emb".
+        **bulk_options: Options of `bulk_indexer.bulk_index`, e.g. `workers`, `chunk_docs`, `chunk_bytes` or `tune_settings`.
+
+    Returns:
+        dict: The bulk load summary for Elasticsearch (see `BulkIndexer.index`), None for a local index.
     """
-    with open(csv_file_path, 'r', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        actions = []
-        for row in reader:
-            action = {
-                "_index": index_name,
-                "_source": {
-                    "Passage": row["Passage"],
-                    "Metadata": row["Metadata"],
+    is_store = os.path.isdir(csv_file_path)
+
+    if isinstance(es_instance, LocalSearchEngine):
+        if is_store:
+            es_instance.index_store(csv_file_path, index_name)
+        else:
+            es_instance.index_csv(csv_file_path, index_name)
+        invalidate_index(index_name)
+        print("Successfully indexed data to local index")
+        return None
+
+    def generate_store_sources():
+        # Stream the memory-mapped embeddings chunk by chunk instead of parsing floats from text
+        for sources, embeddings in iter_store(csv_file_path):
+            for source, embedding in zip(sources, embeddings.astype("float32").tolist()):
+                yield dict(add_metadata_fields(source), Embedding=embedding)
+
+    def generate_csv_sources():
+        with open(csv_file_path, 'r', encoding='utf-8') as csvfile:
+            for row in csv.DictReader(csvfile):
+                yield dict(
+                    add_metadata_fields(source_from_row(row)),
                     # Convert string representation of list to actual list of floats
-                    "Embedding": [float(x) for x in row["Embedding"][1:-1].split(",")]  
-                }
-            }
-            actions.append(action)
+                    Embedding=[float(x) for x in row["Embedding"][1:-1].split(",")]
+                )
 
-        # Bulk index the data to Elasticsearch
-        helpers.bulk(es_instance, actions)
+    sources = generate_store_sources() if is_store else generate_csv_sources()
+    summary = bulk_index(es_instance, index_name, sources, **bulk_options)
+    invalidate_index(index_name)
+    if summary["failed"]:
+        print(f"Indexed data to ES instance with {summary['failed']} failed documents: {summary['errors']}")
+    else:
         print("Successfully indexed data to ES instance")
+    return summary
+
+def index_passages(es_instance, sources, embeddings, index_name="passage_metadata_emb", refresh="wait_for"):
+    """
+    Index passages that are already in memory together with their embeddings.
+
+    Args:
+        es_instance (Elasticsearch or LocalSearchEngine): The Elasticsearch connection object or a local search engine.
+        sources (list): List of {"DocId", "Chunk", "Start", "End", "Passage"} dicts.
+        embeddings (np.ndarray): Embeddings aligned with `sources`.
+        index_name (str, optional): The name of the index to which data will be indexed. Defaults to "passage_metadata_emb".
+        refresh (str or bool, optional): Elasticsearch refresh policy of the bulk request; False leaves refreshing
+            to the caller, which is cheaper when many batches are indexed in a row. Defaults to "wait_for".
+    """
+    if isinstance(es_instance, LocalSearchEngine):
+        es_instance.add(index_name, sources, embeddings)
+    else:
+        actions = (
+            {"_index": index_name, "_source": dict(add_metadata_fields(source), Embedding=embedding)}
+            for source, embedding in zip(sources, embeddings.astype("float32").tolist())
+        )
+        helpers.bulk(es_instance, actions, refresh=refresh)
+
+    invalidate_index(index_name)
+
+
+def delete_documents(es_instance, index_name, doc_ids):
+    """
+    Delete every passage of the given documents from an index.
+
+    Args:
+        es_instance (Elasticsearch or LocalSearchEngine): The Elasticsearch connection object or a local search engine.
+        index_name (str): The name of the index to delete from.
+        doc_ids (list): The `DocId` values of the documents to delete.
+    """
+    if not doc_ids:
+        return
+
+    if isinstance(es_instance, LocalSearchEngine):
+        es_instance.delete_documents(index_name, doc_ids)
+    else:
+        es_instance.delete_by_query(
+            index=index_name,
+            body={"query": {"terms": {"DocId": list(doc_ids)}}},
+            refresh=True,
+            conflicts="proceed"
+        )
+
+    invalidate_index(index_name)
+
+
+def recreate_index(es_instance, index_name, knn=False, quantization=None, dims=MODEL_DIMS):
+    """
+    Delete an index if it exists and create it again empty.
+
+    Args:
+        es_instance (Elasticsearch or LocalSearchEngine): The search backend.
+        index_name (str): The name of the index to recreate.
+        knn (bool, optional): Create the Elasticsearch index with a kNN-indexed embedding field. Defaults to False.
+        quantization (str, optional): Quantize the kNN-indexed vectors, "int8" or "binary". Defaults to None.
+        dims (int, optional): Dimension of the indexed embeddings. Defaults to MODEL_DIMS.
+    """
+    if isinstance(es_instance, LocalSearchEngine):
+        es_instance.delete(index_name)
+    elif es_instance.indices.exists(index=index_name):
+        es_instance.indices.delete(index=index_name)
+
+    create_index(es_instance, index_name, knn=knn, quantization=quantization, dims=dims)
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import hashlib
+from indexing import delete_documents, index_passages
+from metrics import CHUNKS, DOCUMENTS, span
+from model import encode_passages
+from parsing import chunking_signature, document_id, list_documents, metadata_file_for, parse_chunks
+
+
+def hash_document(folder_path, txt_file):
+    """
+    Hash the content of a `_Technical.txt` file together with its `_Metadata.json` file.
+
+    Args:
+        folder_path (str): Path to the folder containing the files.
+        txt_file (str): Name of the `_Technical.txt` file.
+
+    Returns:
+        str: The hex SHA-256 digest of both files.
+    """
+    digest = hashlib.sha256()
+    for name in (txt_file, metadata_file_for(txt_file)):
+        with open(os.path.join(folder_path, name), "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    Record of the documents ingested into an index, keyed by document id.
+
+    Each entry holds the content hash of the document's `_Technical.txt`/`_Metadata.json` pair,
+    the file sizes and modification times it was hashed at, its number of chunks and the chunking
+    configuration it was chunked with. Files whose size and modification time are unchanged are not
+    re-hashed, and every document is re-chunked when the chunking configuration changes.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Path to the JSON file the manifest is stored in.
+        """
+        self.path = path
+        self.documents = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                self.documents = json.load(file)
+
+    def save(self):
+        """Write the manifest to disk atomically."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as file:
+            json.dump(self.documents, file, indent=1)
+        os.replace(self.path + ".tmp", self.path)
+
+    def clear(self):
+        """Forget every document, e.g. after the index has been reset."""
+        self.documents = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def diff(self, folder_path):
+        """
+        Compare the manifest with the documents currently in a folder.
+
+        Args:
+            folder_path (str): Path to the folder containing the files.
+
+        Returns:
+            tuple: (changed, removed) where changed maps the id of every new or modified document
+            to (txt_file, content_hash, stat) and removed lists the ids of documents that are no
+            longer in the folder.
+        """
+        changed = {}
+        current = set()
+        chunking = chunking_signature()
+        for txt_file in list_documents(folder_path):
+            json_file = metadata_file_for(txt_file)
+            if not os.path.exists(os.path.join(folder_path, json_file)):
+                continue
+
+            doc_id = document_id(txt_file)
+            stat = [
+                [st.st_size, st.st_mtime_ns]
+                for st in (os.stat(os.path.join(folder_path, name)) for name in (txt_file, json_file))
+            ]
+            current.add(doc_id)
+
+            entry = self.documents.get(doc_id)
+            if entry is not None and entry.get("chunking", "sentences") != chunking:
+                changed[doc_id] = (txt_file, hash_document(folder_path, txt_file), stat)
+                continue
+            if entry is not None and entry["stat"] == stat:
+                continue
+
+            # Only hash files whose size or modification time changed
+            content_hash = hash_document(folder_path, txt_file)
+            if entry is not None and entry["hash"] == content_hash:
+                entry["stat"] = stat
+                continue
+            changed[doc_id] = (txt_file, content_hash, stat)
+
+        removed = [doc_id for doc_id in self.documents if doc_id not in current]
+        return changed, removed
+
+
+def ingest_folder(es_instance, model, folder_path, index_name, manifest_path, batch_size=64, documents=None):
+    """
+    Bring an index up to date with a folder of documents, touching only what changed.
+
+    New and modified documents are chunked, embedded and indexed; the old passages of modified
+    documents and all passages of removed documents are deleted from the index. The metadata of
+    every document is kept once in the document table rather than in its passages.
+
+    Args:
+        es_instance (Elasticsearch or LocalSearchEngine): The search backend.
+        model (SentenceTransformer): The model used for generating embeddings.
+        folder_path (str): Path to the folder containing the `_Technical.txt`/`_Metadata.json` pairs.
+        index_name (str): The name of the index to update.
+        manifest_path (str): Path to the manifest of the index.
+        batch_size (int, optional): Number of passages per forward pass. Defaults to 64.
+        documents (DocumentStore, optional): The document table to store metadata in. Defaults to None.
+
+    Returns:
+        dict: Counts of `added`, `updated` and `removed` documents and of `chunks` indexed.
+    """
+    start = time.perf_counter()
+    manifest = Manifest(manifest_path)
+    changed, removed = manifest.diff(folder_path)
+
+    updated = [doc_id for doc_id in changed if doc_id in manifest.documents]
+    with span("delete"):
+        delete_documents(es_instance, index_name, updated + removed)
+    for doc_id in removed:
+        del manifest.documents[doc_id]
+    if documents is not None:
+        documents.delete(removed)
+
+    chunks = 0
+    for doc_id, (txt_file, content_hash, stat) in changed.items():
+        with span("parse"):
+            sources, metadata = parse_chunks(folder_path, txt_file)
+            if documents is not None:
+                documents.put(doc_id, metadata)
+        with span("embed"):
+            embeddings = encode_passages(model, [source["Passage"] for source in sources], batch_size=batch_size)
+        with span("index"):
+            index_passages(es_instance, sources, embeddings, index_name)
+        DOCUMENTS.inc()
+        CHUNKS.inc(len(sources))
+
+        # Record each document as soon as it is indexed so an interrupted run resumes where it stopped
+        manifest.documents[doc_id] = {"hash": content_hash, "stat": stat, "chunks": len(sources),
+                                     "chunking": chunking_signature()}
+        manifest.save()
+        chunks += len(sources)
+
+    manifest.save()
+    summary = {
+        "added": len(changed) - len(updated),
+        "updated": len(updated),
+        "removed": len(removed),
+        "chunks": chunks
+    }
+    print(f"Ingested {summary} into {index_name} in {time.perf_counter() - start:.2f}s")
+    return summary
@@ -0,0 +1,521 @@
+import os
+import shutil
+from collections import defaultdict
+import numpy as np
+from ann import IVFIndex, IVF_FILE
+from embedding_store import EmbeddingStoreWriter, append_npy, convert_csv_to_store, iter_store, load_store, store_exists
+from parsing import METADATA_FIELDS, add_metadata_fields, validate_filter
+from quantization import QUANTIZERS, codes_file, params_file, write_codes
+from vectors import normalize_rows, normalize_vector, top_k
+
+DELETED_FILE = "deleted.npy"
+
+
+class LocalSearchEngine:
+    """
+    In-process exact vector search over pre-normalized embeddings stored on disk.
+
+    Each index lives in its own folder under `index_dir` as a float32 embedding store (see
+    `embedding_store`) whose matrix is memory-mapped on load. Hits are returned in the same shape as Elasticsearch hits, so callers can use
+    either backend interchangeably.
+
+    An index may also carry an IVF approximate nearest-neighbour index (`ivf.npz`, see `build_ann`);
+    searches then only score the rows of the closest `nprobe` clusters unless exact search is requested.
+
+    Deleted documents are tombstoned in `deleted.npy` and skipped at search time; `compact` rewrites
+    the index without them.
+
+    Searches can be filtered by the typed metadata fields of `parsing.METADATA_FIELDS`. Posting lists
+    (for keyword fields) and sorted value arrays (for numeric and date fields) are built on first use,
+    and the filter selects candidate rows before any vector is scored.
+
+    An index may also carry int8 or binary codes of its embeddings (see `build_quantized`). A quantized
+    search scans the compact codes to shortlist `oversample` times `top_n` rows and rescores only the
+    shortlist against the float32 embeddings, so the returned scores are exact.
+    """
+
+    def __init__(self, index_dir, default_nprobe=8, quantization=None, oversample=10):
+        """
+        Args:
+            index_dir (str): Folder holding one sub-folder per index.
+            default_nprobe (int, optional): Number of IVF lists visited when a search does not set nprobe. Defaults to 8.
+            quantization (str, optional): Quantization used when a search does not set one, "int8" or "binary".
+                Indexes without those codes are searched in float32. Defaults to None.
+            oversample (int, optional): Shortlist size of quantized searches as a multiple of top_n. Defaults to 10.
+        """
+        self.index_dir = index_dir
+        self.default_nprobe = default_nprobe
+        self.quantization = quantization
+        self.oversample = oversample
+        self._indexes = {}
+        self._ann = {}
+        self._deleted = {}
+        self._postings = {}
+        self._quantized = {}
+        os.makedirs(index_dir, exist_ok=True)
+
+    def _index_path(self, index_name):
+        return os.path.join(self.index_dir, index_name)
+
+    def exists(self, index_name):
+        """Return True if the index has been created."""
+        return os.path.isdir(self._index_path(index_name))
+
+    def create(self, index_name):
+        """Create an empty index."""
+        os.makedirs(self._index_path(index_name), exist_ok=True)
+        self._forget(index_name)
+
+    def delete(self, index_name):
+        """Delete an index and everything stored in it."""
+        shutil.rmtree(self._index_path(index_name), ignore_errors=True)
+        self._forget(index_name)
+
+    def _forget(self, index_name):
+        """Drop the in-memory copy of an index so the next access reloads it from disk."""
+        self._indexes.pop(index_name, None)
+        self._ann.pop(index_name, None)
+        self._deleted.pop(index_name, None)
+        self._postings.pop(index_name, None)
+        self._quantized.pop(index_name, None)
+
+    def _load(self, index_name):
+        """
+        Load an index into memory, memory-mapping the embedding matrix.
+
+        Returns:
+            tuple: (embeddings, sources) where embeddings is an (n, dims) float32 array and
+            sources is a list of passage sources aligned with its rows.
+        """
+        if index_name in self._indexes:
+            return self._indexes[index_name]
+
+        path = self._index_path(index_name)
+        loaded = load_store(path) if store_exists(path) else (np.zeros((0, 0), dtype=np.float32), [])
+
+        self._indexes[index_name] = loaded
+        return loaded
+
+    def _load_deleted(self, index_name):
+        """Return a boolean mask of the tombstoned rows of an index, or None if no row is deleted."""
+        if index_name not in self._deleted:
+            embeddings, _ = self._load(index_name)
+            deleted_path = os.path.join(self._index_path(index_name), DELETED_FILE)
+            mask = None
+            if os.path.exists(deleted_path):
+                mask = np.zeros(len(embeddings), dtype=bool)
+                mask[np.load(deleted_path)] = True
+            self._deleted[index_name] = mask
+        return self._deleted[index_name]
+
+    def _load_postings(self, index_name):
+        """
+        Build the filter indexes of an index.
+
+        Returns:
+            dict: Maps each keyword field to {value: sorted row ids}, and each numeric or date field
+            to a (sorted values, row ids) pair.
+        """
+        if index_name not in self._postings:
+            _, sources = self._load(index_name)
+            postings = {}
+            for field, field_type in METADATA_FIELDS.items():
+                if field_type == "keyword":
+                    rows_by_value = defaultdict(list)
+                    for row, source in enumerate(sources):
+                        values = source.get(field)
+                        for value in values if isinstance(values, list) else [values]:
+                            if value is not None:
+                                rows_by_value[value].append(row)
+                    postings[field] = {value: np.array(rows, dtype=np.int64) for value, rows in rows_by_value.items()}
+                else:
+                    pairs = [(source[field], row) for row, source in enumerate(sources) if source.get(field) is not None]
+                    pairs.sort()
+                    postings[field] = (
+                        np.array([value for value, _ in pairs]),
+                        np.array([row for _, row in pairs], dtype=np.int64)
+                    )
+            self._postings[index_name] = postings
+        return self._postings[index_name]
+
+    def _filter_rows(self, index_name, filters):
+        """
+        Select the rows of an index whose metadata fields match a filter.
+
+        Args:
+            index_name (str): The index to filter.
+            filters (dict): Maps a field of `parsing.METADATA_FIELDS` to a value, a list of accepted
+                values, or a range given as a dict with any of `gte`, `gt`, `lte` and `lt`.
+
+        Returns:
+            np.ndarray: The sorted ids of the matching rows.
+
+        Raises:
+            ValueError: If the filter is invalid (see `parsing.validate_filter`).
+        """
+        filters = validate_filter(filters)
+        postings = self._load_postings(index_name)
+        selected = None
+        for field, condition in filters.items():
+            index = postings[field]
+            if isinstance(index, dict):
+                values = condition if isinstance(condition, (list, tuple)) else [condition]
+                matches = [index[value] for value in values if value in index]
+                rows = np.unique(np.concatenate(matches)) if matches else np.zeros(0, dtype=np.int64)
+            else:
+                sorted_values, sorted_rows = index
+                if isinstance(condition, dict):
+                    low, high = 0, len(sorted_values)
+                    if "gte" in condition:
+                        low = max(low, np.searchsorted(sorted_values, condition["gte"], side="left"))
+                    if "gt" in condition:
+                        low = max(low, np.searchsorted(sorted_values, condition["gt"], side="right"))
+                    if "lte" in condition:
+                        high = min(high, np.searchsorted(sorted_values, condition["lte"], side="right"))
+                    if "lt" in condition:
+                        high = min(high, np.searchsorted(sorted_values, condition["lt"], side="left"))
+                    rows = np.sort(sorted_rows[low:max(low, high)])
+                else:
+                    values = condition if isinstance(condition, (list, tuple)) else [condition]
+                    rows = np.unique(np.concatenate([
+                        sorted_rows[np.searchsorted(sorted_values, value, side="left"):np.searchsorted(sorted_values, value, side="right")]
+                        for value in values
+                    ] or [np.zeros(0, dtype=np.int64)]))
+
+            selected = rows if selected is None else np.intersect1d(selected, rows, assume_unique=True)
+        return selected
+
+    def _load_ann(self, index_name):
+        """Return the IVF index of an index, or None if it has not been built."""
+        if index_name not in self._ann:
+            ann_path = os.path.join(self._index_path(index_name), IVF_FILE)
+            self._ann[index_name] = IVFIndex.load(ann_path) if os.path.exists(ann_path) else None
+        return self._ann[index_name]
+
+    def build_ann(self, index_name, n_lists=256, n_iter=10):
+        """
+        Train an IVF index over the rows of an index and persist it next to the embeddings.
+
+        Args:
+            index_name (str): The index to build the IVF index for.
+            n_lists (int, optional): Number of clusters. Defaults to 256.
+            n_iter (int, optional): Number of k-means iterations. Defaults to 10.
+        """
+        embeddings, sources = self._load(index_name)
+        if not sources:
+            return
+
+        ivf = IVFIndex.train(embeddings, n_lists=n_lists, n_iter=n_iter)
+        ivf.add(embeddings)
+        ivf.save(os.path.join(self._index_path(index_name), IVF_FILE))
+        self._ann[index_name] = ivf
+        print(f"Successfully built IVF index with {ivf.n_lists} lists for {index_name}")
+
+    def _load_quantized(self, index_name, kind):
+        """Return the (quantizer, memory-mapped codes) of an index, or None if they have not been built."""
+        if kind not in QUANTIZERS:
+            raise ValueError(f"Unknown quantization: {kind}")
+
+        loaded = self._quantized.setdefault(index_name, {})
+        if kind not in loaded:
+            path = self._index_path(index_name)
+            params_path = os.path.join(path, params_file(kind))
+            loaded[kind] = None
+            if os.path.exists(params_path):
+                loaded[kind] = (QUANTIZERS[kind].load(params_path), np.load(os.path.join(path, codes_file(kind)), mmap_mode="r"))
+        return loaded[kind]
+
+    def _quantizations(self, index_name):
+        """Return the quantization kinds built for an index."""
+        path = self._index_path(index_name)
+        return [kind for kind in QUANTIZERS if os.path.exists(os.path.join(path, params_file(kind)))]
+
+    def build_quantized(self, index_name, kind="int8"):
+        """
+        Train a quantizer over the rows of an index and persist its codes next to the embeddings.
+
+        Args:
+            index_name (str): The index to quantize.
+            kind (str, optional): "int8" or "binary". Defaults to "int8".
+        """
+        if kind not in QUANTIZERS:
+            raise ValueError(f"Unknown quantization: {kind}")
+        embeddings, sources = self._load(index_name)
+        if not sources:
+            return
+
+        path = self._index_path(index_name)
+        quantizer = QUANTIZERS[kind].train(embeddings)
+        self._quantized.pop(index_name, None)
+        write_codes(quantizer, embeddings, os.path.join(path, codes_file(kind)))
+        quantizer.save(os.path.join(path, params_file(kind)))
+        print(f"Successfully built {kind} codes for {index_name}")
+
+    def add(self, index_name, sources, embeddings):
+        """
+        Append passages and their embeddings to an index, creating it if needed.
+
+        Args:
+            index_name (str): The index to append to.
+            sources (list): List of passage sources, e.g. {"DocId", "Chunk", "Start", "End", "Passage"} dicts.
+            embeddings (array-like): Embeddings aligned with `sources`.
+        """
+        if not sources:
+            return
+
+        new_embeddings = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        ivf = self._load_ann(index_name)
+
+        # Release the memory map before the store grows underneath it
+        self._indexes.pop(index_name, None)
+        self._deleted.pop(index_name, None)
+        self._postings.pop(index_name, None)
+        self._quantized.pop(index_name, None)
+        sources = [add_metadata_fields(source) for source in sources]
+
+        path = self._index_path(index_name)
+        with EmbeddingStoreWriter(path, dtype="float32", append=True) as writer:
+            start_id = writer.rows
+            writer.write(sources, new_embeddings)
+
+        # Insert the new rows into the IVF lists incrementally, if the index has one
+        if ivf is not None:
+            ivf.add(new_embeddings, start_id=start_id)
+            ivf.save(os.path.join(path, IVF_FILE))
+
+        # Encode the new rows with the existing quantizers, if the index has any
+        for kind in self._quantizations(index_name):
+            quantizer = QUANTIZERS[kind].load(os.path.join(path, params_file(kind)))
+            append_npy(os.path.join(path, codes_file(kind)), quantizer.encode(new_embeddings))
+
+    def delete_documents(self, index_name, doc_ids, compact_ratio=0.5):
+        """
+        Tombstone every row whose source has one of the given `DocId` values.
+
+        Args:
+            index_name (str): The index to delete from.
+            doc_ids (iterable): The document ids to delete.
+            compact_ratio (float, optional): Compact the index once this fraction of its rows is deleted. Defaults to 0.5.
+
+        Returns:
+            int: The number of rows deleted.
+        """
+        doc_ids = set(doc_ids)
+        embeddings, sources = self._load(index_name)
+        if not doc_ids or not sources:
+            return 0
+
+        mask = self._load_deleted(index_name)
+        mask = np.zeros(len(sources), dtype=bool) if mask is None else mask.copy()
+        rows = [i for i, source in enumerate(sources) if source.get("DocId") in doc_ids and not mask[i]]
+        if not rows:
+            return 0
+
+        mask[rows] = True
+        np.save(os.path.join(self._index_path(index_name), DELETED_FILE), np.flatnonzero(mask))
+        self._deleted[index_name] = mask
+
+        if mask.mean() >= compact_ratio:
+            self.compact(index_name)
+        return len(rows)
+
+    def compact(self, index_name):
+        """Rewrite an index without its tombstoned rows, keeping its IVF index and quantized codes in step."""
+        mask = self._load_deleted(index_name)
+        if mask is None:
+            return
+
+        embeddings, sources = self._load(index_name)
+        keep = np.flatnonzero(~mask)
+        path = self._index_path(index_name)
+        compact_path = path + ".compact"
+        shutil.rmtree(compact_path, ignore_errors=True)
+        with EmbeddingStoreWriter(compact_path, dtype="float32") as writer:
+            for start in range(0, len(keep), 10000):
+                rows = keep[start:start + 10000]
+                writer.write([sources[i] for i in rows], embeddings[rows])
+
+        # Map old row ids to their new positions in the IVF lists
+        ivf = self._load_ann(index_name)
+        if ivf is not None:
+            new_ids = np.cumsum(~mask) - 1
+            ivf.lists = [new_ids[ids[~mask[ids]]] for ids in ivf.lists]
+            ivf.save(os.path.join(compact_path, IVF_FILE))
+
+        for kind in self._quantizations(index_name):
+            quantizer, codes = self._load_quantized(index_name, kind)
+            for start in range(0, len(keep), 10000):
+                append_npy(os.path.join(compact_path, codes_file(kind)), codes[keep[start:start + 10000]])
+            quantizer.save(os.path.join(compact_path, params_file(kind)))
+
+        self._forget(index_name)
+        shutil.rmtree(path)
+        os.replace(compact_path, path)
+
+    def index_store(self, store_dir, index_name, chunk_size=10000):
+        """
+        Append the rows of an embedding store to an index.
+
+        Args:
+            store_dir (str): Folder of the embedding store.
+            index_name (str): The index to append to.
+            chunk_size (int, optional): Number of rows copied at a time. Defaults to 10000.
+        """
+        for sources, embeddings in iter_store(store_dir, chunk_size):
+            self.add(index_name, sources, embeddings)
+
+    def index_csv(self, csv_file_path, index_name):
+        """
+        Append the rows of a passage/metadata/embedding CSV to an index.
+
+        Args:
+            csv_file_path (str): Path to the CSV file containing the data.
+            index_name (str): The index to append to.
+        """
+        store_dir = os.path.join(self.index_dir, index_name + ".import")
+        convert_csv_to_store(csv_file_path, store_dir)
+        self.index_store(store_dir, index_name)
+        shutil.rmtree(store_dir, ignore_errors=True)
+
+    def search(self, index_name, query_embedding, top_n=5, nprobe=None, exact=False, filters=None,
+               quantization=None, oversample=None):
+        """
+        Return the top_n passages by cosine similarity to the query embedding.
+
+        Args:
+            index_name (str): The index to search in.
+            query_embedding (array-like): The embedding vector of the user's query.
+            top_n (int, optional): The number of top results to retrieve. Defaults to 5.
+            nprobe (int, optional): Number of IVF lists to visit. Defaults to `default_nprobe`.
+            exact (bool, optional): Score every row in float32, ignoring the IVF index and quantized codes. Defaults to False.
+            filters (dict, optional): Only consider rows whose metadata fields match (see `_filter_rows`). Defaults to None.
+            quantization (str, optional): Shortlist with "int8" or "binary" codes. Defaults to `quantization`.
+            oversample (int, optional): Shortlist size as a multiple of top_n. Defaults to `oversample`.
+
+        Returns:
+            list: Hits shaped like Elasticsearch hits, with `_score` being cosine similarity + 1.0.
+        """
+        embeddings, sources = self._load(index_name)
+        if not sources or top_n <= 0:
+            return []
+
+        query = normalize_vector(query_embedding)
+        ivf = None if exact else self._load_ann(index_name)
+        quantization = None if exact else quantization or self.quantization
+        quantized = self._load_quantized(index_name, quantization) if quantization else None
+        deleted = self._load_deleted(index_name)
+        rows = self._filter_rows(index_name, filters) if filters else None
+
+        if rows is not None and (ivf is None or len(rows) <= len(sources) // 4):
+            # A selective filter is cheaper to score exactly than to probe the IVF lists
+            candidates = rows
+        elif ivf is not None:
+            # Only score the rows of the clusters closest to the query
+            candidates = np.sort(ivf.candidates(query, nprobe or self.default_nprobe))
+            if rows is not None:
+                candidates = candidates[np.isin(candidates, rows, assume_unique=True)]
+        else:
+            candidates = None
+
+        if candidates is not None and deleted is not None:
+            candidates = candidates[~deleted[candidates]]
+
+        if quantized is not None:
+            # Shortlist with cheap approximate scores over the codes; only the shortlist is rescored exactly
+            quantizer, codes = quantized
+            approx = quantizer.scores(codes, query, candidates)
+            if candidates is None and deleted is not None:
+                approx[deleted] = -np.inf
+            positions = top_k(approx, top_n * (oversample or self.oversample))
+            positions = positions[approx[positions] > -np.inf]
+            candidates = np.sort(positions if candidates is None else candidates[positions])
+
+        if candidates is None:
+            # One matrix-vector product scores the whole corpus
+            scores = embeddings @ query
+            if deleted is not None:
+                scores[deleted] = -np.inf
+            top_ids = top_k(scores, top_n)
+            top_scores = scores[top_ids]
+        else:
+            candidate_scores = np.asarray(embeddings[candidates]) @ query
+            positions = top_k(candidate_scores, top_n)
+            top_ids = candidates[positions]
+            top_scores = candidate_scores[positions]
+
+        return [
+            {
+                "_index": index_name,
+                "_id": str(i),
+                "_score": float(score) + 1.0,
+                "_source": sources[i],
+            }
+            for i, score in zip(top_ids, top_scores)
+            if score > -np.inf
+        ]
+
+    def search_batch(self, index_name, query_embeddings, top_n=5, exact=False, chunk_size=64, **kwargs):
+        """
+        Return the top_n passages of each of several query embeddings.
+
+        Unfiltered searches over an index without IVF or quantized codes score up to `chunk_size` queries
+        with one matrix product; other searches are run one query at a time.
+
+        Args:
+            index_name (str): The index to search in.
+            query_embeddings (array-like): The embedding vectors of the queries.
+            top_n (int, optional): The number of top results to retrieve per query. Defaults to 5.
+            exact (bool, optional): Score every row in float32. Defaults to False.
+            chunk_size (int, optional): Number of queries scored together. Defaults to 64.
+            **kwargs: Other options of `search`, e.g. `nprobe` or `filters`.
+
+        Returns:
+            list: The hits of each query, as returned by `search`.
+        """
+        embeddings, sources = self._load(index_name)
+        if not sources or top_n <= 0:
+            return [[] for _ in query_embeddings]
+
+        approximate = not exact and (self._load_ann(index_name) is not None
+                                     or kwargs.get("quantization") or self.quantization)
+        if kwargs.get("filters") or approximate:
+            return [self.search(index_name, query, top_n, exact=exact, **kwargs) for query in query_embeddings]
+
+        deleted = self._load_deleted(index_name)
+        queries = normalize_rows(np.asarray(query_embeddings, dtype=np.float32))
+        results = []
+        for start in range(0, len(queries), chunk_size):
+            scores = np.asarray(embeddings @ queries[start:start + chunk_size].T)
+            if deleted is not None:
+                scores[deleted] = -np.inf
+            for column in scores.T:
+                top_ids = top_k(column, top_n)
+                results.append([
+                    {
+                        "_index": index_name,
+                        "_id": str(i),
+                        "_score": float(column[i]) + 1.0,
+                        "_source": sources[i],
+                    }
+                    for i in top_ids
+                    if column[i] > -np.inf
+                ])
+        return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build a local search index from an embedding store or a passage/metadata/embedding CSV.")
+    parser.add_argument("data_path", nargs="?", default="../docs/passage_metadata_emb")
+    parser.add_argument("--index-dir", default="../docs/local_index")
+    parser.add_argument("--index-name", default="passage_metadata_emb")
+    args = parser.parse_args()
+
+    engine = LocalSearchEngine(args.index_dir)
+    engine.delete(args.index_name)
+    if os.path.isdir(args.data_path):
+        engine.index_store(args.data_path, args.index_name)
+    else:
+        engine.index_csv(args.data_path, args.index_name)
+    print(f"Successfully built local index {args.index_name} in {args.index_dir}")
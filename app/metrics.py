@@ -0,0 +1,195 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Histogram buckets for durations in seconds, for sizes in items or characters, and for cosine similarities
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+SIMILARITY_BUCKETS = (0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.92, 0.94, 0.95, 0.96, 0.97, 0.98, 0.99, 1.0)
+
+
+def _format_labels(names, values):
+    """Format label names and values as a Prometheus label set, e.g. `{stage="encode"}`."""
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Counter:
+    """A monotonically increasing count, optionally split by labels."""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, label_names=()):
+        """
+        Args:
+            name (str): Metric name.
+            documentation (str): One-line description shown in the exposition.
+            label_names (tuple, optional): Names of the labels every update must set. Defaults to none.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """Add `amount` to the count of the given label values."""
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        """Return (name, labels, value) exposition samples."""
+        with self._lock:
+            # An unlabelled counter is exposed from the start, so rates can be computed from zero
+            values = self._values or ({(): 0} if not self.label_names else {})
+            return [(self.name + "_total", _format_labels(self.label_names, key), value) for key, value in values.items()]
+
+
+class Histogram:
+    """A distribution of observed values in cumulative buckets, with their sum and count, optionally split by labels."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        """
+        Args:
+            name (str): Metric name.
+            documentation (str): One-line description shown in the exposition.
+            label_names (tuple, optional): Names of the labels every observation must set. Defaults to none.
+            buckets (tuple, optional): Sorted upper bounds of the buckets. Defaults to LATENCY_BUCKETS.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """Record one value for the given label values."""
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["buckets"][i] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def samples(self):
+        """Return (name, labels, value) exposition samples."""
+        samples = []
+        names = self.label_names + ("le",)
+        with self._lock:
+            for key, entry in self._values.items():
+                for bound, count in zip(self.buckets, entry["buckets"]):
+                    samples.append((self.name + "_bucket", _format_labels(names, key + (bound,)), count))
+                samples.append((self.name + "_bucket", _format_labels(names, key + ("+Inf",)), entry["count"]))
+                samples.append((self.name + "_sum", _format_labels(self.label_names, key), entry["sum"]))
+                samples.append((self.name + "_count", _format_labels(self.label_names, key), entry["count"]))
+        return samples
+
+
+class Registry:
+    """The set of metrics exposed together on one /metrics endpoint."""
+
+    def __init__(self):
+        self._metrics = []
+        self._gauges = []
+
+    def counter(self, name, documentation, label_names=()):
+        """Create and register a Counter."""
+        metric = Counter(name, documentation, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        """Create and register a Histogram."""
+        metric = Histogram(name, documentation, label_names, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation, collect):
+        """
+        Register a gauge whose values are read when the metrics are rendered.
+
+        Args:
+            name (str): Metric name.
+            documentation (str): One-line description shown in the exposition.
+            collect (callable): Returns a list of (label dict, value) pairs.
+        """
+        self._gauges.append((name, documentation, collect))
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {value}" for name, labels, value in metric.samples())
+        for name, documentation, collect in self._gauges:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in collect():
+                lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("queryquill_stage_seconds", "Time spent in each pipeline stage.", ("stage",))
+REQUEST_SECONDS = REGISTRY.histogram("queryquill_request_seconds", "HTTP request latency by endpoint.", ("endpoint",))
+REQUESTS = REGISTRY.counter("queryquill_requests", "HTTP requests by endpoint and status code.", ("endpoint", "status"))
+DOCUMENTS = REGISTRY.counter("queryquill_documents_processed", "Documents parsed for indexing.")
+CHUNKS = REGISTRY.counter("queryquill_chunks_processed", "Passages embedded and indexed.")
+HITS_RETURNED = REGISTRY.histogram("queryquill_hits_returned", "Hits returned per search.", buckets=SIZE_BUCKETS)
+PROMPT_CHARS = REGISTRY.histogram("queryquill_prompt_chars", "Characters per generation prompt.", buckets=SIZE_BUCKETS)
+PROMPT_TOKENS = REGISTRY.histogram("queryquill_prompt_tokens", "Estimated tokens per generation prompt.", buckets=SIZE_BUCKETS)
+SEMANTIC_CACHE_SIMILARITY = REGISTRY.histogram("queryquill_semantic_cache_similarity",
+                                               "Similarity of the closest cached question per semantic cache lookup, by outcome.",
+                                               ("outcome",), buckets=SIMILARITY_BUCKETS)
+CONTEXT_PASSAGES_DROPPED = REGISTRY.counter("queryquill_context_passages_dropped",
+                                            "Retrieved passages left out of or cut in prompts, by reason.", ("reason",))
+
+# Timings of the stages run while handling the current request, if tracing is on in this thread
+_local = threading.local()
+
+
+def start_trace():
+    """Start collecting a per-stage timing breakdown in the current thread."""
+    _local.timings = {}
+
+
+def finish_trace():
+    """Stop collecting timings in the current thread and return the breakdown in milliseconds."""
+    timings = getattr(_local, "timings", None) or {}
+    _local.timings = None
+    return {stage: round(seconds * 1000, 3) for stage, seconds in timings.items()}
+
+
+def record_stage(stage, seconds):
+    """Record the duration of a stage in the stage histogram and in the current trace."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = getattr(_local, "timings", None)
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def span(stage):
+    """
+    Time the body of a `with` block as one run of a pipeline stage.
+
+    Args:
+        stage (str): Stage name, e.g. "encode", "search" or "generate".
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
@@ -1,7 +1,221 @@
+import os
 import csv
-from sentence_transformers import SentenceTransformer
+import time
+import tempfile
+import numpy as np
+from embedding_store import EmbeddingStoreWriter
+from parsing import source_from_row
+from projection import PROJECTION_FILE, PROJECTION_PATH, load_projection
 
-def generate_embeddings_and_save(csv_input_path, csv_output_path, save_csv=True):
+MODEL_NAME = 'paraphrase-distilroberta-base-v1'
+
+# Inference runtimes the model can be run with: stock PyTorch, PyTorch with int8 dynamically quantized
+# Linear layers, ONNX Runtime, and ONNX Runtime with an int8 dynamically quantized graph. The ONNX
+# backends need `pip install "sentence-transformers[onnx]"`.
+EMBEDDING_BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+
+
+def _quantized_onnx_file(onnx_quantization):
+    return f"onnx/model_{_quantized_onnx_suffix(onnx_quantization)}.onnx"
+
+
+def _quantized_onnx_suffix(onnx_quantization):
+    return f"qint8_{onnx_quantization}"
+
+
+def _export_quantized_onnx(model, output_dir, onnx_quantization):
+    # The suffix is passed explicitly so the file is found under `_quantized_onnx_file` when loaded
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+    export_dynamic_quantized_onnx_model(model, onnx_quantization, output_dir,
+                                        file_suffix=_quantized_onnx_suffix(onnx_quantization))
+
+
+def load_model(model_name=MODEL_NAME, snapshot_dir=None, backend="torch", onnx_quantization="avx2"):
+    """
+    Load the SentenceTransformer model on an inference backend, preferring a local snapshot over the model hub.
+
+    sentence-transformers (and with it torch) is only imported here, so modules that merely pass a
+    model around stay cheap to import. Every backend returns a SentenceTransformer, so callers do not
+    depend on the runtime in use.
+
+    Args:
+        model_name (str, optional): Name of the model on the hub. Defaults to MODEL_NAME.
+        snapshot_dir (str, optional): Folder of a snapshot saved by `save_snapshot`. It is used if it
+            exists; otherwise the model is loaded by name. For "onnx-int8", a quantized graph missing
+            from the snapshot is exported into it. Defaults to None.
+        backend (str, optional): One of EMBEDDING_BACKENDS. Defaults to "torch".
+        onnx_quantization (str, optional): Target instruction set of the "onnx-int8" backend: "avx2",
+            "avx512", "avx512_vnni" or "arm64". Defaults to "avx2".
+
+    Returns:
+        SentenceTransformer: The loaded model.
+    """
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {backend}")
+
+    from sentence_transformers import SentenceTransformer
+
+    source = snapshot_dir if snapshot_dir and os.path.isdir(snapshot_dir) else model_name
+
+    if backend == "torch":
+        return SentenceTransformer(source)
+
+    if backend == "torch-int8":
+        import torch
+
+        # Swap the Linear layers for int8 dynamically quantized ones; activations stay in float
+        model = SentenceTransformer(source, device="cpu")
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    if backend == "onnx":
+        # Exports the model to ONNX on the fly if the source has no ONNX graph yet
+        return SentenceTransformer(source, backend="onnx")
+
+    file_name = _quantized_onnx_file(onnx_quantization)
+    if os.path.exists(os.path.join(source, file_name)):
+        return SentenceTransformer(source, backend="onnx", model_kwargs={"file_name": file_name})
+
+    # No quantized graph in the source yet: quantize into the snapshot so later starts reuse it,
+    # or into a scratch copy of the model that is removed once the graph is loaded
+    model = SentenceTransformer(source, backend="onnx")
+    if snapshot_dir:
+        model.save(snapshot_dir)
+        _export_quantized_onnx(model, snapshot_dir, onnx_quantization)
+        return SentenceTransformer(snapshot_dir, backend="onnx", model_kwargs={"file_name": file_name})
+    with tempfile.TemporaryDirectory(prefix="queryquill-onnx-") as export_dir:
+        model.save(export_dir)
+        _export_quantized_onnx(model, export_dir, onnx_quantization)
+        return SentenceTransformer(export_dir, backend="onnx", model_kwargs={"file_name": file_name})
+
+
+def save_snapshot(snapshot_dir, model_name=MODEL_NAME, backend="torch", onnx_quantization="avx2"):
+    """
+    Save the model to a local folder so it can be loaded without contacting the model hub.
+
+    For the ONNX backends the exported (and, for "onnx-int8", quantized) graph is saved too, so it is
+    not rebuilt at every start. The "torch-int8" backend quantizes at load time and saves the float model.
+    The snapshot is loaded back with `load_model` and checked to embed like the saved model.
+
+    Args:
+        snapshot_dir (str): Folder to save the model to.
+        model_name (str, optional): Name of the model on the hub, or a folder. Defaults to MODEL_NAME.
+        backend (str, optional): One of EMBEDDING_BACKENDS. Defaults to "torch".
+        onnx_quantization (str, optional): Target instruction set of the "onnx-int8" backend. Defaults to "avx2".
+    """
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, backend="onnx" if backend.startswith("onnx") else "torch")
+    model.save(snapshot_dir)
+    if backend == "onnx-int8":
+        _export_quantized_onnx(model, snapshot_dir, onnx_quantization)
+        if not os.path.exists(os.path.join(snapshot_dir, _quantized_onnx_file(onnx_quantization))):
+            raise RuntimeError(f"The quantized graph was not saved as {_quantized_onnx_file(onnx_quantization)}")
+    check_snapshot(snapshot_dir, model, backend, onnx_quantization)
+    print(f"Successfully saved {model_name} for the {backend} backend to {snapshot_dir}")
+
+
+def check_snapshot(snapshot_dir, model, backend="torch", onnx_quantization="avx2", min_similarity=0.95):
+    """
+    Check that a snapshot loads from its folder and embeds like the model it was saved from.
+
+    Args:
+        snapshot_dir (str): Folder the snapshot was saved to.
+        model (SentenceTransformer): The model that was saved.
+        backend (str, optional): One of EMBEDDING_BACKENDS. Defaults to "torch".
+        onnx_quantization (str, optional): Target instruction set of the "onnx-int8" backend. Defaults to "avx2".
+        min_similarity (float, optional): Lowest cosine similarity accepted between the embeddings of the
+            saved and the loaded model; int8 backends only approximate the float model. Defaults to 0.95.
+
+    Raises:
+        RuntimeError: If the loaded snapshot embeds differently.
+    """
+    probe = "The court dismissed the appeal and upheld the judgement of the lower court."
+    loaded = load_model(snapshot_dir=snapshot_dir, backend=backend, onnx_quantization=onnx_quantization)
+    expected = np.asarray(model.encode(probe), dtype=np.float32)
+    actual = np.asarray(loaded.encode(probe), dtype=np.float32)
+    similarity = float(expected @ actual / max(np.linalg.norm(expected) * np.linalg.norm(actual), 1e-12))
+    if expected.shape != actual.shape or similarity < min_similarity:
+        raise RuntimeError(f"The snapshot in {snapshot_dir} does not round-trip: cosine similarity {similarity:.4f}")
+
+
+def encode_passages(model, passages, batch_size=64, sort_by_length=True, pool=None):
+    """
+    Encode a list of passages in batches.
+
+    Args:
+        model (SentenceTransformer): The model used for generating embeddings.
+        passages (list): The passages to encode.
+        batch_size (int, optional): Number of passages per forward pass. Defaults to 64.
+        sort_by_length (bool, optional): Group passages of similar length into the same batch to cut
+            padding waste. The embeddings are returned in the original order. Defaults to True.
+        pool (dict, optional): A multi-process pool from `model.start_multi_process_pool()`. If given,
+            batches are spread over its worker processes. Defaults to None.
+
+    Returns:
+        np.ndarray: A (len(passages), dims) float32 array of embeddings.
+    """
+    if not passages:
+        return np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    order = np.argsort([-len(p) for p in passages], kind="stable") if sort_by_length else np.arange(len(passages))
+    ordered_passages = [passages[i] for i in order]
+
+    if pool is not None:
+        ordered_embeddings = model.encode_multi_process(ordered_passages, pool, batch_size=batch_size)
+    else:
+        ordered_embeddings = model.encode(ordered_passages, batch_size=batch_size, convert_to_numpy=True)
+
+    # Scatter the embeddings back into the original passage order
+    embeddings = np.empty_like(ordered_embeddings, dtype=np.float32)
+    embeddings[order] = ordered_embeddings
+    return embeddings
+
+
+def _embed_csv(model, csv_input_path, write_chunk, batch_size=64, sort_by_length=True, num_workers=0, chunk_size=10000):
+    """
+    Read a passage/metadata CSV in chunks, embed each chunk and hand it to `write_chunk`.
+
+    Args:
+        model (SentenceTransformer): The model used for generating embeddings.
+        csv_input_path (str): Path to the CSV file containing the passages and metadata.
+        write_chunk (callable): Called with (rows, embeddings) for every chunk.
+        batch_size (int, optional): Number of passages per forward pass. Defaults to 64.
+        sort_by_length (bool, optional): Sort passages by length before batching to reduce padding. Defaults to True.
+        num_workers (int, optional): Number of CPU worker processes used for encoding; 0 or 1 encodes in
+            this process. Defaults to 0.
+        chunk_size (int, optional): Number of CSV rows read and encoded at a time. Defaults to 10000.
+    """
+    pool = model.start_multi_process_pool(["cpu"] * num_workers) if num_workers > 1 else None
+    total_passages = 0
+    start = time.perf_counter()
+
+    def flush(rows):
+        embeddings = encode_passages(model, [row["Passage"] for row in rows], batch_size, sort_by_length, pool)
+        write_chunk(rows, embeddings)
+
+    try:
+        with open(csv_input_path, "r", encoding="utf-8") as csvfile:
+            reader = csv.DictReader(csvfile)
+            rows = []
+            for row in reader:
+                rows.append(row)
+                if len(rows) == chunk_size:
+                    flush(rows)
+                    total_passages += len(rows)
+                    rows = []
+            if rows:
+                flush(rows)
+                total_passages += len(rows)
+    finally:
+        if pool is not None:
+            model.stop_multi_process_pool(pool)
+
+    elapsed = time.perf_counter() - start
+    print(f"Embedded {total_passages} passages in {elapsed:.1f}s ({total_passages / max(elapsed, 1e-9):.1f} passages/s)")
+
+
+def generate_embeddings_and_save(csv_input_path, csv_output_path, save_csv=True, batch_size=64,
+                                 sort_by_length=True, num_workers=0, chunk_size=10000, backend="torch", projection=None):
     """
     Generate embeddings for passages from a CSV file and optionally save the embeddings to another CSV file.
 
@@ -9,38 +223,113 @@ def generate_embeddings_and_save(csv_input_path, csv_output_path, save_csv=True)
         csv_input_path (str): Path to the CSV file containing the passages and metadata.
         csv_output_path (str): Path to the CSV file where the passages, metadata, and embeddings will be saved.
         save_csv (bool, optional): Flag indicating if the embeddings should be saved to a CSV file. Defaults to True.
+        batch_size (int, optional): Number of passages per forward pass. Defaults to 64.
+        sort_by_length (bool, optional): Sort passages by length before batching to reduce padding. Defaults to True.
+        num_workers (int, optional): Number of CPU worker processes used for encoding; 0 or 1 encodes in
+            this process. Defaults to 0.
+        chunk_size (int, optional): Number of CSV rows read and encoded at a time. Defaults to 10000.
+        backend (str, optional): Inference backend, one of EMBEDDING_BACKENDS. Defaults to "torch".
+        projection (PCAProjection, optional): Reduce the embeddings with this projection before saving them,
+            as queries must then be (see `projection`). Defaults to None.
 
     Returns:
         SentenceTransformer: The SentenceTransformer model used for generating embeddings.
     """
-    
+
     # Load the SentenceTransformer model
-    model = SentenceTransformer('paraphrase-distilroberta-base-v1')
-    
+    model = load_model(backend=backend)
+
     # If save_csv is True, read the input CSV, generate embeddings, and write to the output CSV
     if save_csv:
-        with open(csv_input_path, "r", encoding="utf-8") as csvfile, open(csv_output_path, "w", newline='', encoding="utf-8") as outfile:
-            reader = csv.DictReader(csvfile)
-            
-            # Define the columns for the output CSV
-            fieldnames = ["Passage", "Metadata", "Embedding"]
+        with open(csv_input_path, "r", encoding="utf-8") as infile:
+            input_columns = next(csv.reader(infile))
+
+        with open(csv_output_path, "w", newline='', encoding="utf-8") as outfile:
+
+            # Keep the columns of the input CSV and add the embeddings
+            fieldnames = [column for column in input_columns if column != "Embedding"] + ["Embedding"]
             writer = csv.DictWriter(outfile, fieldnames=fieldnames)
             writer.writeheader()
 
-            for row in reader:
-                passage = row["Passage"]
-                metadata = row["Metadata"]
-                
-                # Generate embedding for the passage
-                embedding = model.encode(passage, convert_to_tensor=True).tolist()
-                
-                # Write the passage, metadata, and embedding to the output CSV
-                writer.writerow({
-                    "Passage": passage,
-                    "Metadata": metadata,
-                    "Embedding": embedding
-                })
-            
-            print(f"Successfully generated {csv_output_path}")
-    
+            def write_chunk(rows, embeddings):
+                # Write the passages, their document ids and offsets (or metadata), and embeddings to the output CSV
+                if projection is not None:
+                    embeddings = projection.transform(embeddings)
+                for row, embedding in zip(rows, embeddings):
+                    writer.writerow(dict(row, Embedding=embedding.tolist()))
+
+            _embed_csv(model, csv_input_path, write_chunk, batch_size, sort_by_length, num_workers, chunk_size)
+
+        print(f"Successfully generated {csv_output_path}")
+
     return model
+
+
+def generate_embeddings_to_store(csv_input_path, store_dir, dtype="float32", batch_size=64,
+                                 sort_by_length=True, num_workers=0, chunk_size=10000, backend="torch", projection=None):
+    """
+    Generate embeddings for passages from a CSV file and write them to a binary embedding store.
+
+    Args:
+        csv_input_path (str): Path to the CSV file containing the passages and metadata.
+        store_dir (str): Folder of the embedding store to write (see `embedding_store`).
+        dtype (str, optional): Storage type, "float32" or "float16". Defaults to "float32".
+        batch_size (int, optional): Number of passages per forward pass. Defaults to 64.
+        sort_by_length (bool, optional): Sort passages by length before batching to reduce padding. Defaults to True.
+        num_workers (int, optional): Number of CPU worker processes used for encoding; 0 or 1 encodes in
+            this process. Defaults to 0.
+        chunk_size (int, optional): Number of CSV rows read and encoded at a time. Defaults to 10000.
+        backend (str, optional): Inference backend, one of EMBEDDING_BACKENDS. Defaults to "torch".
+        projection (PCAProjection, optional): Reduce the embeddings with this projection before saving them,
+            as queries must then be (see `projection`). Defaults to None.
+
+    Returns:
+        SentenceTransformer: The SentenceTransformer model used for generating embeddings.
+    """
+
+    # Load the SentenceTransformer model
+    model = load_model(backend=backend)
+
+    with EmbeddingStoreWriter(store_dir, dtype) as writer:
+        def write_chunk(rows, embeddings):
+            if projection is not None:
+                embeddings = projection.transform(embeddings)
+            writer.write([source_from_row(row) for row in rows], embeddings)
+
+        _embed_csv(model, csv_input_path, write_chunk, batch_size, sort_by_length, num_workers, chunk_size)
+
+    # Keep the projection next to the store, so the store says how queries must be projected
+    if projection is not None:
+        projection.save(os.path.join(store_dir, PROJECTION_FILE))
+
+    print(f"Successfully generated {store_dir}")
+    return model
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate embeddings for a passage/metadata CSV.")
+    parser.add_argument("csv_input_path", nargs="?", default="../docs/passage_metadata.csv")
+    parser.add_argument("output_path", nargs="?", default="../docs/passage_metadata_emb",
+                        help="Embedding store folder, or a .csv file for the legacy CSV format")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=0, help="Number of CPU worker processes")
+    parser.add_argument("--no-sort", action="store_true", help="Keep the CSV order instead of length-sorted batches")
+    parser.add_argument("--backend", choices=EMBEDDING_BACKENDS, default=os.getenv("EMBEDDING_BACKEND", "torch"))
+    parser.add_argument("--save-snapshot", metavar="DIR", help="Only save the model (for --backend) to DIR for fast local loading, e.g. ../docs/model_snapshot")
+    parser.add_argument("--projection", default=PROJECTION_PATH, help="PCA projection (.npz) to reduce the embeddings with, see projection.py")
+    args = parser.parse_args()
+    projection = load_projection(args.projection)
+
+    if args.save_snapshot:
+        save_snapshot(args.save_snapshot, backend=args.backend, onnx_quantization=os.getenv("ONNX_QUANTIZATION", "avx2"))
+    elif args.output_path.endswith(".csv"):
+        generate_embeddings_and_save(args.csv_input_path, args.output_path, batch_size=args.batch_size,
+                                     sort_by_length=not args.no_sort, num_workers=args.workers, backend=args.backend,
+                                     projection=projection)
+    else:
+        generate_embeddings_to_store(args.csv_input_path, args.output_path, dtype=args.dtype, batch_size=args.batch_size,
+                                     sort_by_length=not args.no_sort, num_workers=args.workers, backend=args.backend,
+                                     projection=projection)
@@ -0,0 +1,124 @@
+import time
+import numpy as np
+from model import encode_passages
+from vectors import normalize_rows, top_k
+
+
+def _timed_encode(model, passages, batch_size):
+    start = time.perf_counter()
+    embeddings = encode_passages(model, passages, batch_size=batch_size)
+    return normalize_rows(embeddings), time.perf_counter() - start
+
+
+def _query_latencies_ms(model, queries):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        model.encode(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def parity_report(baseline, candidate, passages, queries, top_n=5, batch_size=64):
+    """
+    Compare the embeddings and retrieval results of a candidate inference backend with a baseline.
+
+    Args:
+        baseline (SentenceTransformer): The reference model, normally on the "torch" backend.
+        candidate (SentenceTransformer): The same model on the backend under evaluation.
+        passages (list): Passages to embed and retrieve from.
+        queries (list): Questions to retrieve passages for.
+        top_n (int, optional): The k in the top-k overlap. Defaults to 5.
+        batch_size (int, optional): Number of passages per forward pass. Defaults to 64.
+
+    Returns:
+        dict: Cosine similarity between the two embeddings of each passage (`cosine_mean`, `cosine_min`,
+        `cosine_p1`), the mean fraction of the baseline top-k found by the candidate (`top_k_overlap`),
+        the fraction of queries with the same top hit (`top_1_agreement`), and the throughput and
+        single-query latency of both backends.
+    """
+    baseline_passages, baseline_seconds = _timed_encode(baseline, passages, batch_size)
+    candidate_passages, candidate_seconds = _timed_encode(candidate, passages, batch_size)
+    cosines = np.sum(baseline_passages * candidate_passages, axis=1)
+
+    # Each backend retrieves from its own passage embeddings, as it would in production
+    baseline_queries = normalize_rows(encode_passages(baseline, queries, batch_size=batch_size))
+    candidate_queries = normalize_rows(encode_passages(candidate, queries, batch_size=batch_size))
+    overlaps, same_top = [], []
+    for baseline_query, candidate_query in zip(baseline_queries, candidate_queries):
+        expected = top_k(baseline_passages @ baseline_query, top_n)
+        found = top_k(candidate_passages @ candidate_query, top_n)
+        overlaps.append(len(set(expected) & set(found)) / len(expected))
+        same_top.append(expected[0] == found[0])
+
+    baseline_latencies = _query_latencies_ms(baseline, queries)
+    candidate_latencies = _query_latencies_ms(candidate, queries)
+
+    return {
+        "passages": len(passages),
+        "queries": len(queries),
+        "cosine_mean": float(cosines.mean()),
+        "cosine_min": float(cosines.min()),
+        "cosine_p1": float(np.percentile(cosines, 1)),
+        "top_k_overlap": float(np.mean(overlaps)),
+        "top_1_agreement": float(np.mean(same_top)),
+        "baseline_passages_per_s": len(passages) / max(baseline_seconds, 1e-9),
+        "candidate_passages_per_s": len(passages) / max(candidate_seconds, 1e-9),
+        "baseline_query_p50_ms": float(np.percentile(baseline_latencies, 50)),
+        "candidate_query_p50_ms": float(np.percentile(candidate_latencies, 50)),
+        "encode_speedup": baseline_seconds / max(candidate_seconds, 1e-9)
+    }
+
+
+if __name__ == "__main__":
+    import os
+    import csv
+    import sys
+    import json
+    import argparse
+    import tempfile
+    from model import EMBEDDING_BACKENDS, MODEL_NAME, load_model
+
+    parser = argparse.ArgumentParser(description="Check that an embedding backend agrees with the PyTorch baseline before adopting it.")
+    parser.add_argument("--backend", choices=EMBEDDING_BACKENDS, default="onnx-int8", help="Backend under evaluation")
+    parser.add_argument("--baseline", choices=EMBEDDING_BACKENDS, default="torch")
+    parser.add_argument("--onnx-quantization", default=os.getenv("ONNX_QUANTIZATION", "avx2"))
+    parser.add_argument("--csv", help="Passage CSV with a Passage column, e.g. ../docs/passage_metadata.csv. Defaults to a synthetic corpus")
+    parser.add_argument("--questions", help="Text file with one question per line. Defaults to questions built from the passages")
+    parser.add_argument("--limit", type=int, default=2000, help="Maximum number of passages")
+    parser.add_argument("--top-n", type=int, default=5)
+    parser.add_argument("--min-cosine", type=float, default=0.99, help="Fail if the mean cosine agreement is lower")
+    parser.add_argument("--min-overlap", type=float, default=0.9, help="Fail if the mean top-k overlap is lower")
+    args = parser.parse_args()
+
+    if args.csv:
+        csv.field_size_limit(sys.maxsize)
+        with open(args.csv, encoding="utf-8") as f:
+            passages = [row["Passage"] for _, row in zip(range(args.limit), csv.DictReader(f))]
+        questions = None
+    else:
+        from benchmark import generate_corpus
+        from parsing import list_documents
+        from pipeline import parse_to_sources
+
+        with tempfile.TemporaryDirectory(prefix="queryquill-parity-") as corpus_dir:
+            labelled = generate_corpus(corpus_dir, n_docs=max(args.limit // 8, 1))
+            passages = [source["Passage"] for txt in list_documents(corpus_dir) for source in parse_to_sources(corpus_dir, txt)][:args.limit]
+        questions = [query["question"] for query in labelled]
+
+    if args.questions:
+        with open(args.questions, encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+    elif questions is None:
+        # Use the first sentence of every tenth passage as a question
+        questions = [passage.split(". ")[0] for passage in passages[::10]]
+
+    baseline = load_model(MODEL_NAME, backend=args.baseline)
+    candidate = load_model(MODEL_NAME, backend=args.backend, onnx_quantization=args.onnx_quantization)
+    report = parity_report(baseline, candidate, passages, questions, args.top_n)
+    print(json.dumps(dict(report, baseline=args.baseline, backend=args.backend), indent=2))
+
+    if report["cosine_mean"] < args.min_cosine or report["top_k_overlap"] < args.min_overlap:
+        print(f"{args.backend} does not match {args.baseline} closely enough")
+        sys.exit(1)
+    print(f"{args.backend} matches {args.baseline}")
@@ -1,62 +1,551 @@
 import os
 import csv
 import json
+import datetime
+import threading
+import numpy as np
 
-def process_folder(folder_path, out_folder):
+# Typed metadata fields extracted at ingestion time, so searches can be filtered by them
+METADATA_FIELDS = {
+    "DocId": "keyword",
+    "Title": "keyword",
+    "Court": "keyword",
+    "CaseType": "keyword",
+    "Judges": "keyword",
+    "Citation": "keyword",
+    "Source": "keyword",
+    "Year": "integer",
+    "JudgementDate": "date"
+}
+
+def list_documents(folder_path):
     """
-    Process a folder containing pairs of .txt and .json files. Extract passages from the .txt files, 
-    metadata from the .json files, and write pairings to a CSV file.
-    
+    List the technical text files of a folder, each of which is paired with a metadata file.
+
     Args:
         folder_path (str): Path to the folder containing the files.
-        out_folder (str): Path to the output folder for saving the generated CSV.
 
     Returns:
-        None
+        list: Sorted names of the `_Technical.txt` files.
+    """
+    return sorted(f for f in os.listdir(folder_path) if f.endswith('_Technical.txt'))
+
+
+def metadata_file_for(txt_file):
+    """Return the name of the `_Metadata.json` file paired with a `_Technical.txt` file."""
+    return txt_file.replace('_Technical.txt', '_Metadata.json')
+
+
+def document_id(txt_file):
+    """Return the document id of a `_Technical.txt` file: its name without the suffix."""
+    return txt_file[:-len('_Technical.txt')]
+
+
+# Chunking of technical documents into passages: "sentences" packs five sentences per passage, "tokens"
+# packs whole sentences up to CHUNK_MAX_TOKENS tokens of the embedding model's tokenizer (its maximum
+# sequence length, special tokens included), repeating up to CHUNK_OVERLAP_TOKENS tokens of trailing
+# sentences at the start of the next passage. The tokenizer is read from TOKENIZER_PATH, by default the
+# model snapshot if one was saved, otherwise the hub.
+CHUNKING = os.getenv("CHUNKING", "sentences")
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "128"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "0"))
+TOKENIZER_PATH = os.getenv("TOKENIZER_PATH", "")
+CHUNKING_MODES = ("sentences", "tokens")
+
+
+def iter_paragraphs(content):
+    """
+    Yield the paragraphs of a technical document, in order.
+
+    Args:
+        content (str): The raw file content with `__section__` and `__paragraph__` markers.
+
+    Yields:
+        str: The stripped, non-empty paragraphs.
+    """
+    for section in content.split("__section__"):
+        for paragraph in section.split("__paragraph__")[1:]:
+            paragraph = paragraph.strip()
+            if paragraph:
+                yield paragraph
+
+
+def split_sentences(paragraph):
+    """Split a paragraph into sentences on `'. '`, keeping the full stop of each sentence."""
+    sentences = paragraph.split('. ')
+    return [sentence + "." for sentence in sentences[:-1]] + sentences[-1:]
+
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def load_tokenizer(name_or_path=None):
+    """
+    Load the tokenizer of the embedding model once per process.
+
+    Args:
+        name_or_path (str, optional): A tokenizer folder or hub name. Defaults to TOKENIZER_PATH, the saved
+            model snapshot (MODEL_SNAPSHOT_DIR) if it exists, or the model on the hub.
+
+    Returns:
+        PreTrainedTokenizerFast: The tokenizer.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                from transformers import AutoTokenizer
+                from model import MODEL_NAME
+
+                snapshot_dir = os.getenv("MODEL_SNAPSHOT_DIR", "../docs/model_snapshot")
+                if not name_or_path:
+                    name_or_path = TOKENIZER_PATH or (snapshot_dir if os.path.isdir(snapshot_dir) else f"sentence-transformers/{MODEL_NAME}")
+                _tokenizer = AutoTokenizer.from_pretrained(name_or_path)
+    return _tokenizer
+
+
+class TokenChunker:
+    """
+    Packs the sentences of a document into passages of at most `max_tokens` model tokens.
+
+    Sentences are tokenized once, a paragraph at a time, and packed greedily, so chunking is a single
+    linear pass that never holds more than one paragraph and one passage in memory. A sentence longer
+    than the budget is cut at token boundaries. With `overlap_tokens`, the trailing sentences of a
+    passage that fit in that many tokens are repeated at the start of the next one.
+    """
+
+    def __init__(self, tokenizer, max_tokens=128, overlap_tokens=0):
+        """
+        Args:
+            tokenizer (PreTrainedTokenizerFast): The tokenizer of the embedding model.
+            max_tokens (int, optional): Token budget of a passage, special tokens included; normally the
+                model's maximum sequence length. Defaults to 128.
+            overlap_tokens (int, optional): Tokens of trailing sentences repeated in the next passage. Defaults to 0.
+        """
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.budget = max_tokens - tokenizer.num_special_tokens_to_add()
+        if self.budget <= 0:
+            raise ValueError(f"max_tokens must be larger than the {tokenizer.num_special_tokens_to_add()} special tokens")
+        if not 0 <= overlap_tokens < self.budget // 2:
+            raise ValueError(f"overlap_tokens must be between 0 and {self.budget // 2 - 1}")
+        self.overlap_tokens = overlap_tokens
+
+    def _pieces(self, paragraph):
+        """Yield (sentence, token count) pairs of a paragraph, cutting sentences longer than the budget."""
+        sentences = split_sentences(paragraph)
+        # Count tokens with a leading space, as a sentence inside a passage follows one
+        encoded = self.tokenizer([" " + sentence for sentence in sentences], add_special_tokens=False,
+                                 return_offsets_mapping=True)
+        for sentence, ids, offsets in zip(sentences, encoded["input_ids"], encoded["offset_mapping"]):
+            if len(ids) <= self.budget:
+                yield sentence, len(ids)
+                continue
+            for start in range(0, len(ids), self.budget):
+                end = min(start + self.budget, len(ids))
+                # Offsets are into the sentence with its leading space
+                piece = sentence[max(offsets[start][0] - 1, 0):offsets[end - 1][1] - 1].strip()
+                if piece:
+                    yield piece, end - start
+
+    def chunks(self, content):
+        """
+        Chunk a technical document.
+
+        Args:
+            content (str): The raw file content with `__section__` and `__paragraph__` markers.
+
+        Yields:
+            tuple: (passage, token count) pairs, where the count excludes special tokens.
+        """
+        current, tokens = [], 0
+        for paragraph in iter_paragraphs(content):
+            for sentence, count in self._pieces(paragraph):
+                if current and tokens + count > self.budget:
+                    yield " ".join(sentence for sentence, _ in current), tokens
+
+                    # Carry over the trailing sentences that fit in the overlap, as long as the new sentence still fits
+                    overlap, overlap_tokens = [], 0
+                    for previous in reversed(current):
+                        if overlap_tokens + previous[1] > min(self.overlap_tokens, self.budget - count):
+                            break
+                        overlap.insert(0, previous)
+                        overlap_tokens += previous[1]
+                    current, tokens = overlap, overlap_tokens
+
+                current.append((sentence, count))
+                tokens += count
+        if current:
+            yield " ".join(sentence for sentence, _ in current), tokens
+
+
+_token_chunker = None
+
+
+def get_token_chunker():
+    """Return the TokenChunker configured by CHUNK_MAX_TOKENS and CHUNK_OVERLAP_TOKENS."""
+    global _token_chunker
+    if _token_chunker is None:
+        _token_chunker = TokenChunker(load_tokenizer(), CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS)
+    return _token_chunker
+
+
+def chunking_signature():
+    """Return a string identifying the chunking configuration, so ingestion can re-chunk documents when it changes."""
+    if CHUNKING == "tokens":
+        return f"tokens:{CHUNK_MAX_TOKENS}:{CHUNK_OVERLAP_TOKENS}:{TOKENIZER_PATH}"
+    return CHUNKING
+
+
+def chunk_document(content, chunking=None):
+    """
+    Split the text of a technical document into passages with the configured chunking mode.
+
+    Args:
+        content (str): The raw file content with `__section__` and `__paragraph__` markers.
+        chunking (str, optional): "sentences" or "tokens". Defaults to CHUNKING.
+
+    Returns:
+        list: The passages.
+    """
+    chunking = chunking or CHUNKING
+    if chunking == "tokens":
+        return [passage for passage, _ in get_token_chunker().chunks(content)]
+    if chunking == "sentences":
+        return chunk_text(content)
+    raise ValueError(f"Unknown chunking mode {chunking!r}, expected one of {CHUNKING_MODES}")
+
+
+def chunk_length_stats(token_counts, max_tokens=CHUNK_MAX_TOKENS):
     """
+    Summarize the lengths of the passages of a corpus.
+
+    Args:
+        token_counts (list): Number of tokens of each passage, special tokens excluded.
+        max_tokens (int, optional): The model's maximum sequence length, special tokens included. Defaults to CHUNK_MAX_TOKENS.
+
+    Returns:
+        dict: The number of `passages` and `tokens`, the mean, percentiles and maximum passage length, and the
+        fraction of passages the model truncates together with the fraction of all tokens it never sees.
+    """
+    counts = np.asarray(token_counts, dtype=np.int64)
+    if len(counts) == 0:
+        return {"passages": 0, "tokens": 0}
+
+    budget = max_tokens - load_tokenizer().num_special_tokens_to_add()
+    return {
+        "passages": int(len(counts)),
+        "tokens": int(counts.sum()),
+        "mean_tokens": float(counts.mean()),
+        "p5_tokens": float(np.percentile(counts, 5)),
+        "p50_tokens": float(np.percentile(counts, 50)),
+        "p95_tokens": float(np.percentile(counts, 95)),
+        "max_tokens": int(counts.max()),
+        "truncated_passages": float(np.mean(counts > budget)),
+        "truncated_tokens": float(np.maximum(counts - budget, 0).sum() / max(counts.sum(), 1))
+    }
+
+
+def chunk_text(content):
+    """
+    Split the text of a technical document into passages of five sentences.
+
+    Args:
+        content (str): The raw file content with `__section__` and `__paragraph__` markers.
+
+    Returns:
+        list: The passages.
+    """
+    sections_list = [s.strip() for s in content.split("__section__") if s.strip()]
     
-    all_pairings = []
+    # Split sections into paragraphs
+    refined_paragraphs = []
+    for section in sections_list:
+        paragraphs = section.split("__paragraph__")[1:]
+        refined_paragraphs.extend([p.strip() for p in paragraphs if p.strip()])
     
-    # Get all .txt and .json files in the folder
-    txt_files = [f for f in os.listdir(folder_path) if f.endswith('_Technical.txt')]
-    json_files = [f.replace('_Technical.txt', '_Metadata.json') for f in txt_files]
-
-    for txt_file, json_file in zip(txt_files, json_files):
-        
-        # Extract passages from .txt file
-        with open(os.path.join(folder_path, txt_file), "r", encoding="utf-8") as file:
-            content = file.read()
-        sections_list = [s.strip() for s in content.split("__section__") if s.strip()]
-        
-        # Split sections into paragraphs
-        refined_paragraphs = []
-        for section in sections_list:
-            paragraphs = section.split("__paragraph__")[1:]
-            refined_paragraphs.extend([p.strip() for p in paragraphs if p.strip()])
-        
-        # Combine paragraphs and split into sentences
-        combined_passage = " ".join(refined_paragraphs)
-        sentences = combined_passage.split('. ')
-        
-        # Create chunks of five sentences each
-        chunks_of_five_sentences = [". ".join(sentences[i:i+5]) + "." for i in range(0, len(sentences), 5)]
-        
-        # Extract metadata from .json file
-        with open(os.path.join(folder_path, json_file), "r", encoding="utf-8") as metadata_file:
-            metadata = json.load(metadata_file)
-        
-        # Create pairings of passages and metadata
-        for passage in chunks_of_five_sentences:
-            all_pairings.append({"Passage": passage, "Metadata": json.dumps(metadata)})
+    # Combine paragraphs and split into sentences
+    combined_passage = " ".join(refined_paragraphs)
+    sentences = combined_passage.split('. ')
     
-    # Write all_pairings to a CSV file
+    # Create chunks of five sentences each
+    return [". ".join(sentences[i:i+5]) + "." for i in range(0, len(sentences), 5)]
+
+
+def document_body(content):
+    """Return the text of a technical document without its markers: its paragraphs joined by spaces."""
+    return " ".join(iter_paragraphs(content))
+
+
+def locate_passages(body, passages):
+    """
+    Find the character offsets of passages in the body of their document, in one forward scan.
+
+    Passages of either chunking mode are contiguous spans of the body, apart from the full stop
+    the sentence chunker appends; overlapping passages are found as well.
+
+    Args:
+        body (str): The document body (see `document_body`).
+        passages (list): The passages of the document, in order.
+
+    Returns:
+        list: (start, end) offsets of each passage in `body`, or (None, None) if it was not found.
+    """
+    offsets = []
+    cursor = 0
+    for passage in passages:
+        text = passage.rstrip(".") or passage
+        start = body.find(text[:200], cursor)
+        if start < 0:
+            offsets.append((None, None))
+            continue
+        end = min(start + len(passage), len(body))
+        offsets.append((start, end))
+        cursor = start + 1
+    return offsets
+
+
+def parse_chunks(folder_path, txt_file):
+    """
+    Parse one document into the sources of its passages and the metadata of the document.
+
+    Passages carry the id of their document, their position in it and the typed filter fields of its
+    metadata, but not the metadata itself, which is stored once per document (see `documents`).
+
+    Args:
+        folder_path (str): Path to the folder containing the files.
+        txt_file (str): Name of the `_Technical.txt` file.
+
+    Returns:
+        tuple: (sources, metadata) where sources is a list of {"DocId", "Chunk", "Start", "End", "Passage"}
+        dicts with the fields of `extract_metadata_fields`, and metadata the parsed JSON.
+    """
+    with open(os.path.join(folder_path, txt_file), "r", encoding="utf-8") as file:
+        content = file.read()
+    passages = chunk_document(content)
+    offsets = locate_passages(document_body(content), passages)
+
+    with open(os.path.join(folder_path, metadata_file_for(txt_file)), "r", encoding="utf-8") as metadata_file:
+        metadata = json.load(metadata_file)
+
+    fields = extract_metadata_fields(metadata)
+    doc_id = document_id(txt_file)
+    sources = [
+        dict(fields, DocId=doc_id, Chunk=i, Start=start, End=end, Passage=passage)
+        for i, (passage, (start, end)) in enumerate(zip(passages, offsets))
+    ]
+    return sources, metadata
+
+
+# Columns of passage CSV files holding integers, and the filter fields holding lists (stored as JSON)
+INTEGER_COLUMNS = ("Chunk", "Start", "End", "Year")
+LIST_COLUMNS = ("Judges",)
+
+
+def source_from_row(row):
+    """
+    Return the passage source of a row of a passage CSV file, without its embedding.
+
+    Both the normalized columns (`DocId`, `Chunk`, `Start`, `End`, `Passage` and the typed filter fields)
+    and the legacy `Passage`/`Metadata` columns are carried over.
+
+    Args:
+        row (dict): A row read with csv.DictReader.
+
+    Returns:
+        dict: The source.
+    """
+    source = {}
+    for column, value in row.items():
+        if column == "Embedding" or value is None or value == "":
+            continue
+        if column in INTEGER_COLUMNS:
+            value = int(value)
+        elif column in LIST_COLUMNS:
+            value = json.loads(value)
+        source[column] = value
+    return source
+
+
+def extract_metadata_fields(metadata):
+    """
+    Extract the typed filter fields of a document from its metadata.
+
+    Args:
+        metadata (dict): The parsed `_Metadata.json` content.
+
+    Returns:
+        dict: The fields of METADATA_FIELDS (other than DocId) that have a value.
+    """
+    def get(*path):
+        value = metadata
+        for key in path:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+
+    title = get("title")
+    if isinstance(title, dict):
+        title = title.get("short") or title.get("long")
+
+    judges = [judge for judge in [get("presidingJudge")] + list(get("judges") or []) if isinstance(judge, str) and judge]
+
+    date = get("judgement", "date")
+    date = date[:10] if isinstance(date, str) and date else None
+    year = get("judgement", "year") or (int(date[:4]) if date else None)
+
+    fields = {
+        "Title": title,
+        "Court": get("court", "name"),
+        "CaseType": get("caseId", "type"),
+        "Judges": judges,
+        "Citation": get("mediaNeutralCitation"),
+        "Source": get("source"),
+        "Year": year,
+        "JudgementDate": date
+    }
+    return {field: value for field, value in fields.items() if value not in (None, "", [])}
+
+
+def add_metadata_fields(source):
+    """
+    Return a passage source with the typed filter fields derived from its Metadata JSON.
+
+    Sources that already carry filter fields are returned unchanged.
+
+    Args:
+        source (dict): A {"Passage", "Metadata", ...} dict.
+
+    Returns:
+        dict: The source with the fields of `extract_metadata_fields` added.
+    """
+    if any(field in source for field in METADATA_FIELDS if field != "DocId"):
+        return source
+    try:
+        metadata = json.loads(source["Metadata"])
+    except (KeyError, TypeError, ValueError):
+        return source
+    if not isinstance(metadata, dict):
+        return source
+    return dict(source, **extract_metadata_fields(metadata))
+
+
+# Bounds a range filter may set
+RANGE_OPERATORS = ("gte", "gt", "lte", "lt")
+
+
+def _filter_value(field, value):
+    """Return a filter value converted to the type of its field, or raise ValueError if it does not have it."""
+    field_type = METADATA_FIELDS[field]
+    if field_type == "integer":
+        if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+            return int(value)
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        raise ValueError(f"{field} takes integers, got {value!r}")
+    if field_type == "date":
+        try:
+            return datetime.date.fromisoformat(value).isoformat()
+        except (TypeError, ValueError):
+            raise ValueError(f"{field} takes dates as YYYY-MM-DD, got {value!r}") from None
+    if not isinstance(value, str):
+        raise ValueError(f"{field} takes strings, got {value!r}")
+    return value
+
+
+def validate_filter(filters):
+    """
+    Check a metadata filter and convert its values to the types of their fields.
+
+    Args:
+        filters (dict): Maps a field of METADATA_FIELDS to a value, a list of accepted values, or (for
+            integer and date fields) a range given as a dict with any of `gte`, `gt`, `lte` and `lt`.
+
+    Returns:
+        dict: The filter, with integers given as strings converted to int.
+
+    Raises:
+        ValueError: If the filter is not a dict, names an unknown field, or a value does not have the type of its field.
+    """
+    if not isinstance(filters, dict):
+        raise ValueError(f"A filter must be an object mapping fields to values, got {filters!r}")
+
+    validated = {}
+    for field, condition in filters.items():
+        if field not in METADATA_FIELDS:
+            raise ValueError(f"Unknown filter field: {field}")
+        if isinstance(condition, dict):
+            if METADATA_FIELDS[field] == "keyword":
+                raise ValueError(f"Range filters are not supported on keyword field: {field}")
+            unknown = set(condition) - set(RANGE_OPERATORS)
+            if not condition or unknown:
+                raise ValueError(f"A range on {field} takes any of {', '.join(RANGE_OPERATORS)}, got {sorted(condition)}")
+            validated[field] = {operator: _filter_value(field, value) for operator, value in condition.items()}
+        elif isinstance(condition, (list, tuple)):
+            if not condition:
+                raise ValueError(f"The list of accepted values of {field} is empty")
+            validated[field] = [_filter_value(field, value) for value in condition]
+        else:
+            validated[field] = _filter_value(field, condition)
+    return validated
+
+
+def process_folder(folder_path, out_folder, document_store_path=None):
+    """
+    Process a folder containing pairs of .txt and .json files. Extract passages from the .txt files and write
+    them to a CSV file, and store the metadata of the .json files once per document in a document table.
+
+    Args:
+        folder_path (str): Path to the folder containing the files.
+        out_folder (str): Path to the output folder for saving the generated CSV.
+        document_store_path (str, optional): Path to the document table (see `documents`). Defaults to
+            `documents.sqlite` in `out_folder`.
+
+    Returns:
+        None
+    """
+    from documents import DocumentStore
+
+    documents = DocumentStore(document_store_path or os.path.join(out_folder, "documents.sqlite"))
     csv_filename = os.path.join(out_folder, "passage_metadata.csv")
     with open(csv_filename, "w", newline='', encoding="utf-8") as csvfile:
-        fieldnames = ["Passage", "Metadata"]
+        fieldnames = ["DocId", "Chunk", "Start", "End", "Passage"] + [field for field in METADATA_FIELDS if field != "DocId"]
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writeheader()
-        for pairing in all_pairings:
-            writer.writerow(pairing)
+
+        # Write the passages of each document as soon as it is parsed; list-valued filter fields are stored as JSON
+        for txt_file in list_documents(folder_path):
+            sources, metadata = parse_chunks(folder_path, txt_file)
+            documents.put(document_id(txt_file), metadata)
+            writer.writerows({field: json.dumps(value) if isinstance(value, list) else value for field, value in source.items()}
+                             for source in sources)
 
     print(f"Successfully generated {csv_filename}")
 
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Report passage length statistics of a corpus folder for each chunking mode.")
+    parser.add_argument("folder_path", nargs="?", default="../docs/corpus")
+    parser.add_argument("--chunking", choices=CHUNKING_MODES, nargs="+", default=list(CHUNKING_MODES))
+    parser.add_argument("--max-tokens", type=int, default=CHUNK_MAX_TOKENS, help="Token budget of a passage; the model's maximum sequence length")
+    parser.add_argument("--overlap", type=int, default=CHUNK_OVERLAP_TOKENS, help="Tokens of overlap between consecutive passages")
+    args = parser.parse_args()
+
+    tokenizer = load_tokenizer()
+    _token_chunker = TokenChunker(tokenizer, args.max_tokens, args.overlap)
+    txt_files = list_documents(args.folder_path)
+    for chunking in args.chunking:
+        counts = []
+        for txt_file in txt_files:
+            with open(os.path.join(args.folder_path, txt_file), "r", encoding="utf-8") as file:
+                content = file.read()
+            if chunking == "tokens":
+                counts.extend(count for _, count in _token_chunker.chunks(content))
+            else:
+                passages = chunk_text(content)
+                counts.extend(len(ids) for ids in tokenizer(passages, add_special_tokens=False)["input_ids"])
+        print(chunking, json.dumps(chunk_length_stats(counts, args.max_tokens), indent=2))
@@ -0,0 +1,275 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from metrics import CHUNKS, DOCUMENTS, record_stage
+from model import encode_passages
+from parsing import document_id, list_documents, parse_chunks
+
+# Marks the end of a stream between two stages
+_DONE = object()
+
+
+def parse_to_sources(folder_path, txt_file):
+    """
+    Parse one document into the sources of its passages.
+
+    Args:
+        folder_path (str): Path to the folder containing the files.
+        txt_file (str): Name of the `_Technical.txt` file.
+
+    Returns:
+        list: List of {"DocId", "Chunk", "Start", "End", "Passage"} dicts with the typed metadata fields added.
+    """
+    return parse_chunks(folder_path, txt_file)[0]
+
+
+class _Stage(threading.Thread):
+    """A pipeline stage running in its own thread, recording how long it spent working."""
+
+    def __init__(self, name, target, errors):
+        super().__init__(name=name, daemon=True)
+        self._target_fn = target
+        self._errors = errors
+        self.busy = 0.0
+
+    def run(self):
+        try:
+            self._target_fn(self)
+        except BaseException as e:
+            self._errors.append(e)
+
+
+def _put(q, item, errors):
+    """Put an item on a bounded queue, giving up if another stage has failed."""
+    while True:
+        if errors:
+            raise RuntimeError("Pipeline aborted")
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _get(q, errors):
+    """Get an item from a bounded queue, giving up if another stage has failed."""
+    while True:
+        if errors:
+            raise RuntimeError("Pipeline aborted")
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+
+def run_pipeline(folder_path, model, sink, txt_files=None, parse_workers=None, batch_size=64,
+                 sink_batch_size=500, queue_size=8, documents=None):
+    """
+    Stream documents through parsing, batched embedding and a sink, with the stages overlapping.
+
+    Documents are parsed in parallel worker processes, their passages are embedded in batches as
+    soon as enough of them are available, and embedded passages are handed to `sink` in groups.
+    The stages are connected by bounded queues, so a slow stage holds the others back instead of
+    letting work pile up in memory, and peak memory does not depend on the size of the corpus.
+
+    Args:
+        folder_path (str): Path to the folder containing the `_Technical.txt`/`_Metadata.json` pairs.
+        model (SentenceTransformer): The model used for generating embeddings.
+        sink (callable): Called with (sources, embeddings) for every group of embedded passages,
+            e.g. to index them or write them to an embedding store.
+        txt_files (list, optional): The `_Technical.txt` files to process. Defaults to every file in the folder.
+        parse_workers (int, optional): Number of parsing processes. Defaults to the number of CPUs.
+        batch_size (int, optional): Number of passages per forward pass. Defaults to 64.
+        sink_batch_size (int, optional): Number of passages handed to the sink at a time. Defaults to 500.
+        queue_size (int, optional): Capacity of the queues between stages. Defaults to 8.
+        documents (DocumentStore, optional): Document table the metadata of every parsed document is stored in. Defaults to None.
+
+    Returns:
+        dict: Number of `documents` and `passages` processed, the wall time in `seconds`, and the time
+        each stage spent working (`parse_busy` is the time until the last document was parsed).
+    """
+    if txt_files is None:
+        txt_files = list_documents(folder_path)
+    parse_workers = parse_workers or os.cpu_count() or 1
+
+    parsed = queue.Queue(maxsize=queue_size)
+    embedded = queue.Queue(maxsize=queue_size)
+    errors = []
+    counts = {"documents": 0, "passages": 0}
+
+    def parse(stage):
+        start = time.perf_counter()
+        def emit(txt_file, future):
+            sources, metadata = future.result()
+            if documents is not None:
+                documents.put(document_id(txt_file), metadata)
+            _put(parsed, sources, errors)
+
+        # Keep at most queue_size documents in flight so parsing cannot run far ahead
+        with ProcessPoolExecutor(max_workers=parse_workers) as executor:
+            pending = []
+            for txt_file in txt_files:
+                pending.append((txt_file, executor.submit(parse_chunks, folder_path, txt_file)))
+                if len(pending) >= queue_size:
+                    emit(*pending.pop(0))
+            for txt_file, future in pending:
+                emit(txt_file, future)
+        stage.busy = time.perf_counter() - start
+        _put(parsed, _DONE, errors)
+
+    def embed(stage):
+        buffer = []
+
+        def flush(batch):
+            start = time.perf_counter()
+            embeddings = encode_passages(model, [source["Passage"] for source in batch], batch_size=batch_size)
+            elapsed = time.perf_counter() - start
+            stage.busy += elapsed
+            record_stage("embed", elapsed)
+            _put(embedded, (batch, embeddings), errors)
+
+        # Re-batch passages across document boundaries so every forward pass is full
+        while True:
+            sources = _get(parsed, errors)
+            if sources is _DONE:
+                break
+            counts["documents"] += 1
+            DOCUMENTS.inc()
+            buffer.extend(sources)
+            while len(buffer) >= batch_size:
+                flush(buffer[:batch_size])
+                del buffer[:batch_size]
+        if buffer:
+            flush(buffer)
+        _put(embedded, _DONE, errors)
+
+    def write(stage):
+        sources, embeddings = [], []
+
+        def flush():
+            start = time.perf_counter()
+            sink(list(sources), np.concatenate(embeddings))
+            elapsed = time.perf_counter() - start
+            stage.busy += elapsed
+            record_stage("index", elapsed)
+            counts["passages"] += len(sources)
+            CHUNKS.inc(len(sources))
+            sources.clear()
+            embeddings.clear()
+
+        while True:
+            item = _get(embedded, errors)
+            if item is _DONE:
+                break
+            sources.extend(item[0])
+            embeddings.append(item[1])
+            if len(sources) >= sink_batch_size:
+                flush()
+        if sources:
+            flush()
+
+    start = time.perf_counter()
+    stages = [_Stage(name, target, errors) for name, target in (("parse", parse), ("embed", embed), ("write", write))]
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+    if errors:
+        raise errors[0]
+
+    elapsed = time.perf_counter() - start
+    stats = dict(counts, seconds=elapsed, **{f"{stage.name}_busy": stage.busy for stage in stages})
+    print(f"Processed {counts['documents']} documents, {counts['passages']} passages in {elapsed:.1f}s "
+          f"({counts['passages'] / max(elapsed, 1e-9):.1f} passages/s)")
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+    from contextlib import nullcontext
+    from dotenv import load_dotenv
+    from bulk_indexer import tuned_for_bulk_load
+    from documents import DOCUMENT_STORE_PATH, DocumentStore
+    from embedding_store import EmbeddingStoreWriter
+    from indexing import connect_instance, create_index, index_passages, recreate_index
+    from ingestion import Manifest, ingest_folder
+    from local_search import LocalSearchEngine
+    from model import load_model
+    from projection import PROJECTION_FILE, PROJECTION_PATH, ProjectedEncoder, embedding_dims, load_projection
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Stream a corpus folder through parsing, embedding and indexing.")
+    parser.add_argument("folder_path", nargs="?", default="../docs/corpus")
+    parser.add_argument("--index-name", default="passage_metadata_emb")
+    parser.add_argument("--backend", choices=["elasticsearch", "local", "none"], default=os.getenv("SEARCH_BACKEND", "elasticsearch"))
+    parser.add_argument("--local-index-dir", default=os.getenv("LOCAL_INDEX_DIR", "../docs/local_index"))
+    parser.add_argument("--url", help="Elasticsearch URL, e.g. that of es_stand_in.py. Defaults to ES_HOST/ES_PORT")
+    parser.add_argument("--recreate", action="store_true", help="Delete and recreate the index first")
+    parser.add_argument("--knn", action="store_true", default=os.getenv("ES_KNN", "false").lower() == "true",
+                        help="Create a missing or recreated Elasticsearch index with a kNN-indexed embedding field")
+    parser.add_argument("--store", help="Also write the embeddings to this embedding store folder")
+    parser.add_argument("--workers", type=int, default=None, help="Number of parsing processes")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--document-store", default=DOCUMENT_STORE_PATH, help="Document table the metadata is stored in")
+    parser.add_argument("--projection", default=PROJECTION_PATH, help="PCA projection (.npz) to reduce the embeddings with, see projection.py")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only index new and changed documents and delete removed ones, tracked in a manifest")
+    parser.add_argument("--manifest", help="Manifest of an incremental index. Defaults to ../docs/manifests/<index name>.json")
+    args = parser.parse_args()
+    manifest_path = args.manifest or os.path.join("../docs/manifests", f"{args.index_name}.json")
+    if args.incremental and (args.store or args.backend == "none"):
+        parser.error("--incremental updates an index in place and cannot write --store or use --backend none")
+
+    model = load_model(snapshot_dir=os.getenv("MODEL_SNAPSHOT_DIR"), backend=os.getenv("EMBEDDING_BACKEND", "torch"),
+                       onnx_quantization=os.getenv("ONNX_QUANTIZATION", "avx2"))
+    projection = load_projection(args.projection)
+    if projection is not None:
+        model = ProjectedEncoder(model, projection)
+    writer = EmbeddingStoreWriter(args.store) if args.store else None
+
+    if args.backend == "local":
+        es = LocalSearchEngine(args.local_index_dir)
+    elif args.backend == "elasticsearch" and args.url:
+        from elasticsearch import Elasticsearch
+        es = Elasticsearch(args.url, request_timeout=120)
+    elif args.backend == "elasticsearch":
+        es = connect_instance(os.getenv("ES_HOST"), int(os.getenv("ES_PORT")), os.getenv("ES_USERNAME"), os.getenv("ES_PASSWORD"))
+    else:
+        es = None
+
+    # Indexes are created with the typed filter fields, the kNN and quantization options and the dimension
+    # of the (projected) embeddings; Elasticsearch would otherwise map Embedding as a plain float array
+    index_options = dict(knn=args.knn, quantization=os.getenv("QUANTIZATION") or None, dims=embedding_dims(args.projection))
+    if args.recreate and es is not None:
+        recreate_index(es, args.index_name, **index_options)
+        if args.incremental:
+            Manifest(manifest_path).clear()
+    elif args.backend == "elasticsearch" and not es.indices.exists(index=args.index_name):
+        print(f"Creating missing Elasticsearch index {args.index_name}")
+        create_index(es, args.index_name, **index_options)
+
+    def sink(sources, embeddings):
+        if writer is not None:
+            writer.write(sources, embeddings)
+        if es is not None:
+            index_passages(es, sources, embeddings, args.index_name, refresh=False)
+
+    if args.incremental:
+        # Only documents whose content or chunking changed since the manifest was written are processed
+        ingest_folder(es, model, args.folder_path, args.index_name, manifest_path, batch_size=args.batch_size,
+                      documents=DocumentStore(args.document_store))
+    else:
+        # Refresh and replicas are off while Elasticsearch is loaded, and the index is refreshed once at the end
+        tuning = tuned_for_bulk_load(es, args.index_name) if args.backend == "elasticsearch" else nullcontext()
+        try:
+            with tuning:
+                run_pipeline(args.folder_path, model, sink, parse_workers=args.workers, batch_size=args.batch_size,
+                             documents=DocumentStore(args.document_store))
+        finally:
+            if writer is not None:
+                writer.close()
+                if projection is not None:
+                    projection.save(os.path.join(args.store, PROJECTION_FILE))
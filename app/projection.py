@@ -0,0 +1,245 @@
+import os
+import time
+import numpy as np
+from embedding_store import EMBEDDINGS_FILE, EmbeddingStoreWriter, iter_store
+from recall import sample_queries
+from vectors import normalize_rows, top_k
+
+# Optional PCA projection of the embeddings to fewer dimensions, fitted on the corpus embeddings. Passages
+# and questions must both go through it, so set PROJECTION_PATH for the app whenever the index was built
+# from projected embeddings; empty keeps the full model dimension.
+PROJECTION_PATH = os.getenv("PROJECTION_PATH", "")
+
+# Name of the projection saved next to the embedding store it was applied to
+PROJECTION_FILE = "projection.npz"
+
+# Dimension of the embeddings of the model, used when no projection is configured
+MODEL_DIMS = 768
+
+# Rows a projection is fitted on at most, and rows accumulated at a time while fitting
+FIT_MAX_ROWS = 200000
+FIT_CHUNK_SIZE = 16384
+
+
+class PCAProjection:
+    """
+    Linear projection of embeddings onto their principal components.
+
+    Embeddings are centered on the corpus mean, projected onto the `dims` directions of largest variance,
+    and rescaled to unit length, so cosine similarity in the reduced space approximates the ranking of the
+    full embeddings at a fraction of the memory and scoring cost.
+    """
+
+    def __init__(self, mean, components, explained_variance_ratio=None):
+        """
+        Args:
+            mean (np.ndarray): The float32 mean of the training embeddings.
+            components (np.ndarray): A (dims, model dims) float32 matrix of principal directions.
+            explained_variance_ratio (float, optional): Fraction of the training variance the components keep.
+        """
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+        self.explained_variance_ratio = explained_variance_ratio
+
+    @property
+    def dims(self):
+        """The dimension of projected embeddings."""
+        return len(self.components)
+
+    @classmethod
+    def train(cls, embeddings, dims, max_rows=FIT_MAX_ROWS, chunk_size=FIT_CHUNK_SIZE, seed=0):
+        """
+        Fit the projection to an (n, model dims) embedding matrix, possibly memory-mapped.
+
+        The covariance matrix is accumulated chunk by chunk over at most `max_rows` rows sampled
+        without replacement, so fitting does not load the whole corpus into memory.
+
+        Args:
+            embeddings (np.ndarray): The corpus embeddings.
+            dims (int): The dimension to reduce to.
+            max_rows (int, optional): Maximum number of rows to fit on. Defaults to FIT_MAX_ROWS.
+            chunk_size (int, optional): Number of rows accumulated at a time. Defaults to FIT_CHUNK_SIZE.
+            seed (int, optional): Random seed of the row sample. Defaults to 0.
+
+        Returns:
+            PCAProjection: The fitted projection.
+        """
+        if not 0 < dims <= embeddings.shape[1]:
+            raise ValueError(f"Expected a dimension between 1 and {embeddings.shape[1]}, got {dims}")
+
+        rows = np.arange(len(embeddings))
+        if len(rows) > max_rows:
+            rows = np.sort(np.random.default_rng(seed).choice(len(rows), size=max_rows, replace=False))
+
+        # Fit on unit-length rows, as they are compared by cosine similarity
+        total = np.zeros(embeddings.shape[1], dtype=np.float64)
+        second_moment = np.zeros((embeddings.shape[1], embeddings.shape[1]), dtype=np.float64)
+        for start in range(0, len(rows), chunk_size):
+            block = normalize_rows(embeddings[rows[start:start + chunk_size]]).astype(np.float64)
+            total += block.sum(axis=0)
+            second_moment += block.T @ block
+
+        mean = total / max(len(rows), 1)
+        covariance = second_moment / max(len(rows), 1) - np.outer(mean, mean)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:dims]
+        kept = float(eigenvalues[order].sum() / max(eigenvalues.sum(), 1e-12))
+        return cls(mean, eigenvectors[:, order].T, kept)
+
+    def transform(self, embeddings):
+        """
+        Project one embedding or an (n, model dims) batch of embeddings.
+
+        Returns:
+            np.ndarray: The unit-length float32 projections, with the shape of the input but `dims` columns.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.ndim == 1:
+            return self.transform(embeddings[None, :])[0]
+        return normalize_rows((normalize_rows(embeddings) - self.mean) @ self.components.T)
+
+    def save(self, path):
+        """Persist the projection to an .npz file."""
+        np.savez(path, mean=self.mean, components=self.components,
+                 explained_variance_ratio=np.float32(self.explained_variance_ratio or 0))
+
+    @classmethod
+    def load(cls, path):
+        """Load a projection written by `save`."""
+        with np.load(path) as data:
+            return cls(data["mean"], data["components"], float(data["explained_variance_ratio"]))
+
+
+class ProjectedEncoder:
+    """
+    Wraps an embedding model so that every embedding it returns is projected.
+
+    Only `encode` and `get_sentence_embedding_dimension` are changed; other attributes are those of the model.
+    """
+
+    def __init__(self, model, projection):
+        """
+        Args:
+            model (SentenceTransformer): The embedding model.
+            projection (PCAProjection): The projection applied to its embeddings.
+        """
+        self.model = model
+        self.projection = projection
+
+    def encode(self, sentences, **kwargs):
+        """Encode one sentence or a list of sentences and project the embeddings."""
+        return self.projection.transform(self.model.encode(sentences, **kwargs))
+
+    def get_sentence_embedding_dimension(self):
+        return self.projection.dims
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+def load_projection(path=PROJECTION_PATH):
+    """Return the projection saved at `path`, or None if no path is set."""
+    return PCAProjection.load(path) if path else None
+
+
+def embedding_dims(path=PROJECTION_PATH):
+    """Return the dimension of indexed embeddings: that of the projection at `path`, or MODEL_DIMS without one."""
+    projection = load_projection(path)
+    return projection.dims if projection is not None else MODEL_DIMS
+
+
+def project_store(store_dir, output_dir, projection, dtype="float32", chunk_size=10000):
+    """
+    Write a projected copy of an embedding store, with the projection saved next to it.
+
+    Args:
+        store_dir (str): Folder of the full-dimension store.
+        output_dir (str): Folder of the projected store to write.
+        projection (PCAProjection): The fitted projection.
+        dtype (str, optional): Storage type, "float32" or "float16". Defaults to "float32".
+        chunk_size (int, optional): Number of rows projected at a time. Defaults to 10000.
+    """
+    with EmbeddingStoreWriter(output_dir, dtype) as writer:
+        for sources, embeddings in iter_store(store_dir, chunk_size):
+            writer.write(sources, projection.transform(embeddings))
+    projection.save(os.path.join(output_dir, PROJECTION_FILE))
+    print(f"Successfully projected {store_dir} to {projection.dims} dimensions in {output_dir}")
+
+
+def projection_report(embeddings, dims_list, top_n=5, n_queries=200, seed=0):
+    """
+    Compare search over projected embeddings with search over the full embeddings.
+
+    For each dimension a projection is fitted on the corpus, and sampled queries are scored exactly against
+    the full and the projected matrices.
+
+    Args:
+        embeddings (np.ndarray): The full corpus embeddings.
+        dims_list (list): The dimensions to evaluate.
+        top_n (int, optional): The k of the top-k overlap. Defaults to 5.
+        n_queries (int, optional): Number of sampled queries. Defaults to 200.
+        seed (int, optional): Random seed for query sampling. Defaults to 0.
+
+    Returns:
+        list: One dict per setting with `setting`, `dims`, `bytes`, `memory_saved`, `mean_ms`, `speedup`,
+        `overlap` (the mean fraction of the full top-k found in the projected top-k) and `explained_variance`,
+        preceded by the full-dimension baseline.
+    """
+    full = normalize_rows(embeddings)
+    queries = sample_queries(full, n_queries, seed=seed)
+
+    def run(matrix, projected_queries):
+        results = []
+        start = time.perf_counter()
+        for query in projected_queries:
+            results.append(set(top_k(matrix @ query, top_n).tolist()))
+        return results, (time.perf_counter() - start) * 1000 / max(len(projected_queries), 1)
+
+    full_results, full_ms = run(full, queries)
+    report = [{"setting": "full", "dims": full.shape[1], "bytes": full.nbytes, "memory_saved": 0.0,
+               "mean_ms": full_ms, "speedup": 1.0, "overlap": 1.0, "explained_variance": 1.0}]
+    for dims in dims_list:
+        projection = PCAProjection.train(embeddings, dims)
+        reduced = projection.transform(full)
+        results, mean_ms = run(reduced, projection.transform(queries))
+        overlap = np.mean([len(found & truth) / max(len(truth), 1) for found, truth in zip(results, full_results)])
+        report.append({"setting": f"pca {dims}", "dims": dims, "bytes": reduced.nbytes,
+                       "memory_saved": 1 - reduced.nbytes / max(full.nbytes, 1), "mean_ms": mean_ms,
+                       "speedup": full_ms / max(mean_ms, 1e-9), "overlap": float(overlap),
+                       "explained_variance": projection.explained_variance_ratio})
+    return report
+
+
+def print_report(report, top_n):
+    """Print a projection report as a table."""
+    print(f"{'setting':>10} {'MiB':>10} {'saved':>8} {'mean ms':>10} {'speedup':>8} {'overlap@' + str(top_n):>10} {'variance':>9}")
+    for row in report:
+        print(f"{row['setting']:>10} {row['bytes'] / 1024 / 1024:>10.1f} {row['memory_saved']:>8.1%} {row['mean_ms']:>10.3f} "
+              f"{row['speedup']:>7.1f}x {row['overlap']:>10.3f} {row['explained_variance']:>9.1%}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fit a PCA projection of an embedding store and report its memory, speed and top-k overlap against full-dimension search.")
+    parser.add_argument("store_dir", nargs="?", default="../docs/passage_metadata_emb", help="Full-dimension embedding store folder")
+    parser.add_argument("--dims", type=int, nargs="+", default=[64, 128, 256])
+    parser.add_argument("--top-n", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--output", help="Fit a projection to the single --dims and save it to this .npz file")
+    parser.add_argument("--project-to", metavar="DIR", help="Also write a projected copy of the store to this folder")
+    args = parser.parse_args()
+
+    embeddings = np.load(os.path.join(args.store_dir, EMBEDDINGS_FILE), mmap_mode="r")
+    print_report(projection_report(embeddings, args.dims, args.top_n, args.queries), args.top_n)
+
+    if args.output or args.project_to:
+        if len(args.dims) != 1:
+            parser.error("--output and --project-to need a single --dims")
+        projection = PCAProjection.train(embeddings, args.dims[0])
+        if args.output:
+            projection.save(args.output)
+            print(f"Saved a {projection.dims}-dimension projection keeping {projection.explained_variance_ratio:.1%} "
+                  f"of the variance to {args.output}")
+        if args.project_to:
+            project_store(args.store_dir, args.project_to, projection)
@@ -0,0 +1,219 @@
+import os
+import numpy as np
+from embedding_store import EMBEDDINGS_FILE, append_npy
+
+# Rows scored at a time, bounding the float32 temporaries of a scan over the codes
+SCORE_CHUNK_SIZE = 16384
+
+# Number of set bits of every byte value, used when numpy has no bitwise_count
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _popcount(packed):
+    """Return the number of set bits in each row of a uint8 array."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(packed).sum(axis=1, dtype=np.int32)
+    return _POPCOUNT[packed].sum(axis=1, dtype=np.int32)
+
+
+class Int8Quantizer:
+    """
+    Scalar quantization of unit-length embeddings to one signed byte per dimension.
+
+    Each dimension is scaled by its largest absolute value over the training rows, so codes use the
+    full int8 range. Approximate scores are inner products between the codes and the rescaled query,
+    which keep the ranking of the float32 scores closely at a quarter of the memory.
+    """
+
+    kind = "int8"
+
+    def __init__(self, scale):
+        """
+        Args:
+            scale (np.ndarray): Per-dimension float32 step between consecutive code values.
+        """
+        self.scale = np.asarray(scale, dtype=np.float32)
+
+    @classmethod
+    def train(cls, embeddings, chunk_size=SCORE_CHUNK_SIZE):
+        """Fit the per-dimension scales to an (n, dims) embedding matrix."""
+        max_abs = np.zeros(embeddings.shape[1], dtype=np.float32)
+        for start in range(0, len(embeddings), chunk_size):
+            max_abs = np.maximum(max_abs, np.abs(np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)).max(axis=0))
+        return cls(np.maximum(max_abs, 1e-8) / 127)
+
+    def encode(self, embeddings):
+        """Return the (n, dims) int8 codes of a batch of embeddings."""
+        codes = np.rint(np.asarray(embeddings, dtype=np.float32) / self.scale)
+        return np.clip(codes, -127, 127).astype(np.int8)
+
+    def scores(self, codes, query, rows=None):
+        """
+        Return approximate inner products between a query and a set of codes.
+
+        Args:
+            codes (np.ndarray): The (n, dims) codes of an index, possibly memory-mapped.
+            query (np.ndarray): The unit-length query embedding.
+            rows (np.ndarray, optional): Only score these rows. Defaults to every row.
+
+        Returns:
+            np.ndarray: One float32 score per scored row.
+        """
+        scaled_query = (query * self.scale).astype(np.float32)
+        n = len(codes) if rows is None else len(rows)
+        scores = np.empty(n, dtype=np.float32)
+        for start in range(0, n, SCORE_CHUNK_SIZE):
+            block = codes[start:start + SCORE_CHUNK_SIZE] if rows is None else codes[rows[start:start + SCORE_CHUNK_SIZE]]
+            scores[start:start + len(block)] = block.astype(np.float32) @ scaled_query
+        return scores
+
+    def save(self, path):
+        """Persist the quantizer parameters to an .npz file."""
+        np.savez(path, scale=self.scale)
+
+    @classmethod
+    def load(cls, path):
+        """Load quantizer parameters written by `save`."""
+        with np.load(path) as data:
+            return cls(data["scale"])
+
+
+class BinaryQuantizer:
+    """
+    Binary quantization of unit-length embeddings to one bit per dimension.
+
+    Each dimension is thresholded at its mean over the training rows and the bits are packed eight
+    to a byte, a 32x reduction over float32. Approximate scores are negated Hamming distances, which
+    are only good enough to pick a shortlist for exact rescoring.
+    """
+
+    kind = "binary"
+
+    def __init__(self, threshold):
+        """
+        Args:
+            threshold (np.ndarray): Per-dimension float32 value above which a bit is set.
+        """
+        self.threshold = np.asarray(threshold, dtype=np.float32)
+
+    @classmethod
+    def train(cls, embeddings, chunk_size=SCORE_CHUNK_SIZE):
+        """Fit the per-dimension thresholds to an (n, dims) embedding matrix."""
+        total = np.zeros(embeddings.shape[1], dtype=np.float64)
+        for start in range(0, len(embeddings), chunk_size):
+            total += np.asarray(embeddings[start:start + chunk_size], dtype=np.float32).sum(axis=0)
+        return cls(total / max(len(embeddings), 1))
+
+    def encode(self, embeddings):
+        """Return the (n, ceil(dims / 8)) packed uint8 codes of a batch of embeddings."""
+        return np.packbits(np.asarray(embeddings, dtype=np.float32) > self.threshold, axis=1)
+
+    def scores(self, codes, query, rows=None):
+        """
+        Return negated Hamming distances between a query and a set of codes.
+
+        Args:
+            codes (np.ndarray): The packed codes of an index, possibly memory-mapped.
+            query (np.ndarray): The unit-length query embedding.
+            rows (np.ndarray, optional): Only score these rows. Defaults to every row.
+
+        Returns:
+            np.ndarray: One float32 score per scored row; higher is closer.
+        """
+        query_code = self.encode(query[None, :])[0]
+        n = len(codes) if rows is None else len(rows)
+        scores = np.empty(n, dtype=np.float32)
+        for start in range(0, n, SCORE_CHUNK_SIZE):
+            block = codes[start:start + SCORE_CHUNK_SIZE] if rows is None else codes[rows[start:start + SCORE_CHUNK_SIZE]]
+            scores[start:start + len(block)] = -_popcount(np.bitwise_xor(block, query_code))
+        return scores
+
+    def save(self, path):
+        """Persist the quantizer parameters to an .npz file."""
+        np.savez(path, threshold=self.threshold)
+
+    @classmethod
+    def load(cls, path):
+        """Load quantizer parameters written by `save`."""
+        with np.load(path) as data:
+            return cls(data["threshold"])
+
+
+QUANTIZERS = {quantizer.kind: quantizer for quantizer in (Int8Quantizer, BinaryQuantizer)}
+
+
+def codes_file(kind):
+    """Return the name of the file holding the codes of a quantization kind."""
+    return f"{kind}_codes.npy"
+
+
+def params_file(kind):
+    """Return the name of the file holding the parameters of a quantization kind."""
+    return f"{kind}_params.npz"
+
+
+def write_codes(quantizer, embeddings, path, chunk_size=SCORE_CHUNK_SIZE):
+    """
+    Encode an embedding matrix in chunks and write the codes to a fresh .npy file.
+
+    Args:
+        quantizer (Int8Quantizer or BinaryQuantizer): The trained quantizer.
+        embeddings (np.ndarray): The (n, dims) embeddings, possibly memory-mapped.
+        path (str): Path of the .npy file; it is replaced atomically once complete.
+        chunk_size (int, optional): Number of rows encoded at a time. Defaults to SCORE_CHUNK_SIZE.
+    """
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    for start in range(0, len(embeddings), chunk_size):
+        append_npy(tmp_path, quantizer.encode(embeddings[start:start + chunk_size]))
+    os.replace(tmp_path, path)
+
+
+def memory_report(index_path):
+    """
+    Return the size on disk of the float32 embeddings and of every quantized copy of an index.
+
+    Args:
+        index_path (str): Folder of the local index.
+
+    Returns:
+        dict: Maps "float32" and each built quantization kind to a size in bytes.
+    """
+    sizes = {"float32": os.path.getsize(os.path.join(index_path, EMBEDDINGS_FILE))}
+    for kind in QUANTIZERS:
+        path = os.path.join(index_path, codes_file(kind))
+        if os.path.exists(path):
+            sizes[kind] = os.path.getsize(path)
+    return sizes
+
+
+if __name__ == "__main__":
+    import argparse
+    from local_search import LocalSearchEngine
+    from recall import print_report, recall_against_exact
+
+    parser = argparse.ArgumentParser(description="Build quantized codes for a local search index and report recall@k against exact search.")
+    parser.add_argument("--index-dir", default="../docs/local_index")
+    parser.add_argument("--index-name", default="passage_metadata_emb")
+    parser.add_argument("--kind", choices=sorted(QUANTIZERS), nargs="+", default=sorted(QUANTIZERS))
+    parser.add_argument("--oversample", type=int, nargs="+", default=[1, 4, 10, 40])
+    parser.add_argument("--top-n", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--no-build", action="store_true", help="Evaluate the existing codes instead of rebuilding them")
+    args = parser.parse_args()
+
+    engine = LocalSearchEngine(args.index_dir)
+    for kind in args.kind:
+        if not args.no_build:
+            engine.build_quantized(args.index_name, kind)
+
+    # Exact search ignores quantization, so it is the baseline for every setting
+    settings = [
+        (f"{kind} x{oversample}", {"quantization": kind, "oversample": oversample})
+        for kind in args.kind for oversample in args.oversample
+    ]
+    print_report(recall_against_exact(engine, args.index_name, settings, args.top_n, args.queries), args.top_n)
+
+    for kind, size in memory_report(os.path.join(args.index_dir, args.index_name)).items():
+        print(f"{kind:>8}: {size / 1024 / 1024:.1f} MiB")
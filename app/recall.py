@@ -0,0 +1,66 @@
+import time
+import numpy as np
+from vectors import normalize_rows
+
+
+def sample_queries(embeddings, n_queries=200, noise=0.02, seed=0):
+    """
+    Sample evaluation queries from a corpus by perturbing some of its embeddings.
+
+    Args:
+        embeddings (np.ndarray): The unit-length corpus embeddings.
+        n_queries (int, optional): Number of queries. Defaults to 200.
+        noise (float, optional): Standard deviation of the Gaussian noise added to each query. Defaults to 0.02.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        np.ndarray: The unit-length queries.
+    """
+    rng = np.random.default_rng(seed)
+    query_ids = rng.choice(len(embeddings), size=min(n_queries, len(embeddings)), replace=False)
+    queries = np.asarray(embeddings[np.sort(query_ids)], dtype=np.float32)
+    return normalize_rows(queries + rng.normal(scale=noise, size=queries.shape).astype(np.float32))
+
+
+def recall_against_exact(engine, index_name, settings, top_n=5, n_queries=200, seed=0, queries=None):
+    """
+    Measure recall@k and latency of search settings against exact search on the same index.
+
+    Args:
+        engine (LocalSearchEngine): The local search engine holding the index.
+        index_name (str): The index to evaluate.
+        settings (list): (label, search keyword arguments) pairs to evaluate.
+        top_n (int, optional): The k in recall@k. Defaults to 5.
+        n_queries (int, optional): Number of sampled queries. Defaults to 200.
+        seed (int, optional): Random seed for query sampling. Defaults to 0.
+        queries (np.ndarray, optional): Queries to use instead of sampling them from the corpus.
+
+    Returns:
+        list: One dict per setting with `setting`, `recall` and `mean_ms`, preceded by the exact baseline.
+    """
+    if queries is None:
+        embeddings, _ = engine._load(index_name)
+        queries = sample_queries(embeddings, n_queries, seed=seed)
+
+    def run(kwargs):
+        results = []
+        start = time.perf_counter()
+        for query in queries:
+            hits = engine.search(index_name, query, top_n, **kwargs)
+            results.append({hit["_id"] for hit in hits})
+        return results, (time.perf_counter() - start) * 1000 / max(len(queries), 1)
+
+    exact_results, exact_ms = run({"exact": True})
+    report = [{"setting": "exact", "recall": 1.0, "mean_ms": exact_ms}]
+    for label, kwargs in settings:
+        results, mean_ms = run(kwargs)
+        recall = np.mean([len(found & truth) / max(len(truth), 1) for found, truth in zip(results, exact_results)])
+        report.append({"setting": label, "recall": float(recall), "mean_ms": mean_ms})
+    return report
+
+
+def print_report(report, top_n):
+    """Print a recall report as a table."""
+    print(f"{'setting':>24} {'recall@' + str(top_n):>10} {'mean ms':>10}")
+    for row in report:
+        print(f"{row['setting']:>24} {row['recall']:>10.3f} {row['mean_ms']:>10.3f}")
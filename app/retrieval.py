@@ -1,25 +1,103 @@
 import csv
+from local_search import LocalSearchEngine
+from metrics import span
+from parsing import validate_filter
 
-def search_similar_passages(es_instance, index_name, query_embedding, top_n=5):
+def build_es_filter(filters):
+    """
+    Translate a metadata filter into Elasticsearch filter clauses.
+
+    Args:
+    - filters (dict): Maps a metadata field to a value, a list of accepted values, or a range
+      given as a dict with any of `gte`, `gt`, `lte` and `lt`.
+
+    Returns:
+    - list: Elasticsearch `term`, `terms` and `range` clauses.
+
+    Raises:
+    - ValueError: If the filter is invalid (see `parsing.validate_filter`).
+    """
+    clauses = []
+    for field, value in validate_filter(filters).items():
+        if isinstance(value, dict):
+            clauses.append({"range": {field: value}})
+        elif isinstance(value, (list, tuple)):
+            clauses.append({"terms": {field: list(value)}})
+        else:
+            clauses.append({"term": {field: value}})
+    return clauses
+
+
+def search_similar_passages(es_instance, index_name, query_embedding, top_n=5, nprobe=None, num_candidates=None, filters=None):
     """
     Search for passages in the Elasticsearch index that are similar to the provided query embedding.
     
     Args:
-    - es_instance (Elasticsearch): An instance of the Elasticsearch client.
+    - es_instance (Elasticsearch or LocalSearchEngine): An instance of the Elasticsearch client, or a local search engine.
     - index_name (str): The name of the Elasticsearch index to search in.
     - query_embedding (list): The embedding vector of the user's query.
-    - top_n (int, optional): The number of top results to retrieve. Defaults to 3.
+    - top_n (int, optional): The number of top results to retrieve. Defaults to 5.
+    - nprobe (int, optional): Number of IVF lists to visit when the local index has an ANN index. Defaults to the engine's setting.
+    - num_candidates (int, optional): If set, run an approximate kNN search on Elasticsearch, considering this many
+      candidates per shard. The index must have been created with `knn=True`. Defaults to None (exact script_score).
+    - filters (dict, optional): Restrict the search to passages whose metadata fields match (see `build_es_filter`).
+      The filter is applied before vector scoring. Defaults to None.
     
     Returns:
     - list: List of top search results.
     """
     
+    # The local backend scores the query in-process
+    if isinstance(es_instance, LocalSearchEngine):
+        with span("search"):
+            return es_instance.search(index_name, query_embedding, top_n, nprobe=nprobe, filters=filters)
+
+    query_body = build_search_body(query_embedding, top_n, num_candidates, filters)
+    with span("search"):
+        response = es_instance.search(index=index_name, body=query_body)
+    return response['hits']['hits']
+
+
+def build_search_body(query_embedding, top_n=5, num_candidates=None, filters=None):
+    """
+    Build the Elasticsearch search body of a query embedding (see `search_similar_passages`).
+
+    Args:
+    - query_embedding (list): The embedding vector of the user's query.
+    - top_n (int, optional): The number of top results to retrieve. Defaults to 5.
+    - num_candidates (int, optional): If set, build an approximate kNN search. Defaults to None (exact script_score).
+    - filters (dict, optional): Metadata filter (see `build_es_filter`). Defaults to None.
+
+    Returns:
+    - dict: The search body.
+    """
+    # Hits return the passage and its fields, not the embedding
+    source_filter = {"excludes": ["Embedding"]}
+    filter_query = {"bool": {"filter": build_es_filter(filters)}} if filters else None
+
+    # Approximate kNN over the HNSW graph; scores are (1 + cosine) / 2 instead of cosine + 1
+    if num_candidates:
+        query_body = {
+            "size": top_n,
+            "_source": source_filter,
+            "knn": {
+                "field": "Embedding",
+                "query_vector": list(map(float, query_embedding)),
+                "k": top_n,
+                "num_candidates": max(num_candidates, top_n)
+            }
+        }
+        if filter_query:
+            query_body["knn"]["filter"] = filter_query
+        return query_body
+
     # Construct the Elasticsearch query to compute cosine similarity
-    query_body = {
+    return {
         "size": top_n,
+        "_source": source_filter,
         "query": {
             "script_score": {
-                "query": {
+                "query": filter_query or {
                     "match_all": {}
                 },
                 "script": {
@@ -31,9 +109,44 @@ def search_similar_passages(es_instance, index_name, query_embedding, top_n=5):
             }
         }
     }
-    
-    response = es_instance.search(index=index_name, body=query_body)
-    return response['hits']['hits']
+
+
+def search_similar_passages_batch(es_instance, index_name, query_embeddings, top_n=5, nprobe=None, num_candidates=None, filters=None):
+    """
+    Search for the passages similar to each of several query embeddings in one round trip.
+
+    Elasticsearch runs the searches as one multi-search request; the local backend scores them together.
+
+    Args:
+    - es_instance (Elasticsearch or LocalSearchEngine): An instance of the Elasticsearch client, or a local search engine.
+    - index_name (str): The name of the index to search in.
+    - query_embeddings (list): The embedding vectors of the queries.
+    - top_n, nprobe, num_candidates, filters: As in `search_similar_passages`, applied to every query.
+
+    Returns:
+    - list: The list of top search results of each query, in the order of `query_embeddings`.
+    """
+    if len(query_embeddings) == 0:
+        return []
+
+    if isinstance(es_instance, LocalSearchEngine):
+        with span("search"):
+            return es_instance.search_batch(index_name, query_embeddings, top_n, nprobe=nprobe, filters=filters)
+
+    searches = []
+    for query_embedding in query_embeddings:
+        searches.append({"index": index_name})
+        searches.append(build_search_body(query_embedding, top_n, num_candidates, filters))
+
+    with span("search"):
+        response = es_instance.msearch(searches=searches)
+
+    results = []
+    for item in response['responses']:
+        if "error" in item:
+            raise RuntimeError(f"Search failed: {item['error']}")
+        results.append(item['hits']['hits'])
+    return results
 
 
 def save_results_to_csv(query, search_results, csv_file_path="questions_answers.csv"):
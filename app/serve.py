@@ -0,0 +1,29 @@
+import time
+SERVE_START = time.perf_counter()
+
+import os
+from app import app, start_warm_up, startup
+
+# Number of worker threads serving requests; retrieval and LLM calls of different requests overlap
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", "16"))
+SERVER_PORT = int(os.getenv("PORT", "5000"))
+
+
+if __name__ == "__main__":
+    # Measure startup from the top of this script rather than from the import of the app
+    startup["started_at"] = SERVE_START
+
+    try:
+        from waitress import create_server
+    except ImportError:
+        # Fall back to the threaded development server if waitress is not installed
+        print("waitress is not installed, serving with the threaded Flask server")
+        startup["listening"] = time.perf_counter() - SERVE_START
+        start_warm_up()
+        app.run(host='0.0.0.0', port=SERVER_PORT, threaded=True)
+    else:
+        server = create_server(app, host='0.0.0.0', port=SERVER_PORT, threads=SERVER_THREADS)
+        startup["listening"] = time.perf_counter() - SERVE_START
+        print(f"Serving on port {SERVER_PORT} with {SERVER_THREADS} threads, listening {startup['listening']:.2f}s after startup")
+        start_warm_up()
+        server.run()
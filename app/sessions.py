@@ -0,0 +1,201 @@
+import os
+import time
+import secrets
+import tempfile
+import threading
+from collections import OrderedDict
+from metrics import span
+from model import encode_passages
+from parsing import list_documents, parse_chunks
+from vectors import normalize_rows, normalize_vector, top_k
+
+# Uploaded documents are indexed in memory once per session and queried by session id until the session
+# has been idle for SESSION_TTL seconds, or is the least recently used one when the sessions together
+# hold more than SESSION_MAX_MB megabytes
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+SESSION_MAX_MB = float(os.getenv("SESSION_MAX_MB", "256"))
+
+
+class SessionIndex:
+    """
+    The in-memory vector index of the documents uploaded in one session.
+
+    Passages are searched exactly with one matrix-vector product, and hits carry the metadata of
+    their document, which is kept with the session rather than in the shared document table.
+    """
+
+    def __init__(self, sources, embeddings, metadata):
+        """
+        Args:
+            sources (list): The passage sources, as returned by `parsing.parse_chunks`.
+            embeddings (np.ndarray): A (len(sources), dims) array of passage embeddings.
+            metadata (dict): The metadata JSON text of each uploaded document, by id.
+        """
+        self.sources = sources
+        self.embeddings = normalize_rows(embeddings)
+        self.metadata = metadata
+        self.created_at = time.time()
+        self.last_used = time.monotonic()
+        self.nbytes = (self.embeddings.nbytes + sum(len(source["Passage"].encode("utf-8")) for source in sources)
+                       + sum(len(text.encode("utf-8")) for text in metadata.values()))
+
+    def search(self, query_embedding, top_n=5):
+        """
+        Find the passages most similar to a query embedding.
+
+        Args:
+            query_embedding (array-like): The embedding vector of the user's query.
+            top_n (int, optional): The number of top results to retrieve. Defaults to 5.
+
+        Returns:
+            list: Hits shaped like Elasticsearch hits, with `_score` being cosine similarity + 1.0.
+        """
+        with span("search"):
+            scores = self.embeddings @ normalize_vector(query_embedding)
+            positions = top_k(scores, top_n)
+        return [
+            {
+                "_index": "session",
+                "_id": str(i),
+                "_score": float(scores[i]) + 1.0,
+                "_source": dict(self.sources[i], Metadata=self.metadata.get(self.sources[i]["DocId"], "{}"))
+            }
+            for i in positions
+        ]
+
+
+class SessionStore:
+    """
+    Thread-safe registry of session indexes, bounded by idle time and total memory.
+
+    Sessions idle for longer than `ttl` expire, and the least recently used sessions are evicted
+    while the sessions together hold more than `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=int(SESSION_MAX_MB * 1024 * 1024), ttl=SESSION_TTL):
+        """
+        Args:
+            max_bytes (int, optional): Memory budget of all sessions. Defaults to SESSION_MAX_MB megabytes.
+            ttl (float, optional): Seconds a session stays valid after its last use; 0 disables expiry.
+                Defaults to SESSION_TTL.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.created = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _drop(self, session_id):
+        self.nbytes -= self._sessions.pop(session_id).nbytes
+
+    def _expire(self):
+        if not self.ttl:
+            return
+        deadline = time.monotonic() - self.ttl
+        # Sessions are ordered by last use, so the expired ones are at the front
+        while self._sessions and next(iter(self._sessions.values())).last_used < deadline:
+            self._drop(next(iter(self._sessions)))
+            self.expirations += 1
+
+    def add(self, index):
+        """
+        Register a session index, evicting the least recently used sessions beyond the memory budget.
+
+        Args:
+            index (SessionIndex): The index of the new session.
+
+        Returns:
+            str: The session id.
+
+        Raises:
+            ValueError: If the index alone exceeds the memory budget.
+        """
+        if index.nbytes > self.max_bytes:
+            raise ValueError(f"The uploaded documents need {index.nbytes / 2 ** 20:.1f} MB, more than the "
+                             f"{self.max_bytes / 2 ** 20:.1f} MB sessions may hold")
+
+        session_id = secrets.token_urlsafe(16)
+        with self._lock:
+            self._expire()
+            while self._sessions and self.nbytes + index.nbytes > self.max_bytes:
+                self._drop(next(iter(self._sessions)))
+                self.evictions += 1
+            self._sessions[session_id] = index
+            self.nbytes += index.nbytes
+            self.created += 1
+        return session_id
+
+    def get(self, session_id):
+        """Return the index of a session and mark it used, or None if it is unknown, expired or evicted."""
+        with self._lock:
+            self._expire()
+            index = self._sessions.get(session_id)
+            if index is not None:
+                index.last_used = time.monotonic()
+                self._sessions.move_to_end(session_id)
+            return index
+
+    def delete(self, session_id):
+        """End a session. Returns whether it existed."""
+        with self._lock:
+            if session_id not in self._sessions:
+                return False
+            self._drop(session_id)
+            return True
+
+    def clear(self):
+        """End every session. Returns how many there were."""
+        with self._lock:
+            ended = len(self._sessions)
+            self._sessions.clear()
+            self.nbytes = 0
+            return ended
+
+    def stats(self):
+        """Return the number and memory of the live sessions and the session counters."""
+        with self._lock:
+            self._expire()
+            return {
+                "sessions": len(self._sessions),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "created": self.created,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+
+def build_session_index(model, uploads, batch_size=64):
+    """
+    Parse and embed uploaded documents into a session index.
+
+    Args:
+        model (SentenceTransformer): The model used for generating embeddings.
+        uploads (list): (doc_id, text, metadata JSON text) of each uploaded document.
+        batch_size (int, optional): Number of passages per forward pass. Defaults to 64.
+
+    Returns:
+        SessionIndex: The index of the uploaded passages.
+
+    Raises:
+        ValueError: If a metadata file is not valid JSON.
+    """
+    sources = []
+    # Documents are parsed from a scratch folder, as for a corpus, and only their passages are kept
+    with tempfile.TemporaryDirectory() as folder_path:
+        for doc_id, text, metadata_text in uploads:
+            with open(os.path.join(folder_path, f"{doc_id}_Technical.txt"), "w", encoding="utf-8") as file:
+                file.write(text)
+            with open(os.path.join(folder_path, f"{doc_id}_Metadata.json"), "w", encoding="utf-8") as file:
+                file.write(metadata_text)
+        for txt_file in list_documents(folder_path):
+            document_sources, _ = parse_chunks(folder_path, txt_file)
+            sources.extend(document_sources)
+    metadata = {doc_id: metadata_text for doc_id, _, metadata_text in uploads}
+
+    with span("embed"):
+        embeddings = encode_passages(model, [source["Passage"] for source in sources], batch_size=batch_size)
+    return SessionIndex(sources, embeddings, metadata)
@@ -0,0 +1,55 @@
+import numpy as np
+
+
+def normalize_rows(matrix):
+    """
+    L2-normalize the rows of a matrix so that a dot product equals cosine similarity.
+
+    Args:
+        matrix (np.ndarray): A 2-D array of embeddings.
+
+    Returns:
+        np.ndarray: A contiguous float32 array with unit-length rows (zero rows are left as zeros).
+    """
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def normalize_vector(vector):
+    """
+    L2-normalize a single embedding.
+
+    Args:
+        vector (array-like): An embedding vector.
+
+    Returns:
+        np.ndarray: A float32 unit-length copy of the vector (a zero vector is returned unchanged).
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def top_k(scores, k):
+    """
+    Return the positions of the k largest scores, best first.
+
+    Uses argpartition so only the selected k entries are sorted.
+
+    Args:
+        scores (np.ndarray): A 1-D array of scores.
+        k (int): Number of positions to return.
+
+    Returns:
+        np.ndarray: Positions into `scores`, ordered by descending score.
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(scores):
+        positions = np.argpartition(-scores, k - 1)[:k]
+    else:
+        positions = np.arange(len(scores))
+    return positions[np.argsort(-scores[positions], kind="stable")]